@@ -0,0 +1,563 @@
+import argparse
+import contextlib
+import io
+import json
+import os
+import platform
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.request
+
+import numpy as np
+import pandas as pd
+
+# Benchmark för V75 Spelvärdesanalys
+#
+# Mäter tiden för varje steg i flödet på syntetiska fält med 12-15 hästar,
+# i tre skalor: en omgång, en säsong och flera säsonger. AI-steget körs mot
+# en lokal OpenAI-stub med inställbar fördröjning. Resultatet sparas som JSON
+# och kan jämföras mot en tidigare körning:
+#
+#   python bench_spelvarde.py --output bench_ny.json --compare bench_gammal.json
+
+# OpenAI-klienten kräver en nyckel även mot stubben
+os.environ.setdefault('OPENAI_API_KEY', 'stub')
+
+import openai_stub
+import spelvarde
+
+RACES_PER_CARD = 7
+SCALES = {
+    'card': 1,         # En V75-omgång
+    'season': 52,      # En säsong med en omgång i veckan
+    'multi': 3 * 52,   # Tre säsonger
+}
+REGRESSION_THRESHOLD = 1.2      # Långsammare än så här räknas som regression...
+REGRESSION_MIN_DELTA = 0.0005   # ...om skillnaden också är minst en halv millisekund
+
+# Mål för kallstart (median, sekunder): import av modulen och `spelvarde.py --help`
+# i en ny process. pandas, numpy och openai får inte laddas vid import.
+COLD_START_TARGETS = {
+    'import': 0.15,
+    'cli': 0.30,
+}
+
+# Fel som stubben injicerar i bench_ai_faults, och tidsgräns per försök där
+AI_FAULTS = {'error_rate': 0.1, 'drop_rate': 0.05, 'stall_rate': 0.05, 'stall_seconds': 5.0}
+AI_FAULT_TIMEOUT = 2.0
+
+# Svar för extract_json_safely
+def _ranking_text(horses_data):
+    share = round(100 / len(horses_data), 1)
+    return json.dumps({
+        "horses": [
+            {"name": h['name'], "start_number": h['start_number'], "calculated_percentage": share}
+            for h in horses_data
+        ],
+        "analysis_summary": "Benchmark"
+    }, ensure_ascii=False, indent=2)
+
+MALFORMED_RESPONSES = {
+    'fenced': lambda text: f"```json\n{text}\n```",
+    'extra_brace': lambda text: text[:-1].rstrip() + "}]}",
+    'truncated': lambda text: text[:len(text) // 2],
+    'prose': lambda text: "Här är min analys: " + text,
+}
+
+def make_race(rng, n_horses):
+    """Syntetiskt lopp med samma kolumner som de riktiga CSV-filerna"""
+    positions = np.array(['1', '2', '3', '4', '5', '6', '7', '8', '9', '10', '11', '12', 'd', '0'], dtype=object)
+    position_weights = np.array([10, 10, 10, 9, 9, 8, 8, 7, 6, 5, 4, 3, 2, 1], dtype=float)
+    position_weights /= position_weights.sum()
+    distances = np.array([1609, 1640, 2100, 2140, 2160, 2640, 3140])
+
+    starts = rng.integers(3, 80, n_horses)
+    wins = rng.binomial(starts, 0.12)
+    seconds = rng.binomial(starts - wins, 0.12)
+    thirds = rng.binomial(starts - wins - seconds, 0.12)
+
+    race = {
+        'name': [f"Häst {rng.integers(1, 10 ** 6)}" for _ in range(n_horses)],
+        'start_number': np.arange(1, n_horses + 1),
+        'earnings': rng.integers(0, 3000000, n_horses),
+        'career_results': [f"{s} {w}-{t2}-{t3}" for s, w, t2, t3 in zip(starts, wins, seconds, thirds)],
+    }
+    for i in range(1, 4):
+        position = rng.choice(positions, n_horses, p=position_weights)
+        position[rng.random(n_horses) < 0.05] = None
+        race[f'previous_race_{i}_position'] = position
+        race[f'previous_race_{i}_distance'] = rng.choice(distances, n_horses)
+    return pd.DataFrame(race)
+
+def make_spelprocent(races):
+    """Spelprocent i samma format som spelprocentfilerna"""
+    rng = np.random.default_rng(len(races))
+    data = {}
+    for race_number, race in enumerate(races, 1):
+        shares = rng.dirichlet(np.ones(len(race)) * 0.8) * 100
+        data[f"V75-{race_number}"] = {
+            "horses": [
+                {"number": int(number), "percentage": round(float(share), 2)}
+                for number, share in zip(race['start_number'], shares)
+            ]
+        }
+    return data
+
+def make_track_data():
+    """Banstatistik med auto- och voltstart för två banor"""
+    rng = np.random.default_rng(0)
+    def stats():
+        return [
+            {"spår": str(position), "segerprocent": {"värde": f"{rng.uniform(2, 18):.1f}%"}}
+            for position in range(1, 16)
+        ]
+    return {
+        "spårstatistik": {
+            track: {"autostart": {"hög": stats()}, "voltstart": {"hög": stats()}}
+            for track in ("Axevalla", "Solvalla")
+        }
+    }
+
+def write_cards(directory, n_cards, seed=0):
+    """Skriv syntetiska omgångar som CSV och JSON, en katalog per omgång"""
+    rng = np.random.default_rng(seed)
+    track_data = make_track_data()
+    for card in range(n_cards):
+        card_dir = os.path.join(directory, f"omgang_{card:04d}")
+        os.makedirs(card_dir, exist_ok=True)
+        races = [make_race(rng, int(rng.integers(12, 16))) for _ in range(RACES_PER_CARD)]
+        for race_number, race in enumerate(races, 1):
+            race.to_csv(os.path.join(card_dir, f"Axevalla Lopp {race_number}.csv"), index=False)
+        with open(os.path.join(card_dir, "spelprocent.json"), 'w', encoding='utf-8') as f:
+            json.dump(make_spelprocent(races), f)
+        with open(os.path.join(card_dir, "axevalla.json"), 'w', encoding='utf-8') as f:
+            json.dump(track_data, f, ensure_ascii=False)
+
+def measure(function, repeat=5, number=1):
+    """Kör function och returnera tider per anrop i sekunder"""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        for _ in range(number):
+            function()
+        times.append((time.perf_counter() - start) / number)
+    return times
+
+def summarize(times, items=None):
+    """Nyckeltal för en serie tider"""
+    result = {
+        'best': min(times),
+        'median': statistics.median(times),
+        'mean': statistics.fmean(times),
+        'repeat': len(times),
+    }
+    if items:
+        result['items'] = items
+        result['per_item_us'] = result['median'] / items * 1e6
+    return result
+
+@contextlib.contextmanager
+def quiet():
+    """Dölj utskrifter från funktionerna som mäts"""
+    with contextlib.redirect_stdout(io.StringIO()):
+        yield
+
+@contextlib.contextmanager
+def stub_server(latency, **faults):
+    """Starta OpenAI-stubben i en tråd och peka klienterna mot den"""
+    argv = ['--port', '0', '--latency', str(latency), '--seed', '0']
+    for name, value in faults.items():
+        argv += [f"--{name.replace('_', '-')}", str(value)]
+    settings = openai_stub.parse_args(argv)
+    server = openai_stub.create_server(settings)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    base_url = f"http://127.0.0.1:{server.server_port}/v1"
+    previous = os.environ.get('OPENAI_BASE_URL')
+    os.environ['OPENAI_BASE_URL'] = base_url
+    try:
+        yield base_url
+    finally:
+        server.shutdown()
+        server.server_close()
+        if previous is None:
+            os.environ.pop('OPENAI_BASE_URL', None)
+        else:
+            os.environ['OPENAI_BASE_URL'] = previous
+
+def bench_loading(directory, repeat):
+    """load_horse_data för alla lopp i katalogen"""
+    cards = spelvarde.find_race_cards(directory)
+    jobs = [(path, card['spelprocent']) for card in cards for path in card['races']]
+    def run():
+        with quiet():
+            for race_csv_path, spelprocent_path in jobs:
+                spelvarde.load_horse_data(race_csv_path, spelprocent_path)
+    return summarize(measure(run, repeat), len(jobs))
+
+def bench_columnar(directory, repeat):
+    """Inläsning till kolumnlagret och load_horse_data ur lagret"""
+    cards = spelvarde.find_race_cards(directory)
+    jobs = [(path, card['spelprocent']) for card in cards for path in card['races']]
+    store = spelvarde.columnar_store
+    previous = store.directory
+    store.directory = os.path.join(directory, 'columnar')
+    def ingest():
+        for card in cards:
+            store.ingest(os.path.dirname(card['races'][0]))
+    def run():
+        with quiet():
+            for race_csv_path, spelprocent_path in jobs:
+                spelvarde.load_horse_data(race_csv_path, spelprocent_path)
+    try:
+        return {
+            'columnar_ingest': summarize(measure(ingest, 1), len(jobs)),
+            'load_horse_data_columnar': summarize(measure(run, repeat), len(jobs)),
+        }
+    finally:
+        store.directory = previous
+        store.stores.clear()
+
+def bench_stream(directory, repeat):
+    """Strömmande batch med lokal modell i huvudprocessen, block om standardstorlek"""
+    output_path = os.path.join(directory, 'stream.csv')
+    races = sum(len(card['races']) for card in spelvarde.find_race_cards(directory))
+    def run():
+        with quiet():
+            spelvarde.run_batch_stream(directory, output_path=output_path, workers=0, engine='local')
+    return {'batch_stream': summarize(measure(run, repeat), races)}
+
+def bench_service(directory, repeat):
+    """POST /card mot analystjänsten med lokal modell, första gången och med varma cacher"""
+    service = spelvarde.AnalysisService(directory, engine='local')
+    server = spelvarde.create_service_server(service, port=0)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    url = f"http://127.0.0.1:{server.server_port}/card"
+    cards = [os.path.relpath(os.path.dirname(card['races'][0]), directory)
+             for card in spelvarde.find_race_cards(directory)]
+    def run():
+        for card in cards:
+            request = urllib.request.Request(url, data=json.dumps({'directory': card}).encode('utf-8'))
+            with urllib.request.urlopen(request) as response:
+                response.read()
+    try:
+        with quiet():
+            return {
+                'service_card_cold': summarize(measure(run, 1), len(cards)),
+                'service_card_warm': summarize(measure(run, repeat), len(cards)),
+            }
+    finally:
+        server.shutdown()
+        server.server_close()
+
+def bench_history(directory, races, repeat):
+    """Inläsning av hästhistoriken och uppslag av äldre lopp per lopp"""
+    store = spelvarde.HistoryStore(os.path.join(directory, 'historik.sqlite'))
+    cards = spelvarde.find_race_cards(directory)
+    def ingest():
+        with quiet():
+            for card in cards:
+                store.ingest_card(card)
+    sample = races[:RACES_PER_CARD]
+    def lookup():
+        for race in sample:
+            store.extend(race)
+    try:
+        return {
+            'history_ingest': summarize(measure(ingest, 1), sum(len(card['races']) for card in cards)),
+            'history_lookup': summarize(measure(lookup, repeat), len(sample)),
+        }
+    finally:
+        store.close()
+
+def bench_fit(races, track_data, repeat):
+    """Log-likelihood med derivator och en hel Newton-anpassning över alla lopp, med slumpade vinnare"""
+    track_index = spelvarde.get_track_index(track_data)
+    features = np.concatenate([
+        np.column_stack([scores[column] for column in spelvarde.FEATURE_COLUMNS])
+        for scores in (spelvarde.score_horses(race, track_index) for race in races)
+    ]).astype(float)
+    sizes = np.array([len(race) for race in races])
+    starts = np.cumsum(sizes) - sizes
+    winners = starts + np.random.default_rng(0).integers(0, sizes)
+    coefficients = np.zeros(features.shape[1])
+    return {
+        'conditional_logit': summarize(
+            measure(lambda: spelvarde.conditional_logit(features, starts, winners, coefficients), repeat), len(races)
+        ),
+        'fit_conditional_logit': summarize(
+            measure(lambda: spelvarde.fit_conditional_logit(features, starts, winners, l2=0.01), repeat), len(races)
+        ),
+    }
+
+def bench_scoring(races, betting_data, track_data, repeat):
+    """Varje poängfunktion för sig, samt hela calculate_betting_value"""
+    track_index = spelvarde.get_track_index(track_data)
+    combined = pd.concat(races, ignore_index=True)
+    n = len(combined)
+    results = {
+        'compute_distance_scores': summarize(measure(lambda: spelvarde.compute_distance_scores(combined), repeat), n),
+        'compute_form_scores': summarize(measure(lambda: spelvarde.compute_form_scores(combined), repeat), n),
+        'compute_career_scores': summarize(measure(lambda: spelvarde.compute_career_scores(combined), repeat), n),
+        'compute_track_position_scores': summarize(
+            measure(lambda: spelvarde.compute_track_position_scores(combined, track_index), repeat), n
+        ),
+        'compile_track_index': summarize(measure(lambda: spelvarde.get_track_index(track_data), repeat)),
+    }
+
+    def per_race(function):
+        def run():
+            for race_number, race in enumerate(races, 1):
+                function(race.copy(), (race_number - 1) % RACES_PER_CARD + 1)
+        return run
+
+    results['calculate_betting_percentages'] = summarize(measure(per_race(
+        lambda race, number: spelvarde.calculate_betting_percentages(race, betting_data, number)
+    ), repeat), len(races))
+    # Utan delpoängscache, och med alla rader redan i cachen (i minnet)
+    def betting_value(race, number):
+        spelvarde.calculate_betting_value(race, betting_data, number, track_index)
+    with tempfile.TemporaryDirectory() as directory:
+        spelvarde.feature_cache = spelvarde.FeatureCache(directory, enabled=False)
+        results['calculate_betting_value'] = summarize(measure(per_race(betting_value), repeat), len(races))
+        spelvarde.feature_cache = spelvarde.FeatureCache(directory)
+        per_race(betting_value)()
+        results['calculate_betting_value_cached'] = summarize(measure(per_race(betting_value), repeat), len(races))
+    return results
+
+def bench_extract_json(horses_data, repeat):
+    """extract_json_safely på korrekta och trasiga svar"""
+    valid = _ranking_text(horses_data)
+    cases = {'valid': valid}
+    cases.update({name: make(valid) for name, make in MALFORMED_RESPONSES.items()})
+    results = {}
+    for name, text in cases.items():
+        def run(text=text):
+            with quiet():
+                spelvarde.extract_json_safely(text, horses_data)
+        results[name] = summarize(measure(run, repeat, number=200))
+    return results
+
+def bench_ai(races, latency, repeat):
+    """analyze_horse_with_ai och analyze_card_with_ai mot lokal stub"""
+    from openai import OpenAI
+    spelvarde.ai_cache.enabled = False
+    card = races[:RACES_PER_CARD]
+    with stub_server(latency) as base_url:
+        spelvarde.client = OpenAI(api_key='stub', base_url=base_url, max_retries=0)
+        def single():
+            with quiet():
+                spelvarde.analyze_horse_with_ai(card[0])
+        def concurrent():
+            with quiet():
+                spelvarde.analyze_card_with_ai(card)
+        return {
+            'latency': latency,
+            'analyze_horse_with_ai': summarize(measure(single, repeat)),
+            'analyze_card_with_ai': summarize(measure(concurrent, repeat), len(card)),
+        }
+
+def bench_ai_faults(races, latency, repeat):
+    """analyze_card_with_ai mot en stub som injicerar fel, utan och med hedging"""
+    spelvarde.ai_cache.enabled = False
+    card = races[:RACES_PER_CARD]
+    results = {'latency': latency, 'faults': AI_FAULTS}
+    previous = spelvarde.ai_transport
+    latencies = []
+    try:
+        with stub_server(latency, **AI_FAULTS):
+            for name, hedge in (('plain', False), ('hedged', True)):
+                transport = spelvarde.LLMTransport(timeout=AI_FAULT_TIMEOUT, hedge=hedge)
+                transport.latencies.extend(latencies)
+                spelvarde.ai_transport = transport
+                fallbacks = spelvarde.metrics.counters.get('ai_fallbacks', 0)
+                def concurrent():
+                    with quiet():
+                        spelvarde.analyze_card_with_ai(card)
+                results[name] = summarize(measure(concurrent, repeat), len(card))
+                results[name]['fallbacks'] = spelvarde.metrics.counters.get('ai_fallbacks', 0) - fallbacks
+                latencies = list(transport.latencies)
+    finally:
+        spelvarde.ai_transport = previous
+    return results
+
+def cold_start(args, repeat):
+    """Väggtid för en ny Python-process som kör args"""
+    env = dict(os.environ, OPENAI_API_KEY=os.environ.get('OPENAI_API_KEY', 'stub'))
+    cwd = os.path.dirname(os.path.abspath(spelvarde.__file__))
+    times = []
+    for _ in range(repeat):
+        started = time.perf_counter()
+        output = subprocess.run([sys.executable] + args, capture_output=True, text=True,
+                                env=env, cwd=cwd, check=True)
+        times.append((output, time.perf_counter() - started))
+    return times
+
+def bench_import(repeat):
+    """Kallstart: tid för att importera spelvarde i en ny process"""
+    code = ("import json, sys, time; t = time.perf_counter(); import spelvarde; "
+            "print(json.dumps({'seconds': time.perf_counter() - t, 'loaded': "
+            "[m for m in ('pandas', 'numpy', 'openai') if type(sys.modules.get(m)).__name__ == 'module']}))")
+    runs = [json.loads(output.stdout.strip().splitlines()[-1]) for output, _ in cold_start(['-c', code], repeat)]
+    result = summarize([run['seconds'] for run in runs])
+    result['loaded'] = runs[-1]['loaded']
+    return result
+
+def bench_cli(repeat):
+    """Kallstart: hela processen för `spelvarde.py --help`"""
+    return summarize([seconds for _, seconds in cold_start(['spelvarde.py', '--help'], repeat)])
+
+def check_cold_start(results):
+    """Jämför kallstart mot COLD_START_TARGETS, returnerar antal överskridna mål"""
+    missed = 0
+    print(f"\n{'Kallstart':60}{'Mål':>12}{'Median':>12}")
+    for name, target in COLD_START_TARGETS.items():
+        median = results[name]['median']
+        flag = ''
+        if median > target:
+            flag = '  ÖVER MÅL'
+            missed += 1
+        print(f"{name:60}{target * 1000:>10.1f}ms{median * 1000:>10.1f}ms{flag}")
+    loaded = results['import'].get('loaded')
+    if loaded:
+        print(f"Laddade vid import: {', '.join(loaded)}")
+        missed += 1
+    return missed
+
+def scored_races(races, betting_data, track_data):
+    """Poängsatta lopp för AI-stegen"""
+    return [
+        spelvarde.calculate_betting_value(race.copy(), betting_data, number, track_data)
+        for number, race in enumerate(races, 1)
+    ]
+
+def git_revision():
+    """Aktuell git-commit, om tillgänglig"""
+    try:
+        return subprocess.run(
+            ['git', 'rev-parse', '--short', 'HEAD'], capture_output=True, text=True, check=True,
+            cwd=os.path.dirname(os.path.abspath(__file__))
+        ).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_benchmarks(scales, repeat, latency, seed):
+    """Kör alla benchmarks och returnera resultat som dict"""
+    results = {
+        'meta': {
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'pandas': pd.__version__,
+            'numpy': np.__version__,
+            'platform': platform.platform(),
+            'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        },
+        'import': bench_import(repeat),
+        'cli': bench_cli(repeat),
+        'scales': {}
+    }
+
+    track_data = make_track_data()
+    for scale in scales:
+        n_cards = SCALES[scale]
+        print(f"Skala {scale}: {n_cards} omgångar...", file=sys.stderr)
+        rng = np.random.default_rng(seed)
+        races = [make_race(rng, int(rng.integers(12, 16))) for _ in range(n_cards * RACES_PER_CARD)]
+        betting_data = make_spelprocent(races[:RACES_PER_CARD])
+
+        with tempfile.TemporaryDirectory() as directory:
+            write_cards(directory, n_cards, seed)
+            scale_results = {'load_horse_data': bench_loading(directory, repeat)}
+            scale_results.update(bench_columnar(directory, repeat))
+            scale_results.update(bench_service(directory, repeat))
+            scale_results.update(bench_stream(directory, repeat))
+            scale_results.update(bench_history(directory, races, repeat))
+        scale_results.update(bench_scoring(races, betting_data, track_data, repeat))
+        scale_results.update(bench_fit(races, track_data, repeat))
+        results['scales'][scale] = scale_results
+
+    rng = np.random.default_rng(seed)
+    card_races = [make_race(rng, int(rng.integers(12, 16))) for _ in range(RACES_PER_CARD)]
+    card = scored_races(card_races, make_spelprocent(card_races), track_data)
+    results['extract_json_safely'] = bench_extract_json(spelvarde.prepare_horses_data(card[0]), repeat)
+    if latency is not None:
+        # Körloggen skrivs som vanligt men till en tillfällig katalog
+        with tempfile.TemporaryDirectory() as directory:
+            spelvarde.run_log.directory = directory
+            results['ai'] = bench_ai(card, latency, repeat)
+            results['ai_faults'] = bench_ai_faults(card, latency, repeat)
+            spelvarde.run_log.close()
+    return results
+
+def flatten(results, prefix=''):
+    """Platta till resultat till {namn: median}"""
+    flat = {}
+    for key, value in results.items():
+        if key == 'meta' or not isinstance(value, dict):
+            continue
+        name = f"{prefix}{key}"
+        if 'median' in value:
+            flat[name] = value['median']
+        else:
+            flat.update(flatten(value, name + '.'))
+    return flat
+
+def compare(current, previous):
+    """Jämför medianer mot en tidigare körning, returnerar antal regressioner"""
+    current_flat, previous_flat = flatten(current), flatten(previous)
+    regressions = 0
+    print(f"\n{'Benchmark':60}{'Före':>12}{'Nu':>12}{'Kvot':>8}")
+    for name, now in current_flat.items():
+        before = previous_flat.get(name)
+        if not before:
+            continue
+        ratio = now / before
+        flag = ''
+        if ratio > REGRESSION_THRESHOLD and now - before > REGRESSION_MIN_DELTA:
+            flag = '  REGRESSION'
+            regressions += 1
+        print(f"{name:60}{before * 1000:>10.3f}ms{now * 1000:>10.3f}ms{ratio:>8.2f}{flag}")
+    return regressions
+
+def print_results(results):
+    """Skriv ut medianer"""
+    print(f"\n{'Benchmark':60}{'Median':>12}")
+    for name, median in flatten(results).items():
+        print(f"{name:60}{median * 1000:>10.3f}ms")
+
+def parse_args(argv=None):
+    """Tolka kommandoradsargument"""
+    parser = argparse.ArgumentParser(description="Benchmark för V75 Spelvärdesanalys")
+    parser.add_argument('--scales', nargs='+', choices=list(SCALES), default=['card', 'season'],
+                        help="Skalor att köra")
+    parser.add_argument('--repeat', type=int, default=5, help="Antal upprepningar per mätning")
+    parser.add_argument('--latency', type=float, default=0.2,
+                        help="Fördröjning i sekunder för OpenAI-stubben (negativt värde hoppar över AI)")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--output', default='bench_results.json', help="Spara resultat som JSON")
+    parser.add_argument('--compare', help="Tidigare resultatfil att jämföra mot")
+    return parser.parse_args(argv)
+
+def main(argv=None):
+    args = parse_args(argv)
+    results = run_benchmarks(args.scales, args.repeat, args.latency if args.latency >= 0 else None, args.seed)
+    print_results(results)
+    missed = check_cold_start(results)
+
+    with open(args.output, 'w', encoding='utf-8') as f:
+        json.dump(results, f, ensure_ascii=False, indent=2)
+    print(f"\nResultat sparat i: {args.output}")
+
+    if args.compare:
+        with open(args.compare, 'r', encoding='utf-8') as f:
+            previous = json.load(f)
+        if compare(results, previous):
+            return 1
+    return 1 if missed else 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,230 @@
+import argparse
+import json
+import random
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Lokal ersättare för OpenAI:s chat-API
+#
+# Svarar på POST .../chat/completions med en giltig travanalys för hästarna i
+# prompten, som ett helt svar eller strömmat (stream=True) i bitar om några
+# tecken. Används för att köra AI-flödet utan nätverk och utan kostnad:
+#
+#   python openai_stub.py --port 8765 --latency 1.5
+#   OPENAI_BASE_URL=http://127.0.0.1:8765/v1 OPENAI_API_KEY=stub python spelvarde.py batch csv
+#
+# Fel kan injiceras med given sannolikhet per anrop för att testa
+# transportlagret: felstatus (--error-rate), långa fördröjningar
+# (--stall-rate), avbrutna anslutningar (--drop-rate) och svar utan
+# hästlista (--garbage-rate).
+
+# Svar som inte går att tolka, för --garbage-rate
+GARBAGE_CONTENT = "Jag kan tyvärr inte rangordna hästarna i det här loppet utan mer information om " * 8
+
+def extract_horses(messages):
+    """Plocka ut hästlistan ur promptens JSON"""
+    prompt = messages[-1]['content'] if messages else ''
+    start = prompt.find('[')
+    if start < 0:
+        return []
+    try:
+        horses, _ = json.JSONDecoder().raw_decode(prompt[start:])
+        return horses
+    except json.JSONDecodeError:
+        return []
+
+def build_ranking(horses, rng):
+    """Slumpa procentsatser som summerar till 100"""
+    weights = [rng.random() + 0.1 for _ in horses]
+    total = sum(weights)
+    return {
+        "horses": [
+            {
+                "name": horse.get('name'),
+                "start_number": horse.get('start_number'),
+                "calculated_percentage": round(weight / total * 100, 1)
+            }
+            for horse, weight in zip(horses, weights)
+        ],
+        "analysis_summary": "Svar från lokal stub"
+    }
+
+def build_completion(content, model, prompt_tokens):
+    """Svar i samma format som chat.completions"""
+    completion_tokens = len(content) // 4
+    return {
+        "id": f"chatcmpl-stub-{int(time.time() * 1000)}",
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [
+            {
+                "index": 0,
+                "message": {"role": "assistant", "content": content},
+                "finish_reason": "stop"
+            }
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens
+        }
+    }
+
+def build_chunk(completion_id, model, delta=None, finish_reason=None, usage=None):
+    """En händelse i ett strömmat svar, i samma format som chat.completions"""
+    chunk = {
+        "id": completion_id,
+        "object": "chat.completion.chunk",
+        "created": int(time.time()),
+        "model": model,
+        "choices": [] if usage else [
+            {"index": 0, "delta": delta or {}, "finish_reason": finish_reason}
+        ]
+    }
+    if usage:
+        chunk["usage"] = usage
+    return chunk
+
+def choose_fault(settings, rng):
+    """Dra vilket fel (om något) ett anrop ska få"""
+    draw = rng.random()
+    for fault in ('error', 'stall', 'drop', 'garbage'):
+        rate = getattr(settings, f'{fault}_rate')
+        if draw < rate:
+            return fault
+        draw -= rate
+    return None
+
+def make_handler(settings):
+    """Skapa request-hanterare med givna inställningar"""
+    rng = random.Random(settings.seed)
+
+    class StubHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def log_message(self, format, *args):
+            if settings.verbose:
+                super().log_message(format, *args)
+
+        def send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False).encode('utf-8')
+            try:
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                # Klienten gav upp innan svaret var klart
+                self.close_connection = True
+
+        def write_chunk(self, data):
+            """Skriv en bit med chunked transfer encoding"""
+            self.wfile.write(f"{len(data):X}\r\n".encode('ascii') + data + b"\r\n")
+            self.wfile.flush()
+
+        def send_stream(self, completion, include_usage, drop=False):
+            """Skicka ett färdigt svar som server-sent events. drop bryter anslutningen halvvägs."""
+            content = completion['choices'][0]['message']['content']
+            events = [build_chunk(completion['id'], completion['model'], {"role": "assistant", "content": ""})]
+            for start in range(0, len(content), settings.chunk_chars):
+                events.append(build_chunk(completion['id'], completion['model'],
+                                          {"content": content[start:start + settings.chunk_chars]}))
+            events.append(build_chunk(completion['id'], completion['model'], finish_reason='stop'))
+            if include_usage:
+                events.append(build_chunk(completion['id'], completion['model'], usage=completion['usage']))
+
+            if drop:
+                events = events[:len(events) // 2]
+            try:
+                self.send_response(200)
+                self.send_header('Content-Type', 'text/event-stream')
+                self.send_header('Transfer-Encoding', 'chunked')
+                self.end_headers()
+                for event in events:
+                    self.write_chunk(f"data: {json.dumps(event, ensure_ascii=False)}\n\n".encode('utf-8'))
+                    if settings.token_delay:
+                        time.sleep(settings.token_delay)
+                if drop:
+                    self.close_connection = True
+                    return
+                self.write_chunk(b"data: [DONE]\n\n")
+                self.write_chunk(b"")
+            except (BrokenPipeError, ConnectionResetError):
+                # Klienten avbröt strömmen
+                self.close_connection = True
+
+        def do_POST(self):
+            length = int(self.headers.get('Content-Length', 0))
+            request = json.loads(self.rfile.read(length) or b'{}')
+
+            if not self.path.endswith('/chat/completions'):
+                self.send_json(404, {"error": {"message": f"Okänd sökväg: {self.path}"}})
+                return
+
+            fault = choose_fault(settings, rng)
+            delay = settings.latency + rng.uniform(0, settings.jitter)
+            if fault == 'stall':
+                delay += settings.stall_seconds
+            time.sleep(delay)
+
+            if fault == 'error':
+                self.send_json(settings.error_status, {"error": {"message": "Injicerat fel från stub"}})
+                return
+
+            messages = request.get('messages', [])
+            if fault == 'garbage':
+                content = GARBAGE_CONTENT
+            else:
+                content = json.dumps(build_ranking(extract_horses(messages), rng), ensure_ascii=False, indent=2)
+            prompt_tokens = sum(len(m.get('content', '')) for m in messages) // 4
+            completion = build_completion(content, request.get('model', 'stub'), prompt_tokens)
+            if request.get('stream'):
+                include_usage = (request.get('stream_options') or {}).get('include_usage', False)
+                self.send_stream(completion, include_usage, drop=fault == 'drop')
+            elif fault == 'drop':
+                # Stäng utan att svara
+                self.close_connection = True
+            else:
+                self.send_json(200, completion)
+
+    return StubHandler
+
+def parse_args(argv=None):
+    """Tolka kommandoradsargument"""
+    parser = argparse.ArgumentParser(description="Lokal stub för OpenAI:s chat-API")
+    parser.add_argument('--host', default='127.0.0.1')
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--latency', type=float, default=0.0, help="Fast fördröjning per anrop i sekunder")
+    parser.add_argument('--jitter', type=float, default=0.0, help="Slumpmässig extra fördröjning i sekunder")
+    parser.add_argument('--chunk-chars', type=int, default=8, help="Tecken per bit i strömmade svar")
+    parser.add_argument('--token-delay', type=float, default=0.0,
+                        help="Fördröjning i sekunder mellan bitar i strömmade svar")
+    parser.add_argument('--error-rate', type=float, default=0.0, help="Andel anrop som får felstatus")
+    parser.add_argument('--error-status', type=int, default=500, help="HTTP-status för injicerade fel")
+    parser.add_argument('--stall-rate', type=float, default=0.0, help="Andel anrop med extra fördröjning")
+    parser.add_argument('--stall-seconds', type=float, default=30.0, help="Extra fördröjning i sekunder")
+    parser.add_argument('--drop-rate', type=float, default=0.0, help="Andel anrop där anslutningen bryts")
+    parser.add_argument('--garbage-rate', type=float, default=0.0, help="Andel anrop med svar utan hästlista")
+    parser.add_argument('--seed', type=int, default=None)
+    parser.add_argument('--verbose', action='store_true')
+    return parser.parse_args(argv)
+
+def create_server(settings):
+    """Skapa servern utan att starta den"""
+    return ThreadingHTTPServer((settings.host, settings.port), make_handler(settings))
+
+def main(argv=None):
+    settings = parse_args(argv)
+    server = create_server(settings)
+    print(f"OpenAI-stub lyssnar på http://{settings.host}:{server.server_port}/v1")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+
+if __name__ == "__main__":
+    main()
@@ -1,16 +1,398 @@
-import pandas as pd
-import numpy as np
 import json
 import os
 import re
-from dotenv import load_dotenv
-from openai import OpenAI
+import sys
+import argparse
+import time
+import random
+import collections
+import hashlib
+import importlib.util
+import tempfile
+import threading
+import queue
+import contextlib
+import cProfile
+import functools
 
-# Ladda miljövariabler från .env filen
-load_dotenv()
+# Snabb uppstart
+#
+# pandas, numpy, dotenv, openai, asyncio och processpoolen tar tillsammans
+# runt en sekund att importera. De tunga modulerna laddas därför först när de används och
+# OpenAI-klienten skapas vid första AI-anropet. Processpoolens arbetare
+# poängsätter bara lopp och laddar aldrig openai.
 
-# Konfigurera OpenAI API
-client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'))
+def lazy_import(name):
+    """Registrera en modul som laddas vid första attributåtkomst"""
+    if name in sys.modules:
+        return sys.modules[name]
+    spec = importlib.util.find_spec(name)
+    if spec is None:
+        raise ImportError(f"Modulen {name} är inte installerad")
+    loader = importlib.util.LazyLoader(spec.loader)
+    spec.loader = loader
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[name] = module
+    loader.exec_module(module)
+    parent, _, child = name.rpartition('.')
+    if parent:
+        setattr(sys.modules[parent], child, module)
+    return module
+
+pd = lazy_import('pandas')
+np = lazy_import('numpy')
+asyncio = lazy_import('asyncio')
+futures = lazy_import('concurrent.futures')
+shared_memory = lazy_import('multiprocessing.shared_memory')
+gzip = lazy_import('gzip')
+sqlite3 = lazy_import('sqlite3')
+http_server = lazy_import('http.server')
+
+def load_modules(*modules):
+    """
+    Ladda lata moduler direkt. LazyLoader är inte trådsäker, så moduler som
+    används från flera trådar samtidigt laddas innan trådarna startar.
+    """
+    for module in modules:
+        getattr(module, '__dict__')
+
+# OpenAI-klienten skapas av get_client()
+client = None
+_environment_loaded = False
+
+def load_environment():
+    """Ladda miljövariabler från .env filen (en gång)"""
+    global _environment_loaded
+    if not _environment_loaded:
+        from dotenv import load_dotenv
+        load_dotenv()
+        _environment_loaded = True
+
+def get_client():
+    """Delad OpenAI-klient, skapas vid första anropet"""
+    global client
+    if client is None:
+        load_environment()
+        from openai import OpenAI
+        # Nya försök och tidsgränser sköts av ai_transport
+        client = OpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+    return client
+
+def create_async_client():
+    """Ny asynkron OpenAI-klient för en körning"""
+    load_environment()
+    from openai import AsyncOpenAI
+    return AsyncOpenAI(api_key=os.getenv('OPENAI_API_KEY'), max_retries=0)
+
+# Mätning av körningen
+#
+# Samlar väggtid per steg, AI-latens, tokenförbrukning och räknare för
+# omförsök, fallbacks och JSON-reparationer. Sammanfattningen kan sparas som
+# JSON med latenshistogram. Profilering av poängberäkningen slås på separat.
+
+# Gränser (sekunder) för latenshistogram
+LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+MAX_RECORDED_ERRORS = 50
+
+class RunMetrics:
+    """Mätvärden för en körning"""
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.started = time.time()
+        self.stages = {}
+        self.counters = {}
+        self.tokens = {'prompt': 0, 'completion': 0}
+        self.errors = []
+        self.profiler = None
+    
+    def timed(self, name):
+        """Dekorator som mäter väggtid för varje anrop av funktionen"""
+        def decorator(function):
+            @functools.wraps(function)
+            def wrapper(*args, **kwargs):
+                with self.stage(name):
+                    return function(*args, **kwargs)
+            return wrapper
+        return decorator
+    
+    @contextlib.contextmanager
+    def stage(self, name):
+        """Mät väggtid för ett steg"""
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record_stage(name, time.perf_counter() - start)
+    
+    def record_stage(self, name, seconds):
+        with self.lock:
+            self.stages.setdefault(name, []).append(seconds)
+    
+    def increment(self, name, amount=1):
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + amount
+    
+    def record_llm_call(self, seconds, usage=None):
+        """Latens och tokens för ett AI-anrop"""
+        self.record_stage('llm_call', seconds)
+        self.increment('llm_calls')
+        if usage is not None:
+            with self.lock:
+                self.tokens['prompt'] += getattr(usage, 'prompt_tokens', 0) or 0
+                self.tokens['completion'] += getattr(usage, 'completion_tokens', 0) or 0
+    
+    def record_error(self, stage, error):
+        """Spara ett fel som annars bara skrivs ut"""
+        self.increment(f'errors.{stage}')
+        with self.lock:
+            if len(self.errors) < MAX_RECORDED_ERRORS:
+                self.errors.append({'stage': stage, 'type': type(error).__name__, 'message': str(error)})
+    
+    def export_raw(self):
+        """Råa mätvärden, för att skicka från en arbetsprocess"""
+        with self.lock:
+            return {
+                'stages': {name: list(values) for name, values in self.stages.items()},
+                'counters': dict(self.counters),
+                'tokens': dict(self.tokens),
+                'errors': list(self.errors)
+            }
+    
+    def reset(self):
+        """Töm alla mätvärden (t.ex. i en arbetsprocess mellan jobb)"""
+        with self.lock:
+            self.stages, self.counters, self.errors = {}, {}, []
+            self.tokens = {'prompt': 0, 'completion': 0}
+    
+    def merge_raw(self, raw):
+        """Lägg till mätvärden från en arbetsprocess"""
+        if not raw:
+            return
+        with self.lock:
+            for name, values in raw['stages'].items():
+                self.stages.setdefault(name, []).extend(values)
+            for name, value in raw['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, value in raw['tokens'].items():
+                self.tokens[name] += value
+            self.errors.extend(raw['errors'][:MAX_RECORDED_ERRORS - len(self.errors)])
+    
+    @staticmethod
+    def _stage_summary(values):
+        values = np.asarray(values)
+        return {
+            'count': int(len(values)),
+            'total': float(values.sum()),
+            'mean': float(values.mean()),
+            'p50': float(np.percentile(values, 50)),
+            'p95': float(np.percentile(values, 95)),
+            'p99': float(np.percentile(values, 99)),
+            'max': float(values.max())
+        }
+    
+    @staticmethod
+    def histogram(values):
+        """Antal värden per latenshink, sista hinken är allt över högsta gränsen"""
+        counts = np.bincount(np.searchsorted(LATENCY_BUCKETS, values), minlength=len(LATENCY_BUCKETS) + 1)
+        labels = [f'<={bound}' for bound in LATENCY_BUCKETS] + [f'>{LATENCY_BUCKETS[-1]}']
+        return dict(zip(labels, counts.tolist()))
+    
+    def summary(self):
+        """Maskinläsbar sammanfattning av körningen"""
+        with self.lock:
+            stages = {name: list(values) for name, values in self.stages.items()}
+            counters = dict(self.counters)
+            tokens = dict(self.tokens)
+            errors = list(self.errors)
+        
+        return {
+            'started': self.started,
+            'wall_time': time.time() - self.started,
+            'stages': {name: self._stage_summary(values) for name, values in stages.items() if values},
+            'histograms': {name: self.histogram(values) for name, values in stages.items() if values},
+            'counters': counters,
+            'tokens': tokens,
+            'errors': errors
+        }
+    
+    def write(self, path):
+        """Spara sammanfattningen som JSON"""
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.summary(), f, ensure_ascii=False, indent=2)
+    
+    def print_summary(self):
+        """Skriv ut tid per steg och räknare"""
+        summary = self.summary()
+        print("\n=== MÄTVÄRDEN ===")
+        print(f"{'Steg':32}{'Antal':>8}{'Totalt':>10}{'p50':>10}{'p95':>10}")
+        for name, stage in sorted(summary['stages'].items(), key=lambda item: -item[1]['total']):
+            print(f"{name:32}{stage['count']:>8}{stage['total']:>9.3f}s"
+                  f"{stage['p50'] * 1000:>8.1f}ms{stage['p95'] * 1000:>8.1f}ms")
+        if summary['tokens']['prompt'] or summary['tokens']['completion']:
+            print(f"Tokens: {summary['tokens']['prompt']} prompt, {summary['tokens']['completion']} svar")
+        for name, value in sorted(summary['counters'].items()):
+            print(f"{name}: {value}")
+    
+    # Profilering av poängberäkningen
+    def enable_profiling(self):
+        self.profiler = cProfile.Profile()
+    
+    @contextlib.contextmanager
+    def profile(self):
+        """Profilera blocket om profilering är påslagen"""
+        if self.profiler is None:
+            yield
+            return
+        self.profiler.enable()
+        try:
+            yield
+        finally:
+            self.profiler.disable()
+    
+    def write_profile(self, path):
+        """Spara profilen (läses med pstats eller snakeviz)"""
+        if self.profiler is not None:
+            directory = os.path.dirname(path)
+            if directory:
+                os.makedirs(directory, exist_ok=True)
+            self.profiler.dump_stats(path)
+
+# Delade mätvärden för körningen
+metrics = RunMetrics()
+
+# Körlogg
+#
+# Varje AI-analys loggas som en JSON-rad med hästdata, prompt, svar, tolkat
+# resultat och tider. Raderna läggs i en kö och skrivs av en bakgrundstråd
+# till gzip-komprimerade JSONL-filer, så analysen aldrig väntar på disken.
+# Är kön full tappas raden hellre än att analysen blockeras. Filerna roteras
+# på storlek och ålder och de äldsta tas bort. Läses med `spelvarde.py runs`.
+
+RUN_LOG_DIR = 'logs'
+RUN_LOG_MAX_BYTES = 5 * 1024 * 1024    # Komprimerad storlek innan ny fil
+RUN_LOG_MAX_AGE = 3600                 # Sekunder innan ny fil
+RUN_LOG_KEEP = 100                     # Antal filer som sparas
+RUN_LOG_QUEUE_SIZE = 10000
+RUN_LOG_BATCH = 500                    # Max antal rader per skrivning
+
+class RunLog:
+    """
+    Strukturerad körlogg med bakgrundsskrivare. Varje skrivning läggs till som
+    en egen gzip-medlem, så en fil är läsbar även om processen avbryts.
+    """
+    def __init__(self, directory=RUN_LOG_DIR, enabled=True):
+        self.directory = directory
+        self.enabled = enabled
+        self.run_id = f"{time.strftime('%Y%m%d-%H%M%S')}-{os.getpid()}"
+        self.queue = queue.Queue(maxsize=RUN_LOG_QUEUE_SIZE)
+        self.thread = None
+        self.lock = threading.Lock()
+        self.path = None
+        self.opened = 0
+        self.sequence = 0
+    
+    def log(self, kind, **fields):
+        """Lägg en rad i kön, blockerar aldrig"""
+        if not self.enabled:
+            return
+        if self.thread is None:
+            self._start()
+        entry = {'time': time.time(), 'run': self.run_id, 'kind': kind, **fields}
+        try:
+            self.queue.put_nowait(entry)
+        except queue.Full:
+            metrics.increment('run_log_dropped')
+    
+    def _start(self):
+        with self.lock:
+            if self.thread is None:
+                self.thread = threading.Thread(target=self._writer, name='run-log', daemon=True)
+                self.thread.start()
+    
+    def _writer(self):
+        """Bakgrundstråden: töm kön i omgångar och skriv till aktuell fil"""
+        while True:
+            entries = [self.queue.get()]
+            while len(entries) < RUN_LOG_BATCH:
+                try:
+                    entries.append(self.queue.get_nowait())
+                except queue.Empty:
+                    break
+            stop = None in entries
+            entries = [entry for entry in entries if entry is not None]
+            if entries:
+                try:
+                    self._write(entries)
+                except Exception as e:
+                    print(f"Kunde inte skriva körlogg: {e}")
+                    metrics.record_error('run_log', e)
+            if stop:
+                return
+    
+    def _write(self, entries):
+        if self.path is None or self._should_rotate():
+            self._rotate()
+        data = ''.join(json.dumps(entry, ensure_ascii=False, default=str) + '\n' for entry in entries)
+        with gzip.open(self.path, 'ab') as f:
+            f.write(data.encode('utf-8'))
+    
+    def _should_rotate(self):
+        if time.monotonic() - self.opened >= RUN_LOG_MAX_AGE:
+            return True
+        try:
+            return os.path.getsize(self.path) >= RUN_LOG_MAX_BYTES
+        except OSError:
+            return True
+    
+    def _rotate(self):
+        """Byt till en ny fil och ta bort de äldsta"""
+        os.makedirs(self.directory, exist_ok=True)
+        self.path = os.path.join(self.directory, f"run-{self.run_id}-{self.sequence:03d}.jsonl.gz")
+        self.sequence += 1
+        self.opened = time.monotonic()
+        for path in run_log_files(self.directory)[:-RUN_LOG_KEEP]:
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def close(self, timeout=5.0):
+        """Skriv ut det som ligger i kön och stoppa skrivaren"""
+        if self.thread is None:
+            return
+        try:
+            self.queue.put(None, timeout=timeout)
+        except queue.Full:
+            return
+        self.thread.join(timeout)
+        self.thread = None
+
+def run_log_files(directory=RUN_LOG_DIR):
+    """Loggfiler sorterade från äldst till nyast"""
+    try:
+        names = [name for name in os.listdir(directory) if name.endswith('.jsonl.gz')]
+    except FileNotFoundError:
+        return []
+    return [os.path.join(directory, name) for name in sorted(names)]
+
+def read_run_log(directory=RUN_LOG_DIR):
+    """Alla loggrader, äldst först. En avbruten sista rad hoppas över."""
+    for path in run_log_files(directory):
+        try:
+            with gzip.open(path, 'rt', encoding='utf-8') as f:
+                for line in f:
+                    try:
+                        yield json.loads(line)
+                    except json.JSONDecodeError:
+                        continue
+        except (OSError, EOFError) as e:
+            print(f"Kunde inte läsa {path}: {e}")
+
+# Delad körlogg
+run_log = RunLog()
 
 # Funktioner för filhantering
 def list_csv_files(directory="csv"):
@@ -33,74 +415,46 @@ def list_json_files(directory="json"):
         print(f"Fel vid listning av JSON-filer: {e}")
         return []
 
-def select_csv_file():
-    """Låt användaren välja en CSV-fil"""
-    csv_files = list_csv_files()
-    
-    if not csv_files:
-        print("Inga CSV-filer hittades. Lägg till filer och försök igen.")
-        return None
-    
-    print("\nTillgängliga CSV-filer:")
-    for i, file in enumerate(csv_files, 1):
-        print(f"{i}. {file}")
-    
+def choose_file(paths, prompt):
+    """Låt användaren välja en av filerna. None vid ogiltigt val."""
+    for i, path in enumerate(paths, 1):
+        print(f"{i}. {os.path.basename(path)}")
     try:
-        choice = int(input("\nVälj filnummer: "))
-        if 1 <= choice <= len(csv_files):
-            return os.path.join("csv", csv_files[choice-1])
-        else:
-            print("Ogiltigt val!")
-            return None
+        choice = int(input(prompt))
     except ValueError:
         print("Ange ett giltigt nummer!")
         return None
+    if 1 <= choice <= len(paths):
+        return paths[choice - 1]
+    print("Ogiltigt val!")
+    return None
 
-def select_json_files():
-    """Låt användaren välja JSON-filer för spelprocent och banstatistik"""
+def select_json_files(catalog):
+    """Låt användaren välja spelprocent- och banstatistikfil bland katalogens JSON-filer"""
     print("\n===== VÄLJ JSON-FILER =====")
     
-    json_files = list_json_files()
-    
-    if not json_files:
-        print("Inga JSON-filer hittades.")
+    if not catalog.spelprocent_files:
+        print("Inga spelprocentfiler hittades.")
         return None, None
     
-    # Separera filer
-    spelprocent_files = [f for f in json_files if 'spelprocent' in f.lower()]
-    banstatistik_files = [f for f in json_files if 'axevalla' in f.lower()]
-    
-    # Välj spelprocentfil
     print("\nTillgängliga spelprocentfiler:")
-    for i, file in enumerate(spelprocent_files, 1):
-        print(f"{i}. {file}")
-    
-    try:
-        spelprocent_choice = int(input("\nVälj spelprocentfil: ")) - 1
-        spelprocent_path = os.path.join("json", spelprocent_files[spelprocent_choice])
-    except (ValueError, IndexError):
-        print("Ogiltigt val!")
+    spelprocent_path = choose_file(catalog.spelprocent_files, "\nVälj spelprocentfil: ")
+    if not spelprocent_path:
         return None, None
     
-    # Välj banstatistikfil
     print("\nTillgängliga banstatistikfiler:")
-    for i, file in enumerate(banstatistik_files, 1):
-        print(f"{i}. {file}")
-    
-    try:
-        banstatistik_choice = int(input("\nVälj banstatistikfil: ")) - 1
-        banstatistik_path = os.path.join("json", banstatistik_files[banstatistik_choice])
-    except (ValueError, IndexError):
+    banstatistik_path = choose_file(catalog.track_files, "\nVälj banstatistikfil: ")
+    if not banstatistik_path:
         print("Varning: Ingen banstatistikfil vald.")
-        banstatistik_path = None
     
     return spelprocent_path, banstatistik_path
 
+@metrics.timed('load_horse_data')
 def load_horse_data(race_csv_path, spelprocent_json_path):
     """Läs in hästdata från CSV och JSON"""
     try:
-        # Läs CSV-fil
-        horses_df = pd.read_csv(race_csv_path)
+        # Läs CSV-fil, eller dess kolumner ur kolumnlagret
+        horses_df = read_race_csv(race_csv_path)
         
         # Läs spelprocentfil
         with open(spelprocent_json_path, 'r', encoding='utf-8') as f:
@@ -113,415 +467,1394 @@ def load_horse_data(race_csv_path, spelprocent_json_path):
     
     except Exception as e:
         print(f"Fel vid inläsning av data: {e}")
+        metrics.record_error('load_horse_data', e)
         return None, None, None
 
+def load_track_data(banstatistik_json_path):
+    """Läs in banstatistik om filen finns"""
+    if banstatistik_json_path and os.path.exists(banstatistik_json_path):
+        with open(banstatistik_json_path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    return None
+
+class RaceNumberError(ValueError):
+    """Loppnumret går varken att läsa ur filnamnet eller ur loppdata"""
+
+def race_number_from_filename(filename):
+    """
+    Loppnummer ur "Lopp N" eller "V75-N" i ett filnamn, None om det saknas.
+    "Lopp N" går först, och V75-N räknas bara som ett fristående 1-7 så att
+    datum som i "V75-2024-05-04 Lopp 3" inte tolkas som loppnummer.
+    """
+    basename = os.path.basename(filename)
+    match = (re.search(r'Lopp\s*(\d+)', basename, re.IGNORECASE)
+             or re.search(r'V75[-_ ]?([1-7])(?!\d)', basename, re.IGNORECASE))
+    return int(match.group(1)) if match else None
+
 def determine_race_number(race_csv_path, df):
-    """Bestäm loppnummer från filnamn eller data"""
-    # Försök från filnamn
-    filename = os.path.basename(race_csv_path)
-    match = re.search(r'Lopp\s*(\d+)', filename, re.IGNORECASE)
-    if match:
-        return int(match.group(1))
+    """
+    Bestäm loppnummer från filnamn, annars från kolumnen race_number om alla
+    rader har samma nummer. Kastar RaceNumberError om inget av dem finns.
+    """
+    race_number = race_number_from_filename(race_csv_path)
+    if race_number is not None:
+        return race_number
     
-    # Fallback
-    return 1
+    if df is not None and 'race_number' in df.columns:
+        numbers = pd.to_numeric(df['race_number'], errors='coerce').dropna().unique()
+        if len(numbers) == 1 and numbers[0] % 1 == 0:
+            return int(numbers[0])
+    raise RaceNumberError(
+        f"Kunde inte bestämma loppnummer för {os.path.basename(race_csv_path)}: "
+        "filnamnet saknar \"Lopp N\" och loppdata saknar ett entydigt race_number"
+    )
+
+# Spårstatistik
+#
+# Banstatistikens JSON kompileras en gång till uppslagstabeller per bana,
+# startmetod och distansklass. Varje tabell är en array indexerad med
+# spårnummer, så uppslag för ett helt fält är en enda indexering.
+
+# Namn på startmetoder i banstatistik och loppdata
+START_METHOD_ALIASES = {
+    'autostart': 'auto',
+    'auto': 'auto',
+    'a': 'auto',
+    'voltstart': 'volt',
+    'volt': 'volt',
+    'v': 'volt',
+}
+
+# Bana och distansklass när loppet inte anger någon som finns i filen
+# (tidigare användes alltid Axevalla, autostart, hög). Distansklassen härleds
+# inte ur loppets distans utan måste anges i kolumnen distance_class.
+DEFAULT_TRACK = 'Axevalla'
+DEFAULT_DISTANCE_CLASS = 'hög'
+
+def normalize_start_method(value):
+    """Startmetod som 'auto' eller 'volt' (standard auto)"""
+    return START_METHOD_ALIASES.get(str(value).strip().lower(), 'auto')
 
-def analyze_distance_performance(horse):
+def _compile_position_stats(stats):
     """
-    Analysera hästens prestanda på olika distanser
+    Spårpoäng per spår för en lista med spårstatistik.
+    Första posten per spår gäller. En post med ogiltigt spår avslutar listan
+    och en ogiltig segerprocent ger neutralt värde.
     """
-    # Samla distanser från de tre senaste loppen
-    distances = [
-        horse.get('previous_race_1_distance', 0),
-        horse.get('previous_race_2_distance', 0),
-        horse.get('previous_race_3_distance', 0)
-    ]
-    
-    # Gruppera resultat per distans
-    distance_results = {
-        1640: [],  # Korta distansen
-        2140: [],  # Mellandistansen
-        2640: []   # Långa distansen
-    }
-    
-    # Placeringar för respektive distans
-    for i, distance in enumerate(distances, 1):
-        # Konvertera till integer och kolla mot närmaste standarddistans
-        try:
-            distance = int(distance)
-            placement = horse.get(f'previous_race_{i}_position', 0)
-            
-            # Robust hantering av placering
-            if pd.isna(placement):
+    table = {}
+    try:
+        for stat in stats:
+            position = int(stat['spår'])
+            if position in table:
                 continue
-            
-            # Konvertera placering till integer, hantera strängar
             try:
-                placement = int(str(placement).replace('d', '10'))
-            except (ValueError, TypeError):
-                continue
-            
-            if abs(distance - 1640) <= 100:
-                distance_results[1640].append(placement)
-            elif abs(distance - 2140) <= 100:
-                distance_results[2140].append(placement)
-            elif abs(distance - 2640) <= 100:
-                distance_results[2640].append(placement)
-        except (ValueError, TypeError):
-            continue
-    
-    # Beräkna poäng per distans
-    distance_scores = {}
-    for dist, placements in distance_results.items():
-        if placements:
-            # Poängsätt placeringar
-            points = []
-            for placement in placements:
-                if placement == 1:
-                    points.append(10)
-                elif placement == 2:
-                    points.append(8)
-                elif placement == 3:
-                    points.append(6)
-                elif 4 <= placement <= 5:
-                    points.append(4)
-                else:
-                    points.append(1)
-            
-            # Vägt genomsnitt med senaste loppet viktat tyngre
-            if not points:
-                distance_scores[dist] = 0
-            elif len(points) == 1:
-                distance_scores[dist] = points[0]
-            elif len(points) == 2:
-                distance_scores[dist] = (points[0] * 0.7 + points[1] * 0.3)
-            else:
-                distance_scores[dist] = (points[0] * 0.5 + points[1] * 0.3 + points[2] * 0.2)
-        else:
-            distance_scores[dist] = 0
+                seg_procent = float(stat['segerprocent']['värde'].rstrip('%'))
+                table[position] = min(10, max(1, seg_procent))
+            except Exception:
+                table[position] = 5.0
+    except Exception:
+        pass
     
-    return distance_scores
+    positions = [position for position in table if position >= 0]
+    scores = np.full(max(positions, default=0) + 1, np.nan)
+    for position in positions:
+        scores[position] = table[position]
+    return scores
 
-def calculate_form_score(horse):
+class TrackIndex:
     """
-    Beräkna formvärde baserat på de tre senaste loppen
+    Kompilerad spårstatistik för alla banor i en banstatistikfil.
+    Nyckel: (bana, startmetod, distansklass) -> spårpoäng indexerade med spår.
     """
-    # Samla placeringar
-    placements = [
-        horse.get('previous_race_1_position', 0),
-        horse.get('previous_race_2_position', 0),
-        horse.get('previous_race_3_position', 0)
-    ]
-    
-    # Rensa och hantera olika datatyper
-    clean_placements = []
-    for placement in placements:
+    def __init__(self, track_data):
+        self.tables = {}
+        self.track_names = {}   # Gemener -> namn i filen
+        self.classes = {}       # (bana, startmetod) -> distansklasser i filordning
+        
         try:
-            if pd.isna(placement):
+            tracks = track_data['spårstatistik'].items()
+        except (KeyError, TypeError, AttributeError):
+            tracks = []
+        
+        for track, methods in tracks:
+            if not isinstance(methods, dict):
                 continue
-            placement = int(placement)
-            if placement > 0:
-                clean_placements.append(placement)
-        except (ValueError, TypeError):
-            continue
+            track_key = str(track).strip().lower()
+            self.track_names.setdefault(track_key, track)
+            for method, distance_classes in methods.items():
+                if not isinstance(distance_classes, dict):
+                    continue
+                method_key = normalize_start_method(method)
+                for distance_class, stats in distance_classes.items():
+                    class_key = str(distance_class).strip().lower()
+                    key = (track_key, method_key, class_key)
+                    if key in self.tables:
+                        continue
+                    self.tables[key] = _compile_position_stats(stats)
+                    self.classes.setdefault((track_key, method_key), []).append(class_key)
+        
+        self.version = hashlib.sha1(
+            json.dumps(track_data, sort_keys=True, ensure_ascii=False, default=str).encode('utf-8')
+        ).hexdigest()
     
-    # Om inga placeringar
-    if not clean_placements:
-        return 5.0  # Neutralt värde
-    
-    # Poängsätt placeringar med viktning
-    points = []
-    weights = [0.5, 0.3, 0.2]  # Vikta senaste loppet tyngre
-    
-    for i, placement in enumerate(clean_placements[:3]):
-        weight = weights[i] if i < len(weights) else 0.2
-        
-        if placement == 1:
-            points.append(10 * weight)
-        elif placement == 2:
-            points.append(8 * weight)
-        elif placement == 3:
-            points.append(6 * weight)
-        elif placement <= 5:
-            points.append(4 * weight)
-        else:
-            points.append(1 * weight)
+    def tracks(self):
+        """Banor i filen"""
+        return list(self.track_names.values())
     
-    # Summera poäng
-    total_score = sum(points)
+    def resolve_track(self, track=None):
+        """Bana att använda: angiven bana om den finns, annars DEFAULT_TRACK, annars filens första bana"""
+        for candidate in (track, DEFAULT_TRACK):
+            if candidate is not None and str(candidate).strip().lower() in self.track_names:
+                return str(candidate).strip().lower()
+        return next(iter(self.track_names), None)
     
-    # Normalisera till 0-10 skala
-    return min(10, max(0, total_score * 2))
+    def table(self, track=None, start_method='auto', distance_class=None):
+        """Spårpoäng för en bana, startmetod och distansklass (None om statistik saknas)"""
+        track_key = self.resolve_track(track)
+        method_key = normalize_start_method(start_method)
+        classes = self.classes.get((track_key, method_key))
+        if not classes:
+            return None
+        
+        # Okänd eller saknad distansklass ger DEFAULT_DISTANCE_CLASS, annars filens första klass för metoden
+        class_key = str(distance_class).strip().lower() if distance_class is not None else None
+        if class_key not in classes:
+            class_key = DEFAULT_DISTANCE_CLASS if DEFAULT_DISTANCE_CLASS in classes else classes[0]
+        return self.tables[(track_key, method_key, class_key)]
+    
+    def scores(self, start_numbers, track=None, start_method='auto', distance_class=None):
+        """Spårpoäng för en array av startnummer, 5.0 där statistik saknas"""
+        start_numbers = np.asarray(start_numbers, dtype=float)
+        table = self.table(track, start_method, distance_class)
+        if table is None:
+            return np.full(len(start_numbers), 5.0)
+        
+        valid = (start_numbers >= 0) & (start_numbers < len(table)) & (start_numbers == np.floor(start_numbers))
+        positions = np.where(valid, start_numbers, 0).astype(int)
+        scores = np.where(valid, table[positions], np.nan)
+        return np.where(np.isnan(scores), 5.0, scores)
 
-def calculate_career_score(horse):
+def get_track_index(track_data):
+    """TrackIndex från rå banstatistik, eller None om statistik saknas"""
+    if isinstance(track_data, TrackIndex) or not track_data:
+        return track_data or None
+    return TrackIndex(track_data)
+
+def detect_track(horses_df, race_csv_path, track_index):
     """
-    Beräkna karriärvärde baserat på intjänade pengar och vinstprocent
+    Sätt kolumnen track från filnamnet om loppdata saknar bana
+    och en bana i banstatistiken nämns i filnamnet
     """
-    # Extrahera vinstprocent
-    def extract_win_percentage(career_results):
-        if pd.isna(career_results):
-            return 0
-        
-        try:
-            # Förväntat format: "X Y-Z" där X är totala starter, Y-Z är vinster-totalresultat
-            parts = str(career_results).split()
-            if len(parts) >= 2:
-                total_starts = int(parts[0])
-                wins_part = parts[1].split('-')[0]
-                wins = int(wins_part)
-                
-                if total_starts > 0:
-                    return (wins / total_starts) * 100
-        except:
-            pass
-        return 0
-    
-    # Beräkna vinstprocent
-    win_percentage = extract_win_percentage(horse.get('career_results', '0 0-0'))
-    
-    # Normalisera intjänade pengar
-    earnings = horse.get('earnings', 0)
-    
-    # Viktad poängsättning
-    win_score = min(10, win_percentage / 10)  # Normalisera till 0-10
-    earnings_score = min(10, (earnings / 1000000) * 10)  # Anta maxvärde 1 miljon
+    if track_index is None or 'track' in horses_df.columns:
+        return horses_df
     
-    # Kombinera poäng
-    return (win_score * 0.7 + earnings_score * 0.3)
+    filename = os.path.basename(race_csv_path).lower()
+    for track in track_index.tracks():
+        if str(track).lower() in filename:
+            horses_df['track'] = track
+            break
+    return horses_df
+
+def _race_context(horses_df, name, default=None):
+    """Första icke-tomma värdet i en valfri loppkolumn (t.ex. bana eller startmetod)"""
+    if name in horses_df.columns:
+        values = horses_df[name].dropna()
+        if len(values):
+            return values.iloc[0]
+    return default
+
+# Vektoriserad poängmotor
+#
+# Delpoängen beräknas kolumnvis med NumPy över hela fältet på en gång, med
+# samma regler som den tidigare radvisa beräkningen.
 
-def calculate_track_position_score(horse, track_data=None):
+# Standarddistanser och tolerans för distansgruppering
+DISTANCE_BUCKETS = (1640, 2140, 2640)
+DISTANCE_TOLERANCE = 100
+
+# Vikter för formvärdet (senaste loppet först)
+FORM_WEIGHTS = (0.5, 0.3, 0.2)
+
+# Vikter för distanspoäng beroende på antal lopp i gruppen
+DISTANCE_WEIGHTS = {
+    1: (1.0,),
+    2: (0.7, 0.3),
+    3: (0.5, 0.3, 0.2),
+}
+
+# Antal tidigare lopp i CSV-filerna
+PREVIOUS_RACES = 3
+
+# Äldre lopp från hästhistoriken (HISTORY_DEPTH > PREVIOUS_RACES) viktas med
+# avtagande vikter, varje lopp HISTORY_DECAY av det föregående, normerade till 1.
+# Vikterna väljs efter hur många giltiga lopp hästen har, inte antalet kolumner.
+HISTORY_DECAY = 0.6
+HISTORY_WEIGHTING = 'per-horse'
+
+PREVIOUS_RACE_PATTERN = re.compile(r'previous_race_(\d+)_(position|distance)$')
+
+# Poäng per placering: etta, tvåa, trea, fyra-femma, övriga
+PLACEMENT_POINTS = (10.0, 8.0, 6.0, 4.0, 1.0)
+
+# Vikter för total_score per delpoäng
+TOTAL_SCORE_WEIGHTS = {
+    'form_score': 0.3,
+    'career_score': 0.2,
+    'distance_1640_score': 0.1,
+    'distance_2140_score': 0.1,
+    'distance_2640_score': 0.1,
+    'track_position_score': 0.2,
+}
+
+def _column(horses_df, name, default=0):
+    """Hämta kolumn, eller en kolumn med standardvärde om den saknas"""
+    if name in horses_df.columns:
+        return horses_df[name]
+    return pd.Series(np.full(len(horses_df), default), index=horses_df.index)
+
+def _parse_unique(values, parser):
     """
-    Beräkna poäng baserat på startnummer
+    Tolka värden genom att bara anropa parser en gång per unikt värde.
+    Saknade värden blir NaN.
     """
-    # Standardvärde om ingen banstatistik finns
-    if not track_data:
-        return 5.0
-    
-    start_number = horse['start_number']
-    
-    # Hämta spårstatistik
+    codes, uniques = pd.factorize(values)
+    parsed = np.array([parser(value) for value in uniques] + [np.nan], dtype=float)
+    return parsed[codes]
+
+def _parse_distance(value):
+    """Distans som heltal, eller NaN om den inte går att tolka"""
     try:
-        autostart_stats = track_data['spårstatistik']['Axevalla']['autostart']['hög']
-        
-        # Hitta statistik för detta startnummer
-        for stat in autostart_stats:
-            if int(stat['spår']) == start_number:
-                # Konvertera segerprocent till poäng
-                seg_procent = float(stat['segerprocent']['värde'].rstrip('%'))
-                return min(10, max(1, seg_procent))
-    except:
-        pass
-    
-    # Fallback
-    return 5.0
+        return int(value)
+    except (ValueError, TypeError):
+        return np.nan
 
-def calculate_betting_percentages(horses_df, betting_data, race_number):
+def _parse_distance_placement(value):
+    """Placering för distansanalys, där 'd' (diskvalificerad) räknas som 10"""
+    try:
+        return int(str(value).replace('d', '10'))
+    except (ValueError, TypeError):
+        return np.nan
+
+def _parse_form_placement(value):
+    """Placering för formvärde, endast placeringar över 0 räknas"""
+    try:
+        placement = int(value)
+    except (ValueError, TypeError):
+        return np.nan
+    return placement if placement > 0 else np.nan
+
+# Förtolkade kolumner previous_race_N_<namn> från kolumnlagret, per källfält
+# och tolkning. Finns kolumnen används den i stället för att tolka om texten.
+PARSED_RACE_COLUMNS = {
+    ('distance', _parse_distance): 'distance_value',
+    ('position', _parse_distance_placement): 'distance_placement',
+    ('position', _parse_form_placement): 'form_placement',
+}
+
+def placement_points(placements):
+    """Poängsätt placeringar kolumnvis enligt poängtabellen (standard 10/8/6/4/1)"""
+    points = scoring_params.placement_points
+    return np.select(
+        [
+            placements == 1,
+            placements == 2,
+            placements == 3,
+            (placements >= 4) & (placements <= 5),
+        ],
+        points[:4],
+        default=points[4],
+    )
+
+def previous_race_count(horses_df):
+    """Antal tidigare lopp i fältet: minst PREVIOUS_RACES, fler om historiken lagts till"""
+    numbers = [int(match.group(1)) for match in map(PREVIOUS_RACE_PATTERN.match, horses_df.columns) if match]
+    return max([PREVIOUS_RACES] + numbers)
+
+def decay_weights(count):
+    """Vikter för count lopp, senaste först, avtagande med HISTORY_DECAY och summa 1"""
+    weights = HISTORY_DECAY ** np.arange(count)
+    return tuple((weights / weights.sum()).tolist())
+
+def form_weight_table(races):
     """
-    Beräkna och tilldela spelprocentar från JSON-data
+    Viktmatris för formvärdet indexerad med [antal giltiga placeringar, ordning].
+    Hästar med högst PREVIOUS_RACES giltiga placeringar får FORM_WEIGHTS, precis
+    som utan historik, och bara hästar med fler lopp avtagande vikter.
     """
-    # Extrahera spelprocent för specifikt lopp
-    race_key = f"V75-{race_number}"
-    
-    # Standardvärde om ingen data finns
-    default_percentage = 100 / len(horses_df)
-    
-    if betting_data and race_key in betting_data:
-        betting_percentages = {
-            int(horse['number']): horse['percentage'] 
-            for horse in betting_data[race_key]['horses']
-        }
-        
-        # Tilldela spelprocent
-        horses_df['betting_percentage'] = horses_df['start_number'].map(
-            betting_percentages
-        ).fillna(default_percentage)
-    else:
-        # Jämn fördelning om ingen data
-        horses_df['betting_percentage'] = default_percentage
-    
-    return horses_df
+    table = np.zeros((races + 1, races))
+    for count in range(1, races + 1):
+        weights = FORM_WEIGHTS if count <= PREVIOUS_RACES else decay_weights(count)
+        table[count, :len(weights)] = weights
+    return table
 
-def extract_json_safely(text, horses_data):
-    try:
-        # Rensa text och ta bort kodblock-markörer
-        text = text.strip().replace('```json', '').replace('```', '').strip()
-        
-        # Ta bort extra slutande måsvinge
-        text = text.replace('}]}', ']}')
-        
-        print("DEBUG: Rensat text:", text)
+def distance_weight_table(races):
+    """Viktmatris indexerad med [antal lopp i gruppen, ordning inom gruppen]"""
+    table = np.zeros((races + 1, races))
+    for count in range(1, races + 1):
+        weights = DISTANCE_WEIGHTS[count] if count <= PREVIOUS_RACES else decay_weights(count)
+        table[count, :len(weights)] = weights
+    return table
 
-        # Försök parsa JSON
-        parsed = json.loads(text)
-        
-        # Validera struktur
-        if (isinstance(parsed, dict) and 
-            'horses' in parsed and 
-            all('name' in h and 'start_number' in h and 'calculated_percentage' in h for h in parsed['horses'])):
-            
-            # Normalisera procentvärden
-            total_percentage = sum(h['calculated_percentage'] for h in parsed['horses'])
-            
-            if abs(total_percentage - 100) > 0.1:
-                for h in parsed['horses']:
-                    h['calculated_percentage'] *= 100 / total_percentage
-            
-            return parsed
+def _previous_race_matrix(horses_df, field, parser, races=None):
+    """Tolka previous_race_N_<field> till en matris (hästar x lopp)"""
+    races = races or previous_race_count(horses_df)
+    parsed = PARSED_RACE_COLUMNS.get((field, parser))
+    columns = []
+    for i in range(1, races + 1):
+        if parsed and f'previous_race_{i}_{parsed}' in horses_df.columns:
+            columns.append(horses_df[f'previous_race_{i}_{parsed}'].to_numpy(dtype=float))
+        else:
+            columns.append(_parse_unique(_column(horses_df, f'previous_race_{i}_{field}'), parser))
+    return np.column_stack(columns)
 
-    except json.JSONDecodeError as e:
-        print(f"JSON-tolkningsfel: {e}")
-        
-        # Fallback: skapa standardsvar
-        return {
-            "horses": [
-                {
-                    "name": horse['name'], 
-                    "start_number": horse['start_number'], 
-                    "calculated_percentage": 100/len(horses_data)
-                } 
-                for horse in horses_data
-            ],
-            "analysis_summary": "Kunde inte genomföra fullständig analys"
-        }
-    except Exception as e:
-        print(f"Oväntat fel vid JSON-extrahering: {e}")
-        
-        # Sista fallback
-        return {
-            "horses": [
-                {"name": horse['name'], "start_number": horse['start_number'], "calculated_percentage": 100/len(horses_data)} 
-                for horse in horses_data
-            ],
-            "analysis_summary": "Kunde inte genomföra fullständig analys"
-        }
+def compute_distance_scores(horses_df):
+    """
+    Distanspoäng för alla hästar, en kolumn per standarddistans
+    """
+    races = previous_race_count(horses_df)
+    distances = _previous_race_matrix(horses_df, 'distance', _parse_distance, races)
+    placements = _previous_race_matrix(horses_df, 'position', _parse_distance_placement, races)
+    valid = ~np.isnan(distances) & ~np.isnan(placements)
+    points = placement_points(placements)
+
+    # Gruppera varje lopp till närmaste standarddistans (första träff vinner)
+    bucket = np.full(distances.shape, -1)
+    for index in reversed(range(len(DISTANCE_BUCKETS))):
+        in_bucket = np.abs(distances - DISTANCE_BUCKETS[index]) <= scoring_params.distance_tolerance
+        bucket = np.where(in_bucket, index, bucket)
 
-def analyze_horse_with_ai(horses_df):
+    weight_table = distance_weight_table(races)
+
+    scores = np.zeros((len(horses_df), len(DISTANCE_BUCKETS)))
+    for index in range(len(DISTANCE_BUCKETS)):
+        member = valid & (bucket == index)
+        rank = np.cumsum(member, axis=1) - 1
+        count = member.sum(axis=1, keepdims=True)
+        weights = weight_table[count, np.clip(rank, 0, None)]
+        # Summera i loppordning så att resultatet blir identiskt med radvis beräkning
+        total = np.zeros(len(horses_df))
+        for race in range(races):
+            total = total + np.where(member[:, race], points[:, race] * weights[:, race], 0.0)
+        scores[:, index] = total
+
+    return scores
+
+def compute_form_scores(horses_df):
     """
-    AI analyserar och rankar hästar baserat på förberedda data
+    Formvärde för alla hästar baserat på de tre senaste loppen (eller fler
+    från hästhistoriken)
     """
-    try:
-        # Förbered data för AI
-        horses_data = []
-        for _, horse in horses_df.iterrows():
-            horse_info = {
-                "name": horse['name'],
-                "start_number": horse['start_number'],
-                "form_score": round(horse['form_score'], 2),
-                "career_earnings": horse['earnings'],
-                "distance_1640_score": round(horse['distance_1640_score'], 2),
-                "distance_2140_score": round(horse['distance_2140_score'], 2),
-                "distance_2640_score": round(horse['distance_2640_score'], 2),
-                "track_position_score": round(horse['track_position_score'], 2),
-                "betting_percentage": round(horse['betting_percentage'], 2)
-            }
-            horses_data.append(horse_info)
-        
-        # Skapa prompt för AI
-        prompt = f"""Analysera och fördela EXAKT 100% mellan {len(horses_data)} hästar.
-
-KRITISKA KRAV:
-- Fullständig, giltig JSON
-- Exakt {len(horses_data)} hästar
-- Varje häst MÅSTE ha:
-  * Namn
-  * Startnummer
-  * Procentsats
-- Procentsatser MÅSTE summera till 100% exakt
-- INGEN ofullständig data
-- INGEN extra text utanför JSON
-
-STRIKT FORMAT:
-{{
-    "horses": [
-        {{
-            "name": "Hästnamn",
-            "start_number": nummer,
-            "calculated_percentage": procent (0-100)
-        }}
-    ],
-    "analysis_summary": "Mycket kort analys"
-}}
+    races = previous_race_count(horses_df)
+    placements = _previous_race_matrix(horses_df, 'position', _parse_form_placement, races)
+    valid = ~np.isnan(placements)
+    points = placement_points(placements)
 
-Hästdata:
-{json.dumps(horses_data, indent=2)}"""
-        
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo", 
-            messages=[
-                {"role": "system", "content": "Du MÅSTE returnera perfekt JSON för travhästanalys"},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=800
-        )
-        
-        # Hämta det fullständiga svaret
-        full_response = response.choices[0].message.content.strip()
-        
-        # Skapa debug-katalog om den inte finns
-        debug_dir = os.path.expanduser('~/Desktop/travanalys_debug')
-        os.makedirs(debug_dir, exist_ok=True)
-        
-        # Skapa filnamn med tidsstämpel
-        timestamp = datetime.now().strftime("%Y%m%d_%H%M%S")
-        debug_file = os.path.join(debug_dir, f'ai_debug_{timestamp}.txt')
-        
-        # Skriv all debug-information till samma fil
-        try:
-            with open(debug_file, 'w', encoding='utf-8') as f:
-                # Skriv hästdata
-                f.write("HÄSTDATA:\n")
-                f.write(json.dumps(horses_data, indent=2) + "\n\n")
-                
-                # Skriv prompt
-                f.write("PROMPT:\n")
-                f.write(prompt + "\n\n")
-                
-                # Skriv fullständigt AI-svar
-                f.write("FULLSTÄNDIGT AI-SVAR:\n")
-                f.write(full_response + "\n\n")
-            
-            print(f"Debug-information sparad i: {debug_file}")
-        
-        except Exception as e:
-            print(f"Kunde inte spara debug-fil: {e}")
-        
-        # Använd robust JSON-extrahering
-        parsed_response = extract_json_safely(full_response, horses_data)
-        
-        return parsed_response
+    # Vikten bestäms av antalet giltiga placeringar och ordningen bland dem
+    rank = np.clip(np.cumsum(valid, axis=1) - 1, 0, None)
+    count = valid.sum(axis=1, keepdims=True)
+    weights = form_weight_table(races)[count, rank]
+
+    total = np.zeros(len(horses_df))
+    for race in range(races):
+        total = total + np.where(valid[:, race], points[:, race] * weights[:, race], 0.0)
+
+    scores = np.clip(total * 2, 0, 10)
+    return np.where(valid.any(axis=1), scores, 5.0)  # Neutralt värde
+
+def career_starts_and_wins(horses_df):
+    """Antal starter och vinster ur career_results, NaN om de inte går att tolka"""
+    if 'career_starts' in horses_df.columns and 'career_wins' in horses_df.columns:
+        # Redan tolkade i kolumnlagret
+        return horses_df['career_starts'].to_numpy(dtype=float), horses_df['career_wins'].to_numpy(dtype=float)
     
-    except Exception as e:
-        print(f"Fel vid AI-analys: {e}")
-        
-        # Skapa fallback-svar
-        return {
-            "horses": [
-                {
-                    "name": horse['name'], 
-                    "start_number": horse['start_number'], 
-                    "calculated_percentage": 100/len(horses_df)
-                } 
-                for _, horse in horses_df.iterrows()
-            ],
-            "analysis_summary": "Kunde inte genomföra fullständig analys"
-        }
+    # Förväntat format: "X Y-Z" där X är totala starter och Y vinster
+    career_results = _column(horses_df, 'career_results', '0 0-0').astype(str)
+    parts = career_results.str.extract(r'^\s*([+-]?[0-9]+)\s+\+?([0-9]+)(?:-\S*)?(?:\s|$)')
+    return parts[0].astype(float).to_numpy(), parts[1].astype(float).to_numpy()
 
-def compare_ai_ranking_with_betting_percentages(ai_ranking, horses_df):
+def compute_career_scores(horses_df):
     """
-    Jämför AI:ns ranking med faktiska spelade procenten
+    Karriärvärde för alla hästar baserat på vinstprocent och intjänade pengar
     """
-    print("\n=== JÄMFÖRELSE: AI-RANKING MOT SPELAD PROCENT ===")
-    
-    # Skapa dictionary för enkel sökning
-    betting_percentages = {
-        horse['start_number']: horse['betting_percentage'] 
-        for _, horse in horses_df.iterrows()
+    total_starts, wins = career_starts_and_wins(horses_df)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        win_percentage = np.where(total_starts > 0, (wins / total_starts) * 100, 0.0)
+
+    earnings = _column(horses_df, 'earnings').to_numpy(dtype=float)
+    earnings_score = (earnings / 1000000) * 10  # Anta maxvärde 1 miljon
+
+    win_score = np.minimum(10, win_percentage / 10)
+    # Saknade intjänade pengar ger maxpoäng, precis som min() i den tidigare radvisa beräkningen
+    earnings_score = np.where(np.isnan(earnings_score), 10, np.minimum(10, earnings_score))
+
+    return win_score * 0.7 + earnings_score * 0.3
+
+def race_context(horses_df):
+    """Loppets bana, startmetod och distansklass från valfria kolumner"""
+    return {
+        'track': _race_context(horses_df, 'track'),
+        'start_method': _race_context(horses_df, 'start_method', 'auto'),
+        'distance_class': _race_context(horses_df, 'distance_class'),
     }
-    
-    # Sortera hästar efter AI:ns ranking
-    sorted_horses = sorted(
-        ai_ranking['horses'], 
+
+def compute_track_position_scores(horses_df, track_data=None, context=None):
+    """
+    Spårpoäng för alla hästar baserat på startnummer.
+    track_data kan vara rå banstatistik eller ett TrackIndex. Bana, startmetod
+    och distansklass tas från context, annars från kolumnerna track,
+    start_method och distance_class om de finns.
+    """
+    # Standardvärde om ingen banstatistik finns
+    track_index = get_track_index(track_data)
+    if track_index is None:
+        return np.full(len(horses_df), 5.0)
+
+    start_numbers = pd.to_numeric(horses_df['start_number'], errors='coerce').to_numpy(dtype=float)
+    return track_index.scores(start_numbers, **(context or race_context(horses_df)))
+
+# Poängkolumner i den ordning score_horses returnerar dem
+FEATURE_COLUMNS = (
+    'distance_1640_score', 'distance_2140_score', 'distance_2640_score',
+    'form_score', 'career_score', 'track_position_score',
+)
+
+@metrics.timed('score_horses')
+def score_horses(horses_df, track_data=None, context=None):
+    """
+    Beräkna alla delpoäng för ett fält i ett svep.
+    Returnerar en dict med en NumPy-array per poängkolumn.
+    """
+    distance_scores = compute_distance_scores(horses_df)
+    return {
+        'distance_1640_score': distance_scores[:, 0],
+        'distance_2140_score': distance_scores[:, 1],
+        'distance_2640_score': distance_scores[:, 2],
+        'form_score': compute_form_scores(horses_df),
+        'career_score': compute_career_scores(horses_df),
+        'track_position_score': compute_track_position_scores(horses_df, track_data, context),
+    }
+
+# Cache för delpoäng
+#
+# Delpoängen beror bara på hästens rad i CSV-filen, loppets bana/startmetod/
+# distansklass, banstatistiken och poängreglerna. Varje rad får ett
+# fingeravtryck (hash av indatakolumnerna) och poängvektorn sparas per
+# namnrymd, där namnrymden är en hash av allt som gäller hela loppet. Bara
+# rader som inte setts förut poängsätts. Namnrymderna sparas som .npz-filer
+# och rensas på ålder, antal poster och total storlek.
+
+FEATURE_CACHE_DIR = os.path.join('.cache', 'features')
+FEATURE_CACHE_MAX_ENTRIES = 200000            # Poster per namnrymd
+FEATURE_CACHE_MAX_BYTES = 100 * 1024 * 1024
+FEATURE_CACHE_MAX_AGE = 30 * 24 * 3600        # Sekunder sedan senaste användning
+
+# Kolumner som delpoängen räknas från (utöver loppets kontext)
+FEATURE_INPUT_COLUMNS = ('start_number', 'career_results', 'earnings') + tuple(
+    f'previous_race_{i}_{field}'
+    for i in range(1, PREVIOUS_RACES + 1)
+    for field in ('distance', 'position')
+)
+
+def feature_input_columns(horses_df):
+    """Indatakolumner som finns i fältet, inklusive tillagd historik"""
+    columns = [c for c in FEATURE_INPUT_COLUMNS if c in horses_df.columns]
+    return columns + [
+        f'previous_race_{i}_{field}'
+        for i in range(PREVIOUS_RACES + 1, previous_race_count(horses_df) + 1)
+        for field in ('distance', 'position')
+        if f'previous_race_{i}_{field}' in horses_df.columns
+    ]
+
+def scoring_version():
+    """Hash av poängreglerna, byts när vikter eller gränser ändras"""
+    payload = repr((DISTANCE_BUCKETS, scoring_params.distance_tolerance, FORM_WEIGHTS, DISTANCE_WEIGHTS,
+                    PREVIOUS_RACES, HISTORY_DECAY, HISTORY_WEIGHTING, DEFAULT_TRACK, DEFAULT_DISTANCE_CLASS,
+                    tuple(scoring_params.placement_points)))
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def feature_namespace(horses_df, track_index, context):
+    """Hash av det som är gemensamt för alla rader i loppet"""
+    dtypes = horses_df.dtypes
+    payload = json.dumps({
+        'scoring': scoring_version(),
+        'track_data': track_index.version if track_index is not None else None,
+        'context': context,
+        'columns': [[c, str(dtypes[c])] for c in feature_input_columns(horses_df)],
+    }, sort_keys=True, default=str)
+    return hashlib.sha1(payload.encode('utf-8')).hexdigest()
+
+def row_fingerprints(horses_df):
+    """
+    64-bitars hash per häst av indatakolumnerna. Bygger på repr av
+    Python-värdena, så 1, 1.0 och '1' ger olika fingeravtryck.
+    """
+    columns = [horses_df[c].tolist() for c in feature_input_columns(horses_df)]
+    return [
+        int.from_bytes(hashlib.blake2b(repr(row).encode('utf-8'), digest_size=8).digest(), 'little')
+        for row in zip(*columns)
+    ] if columns else [0] * len(horses_df)
+
+class FeatureCache:
+    """
+    Delpoäng per häst, i minnet och på disk.
+    Arbetsprocesser lämnar nya och använda poster till huvudprocessen med
+    export_pending(), som tar emot dem med merge_pending() och skriver till
+    disk med save(). Kan delas av flera trådar.
+    """
+    def __init__(self, directory=FEATURE_CACHE_DIR, max_entries=FEATURE_CACHE_MAX_ENTRIES,
+                 max_bytes=FEATURE_CACHE_MAX_BYTES, max_age=FEATURE_CACHE_MAX_AGE, enabled=True):
+        self.directory = directory
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.enabled = enabled
+        self.tables = {}   # namnrymd -> {fingeravtryck: (senast använd, poängvektor)}
+        self.pending = {}  # Poster (samma format) som lagts till eller använts sedan förra sparningen
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.RLock()
+    
+    def _path(self, namespace):
+        return os.path.join(self.directory, f'{namespace}.npz')
+    
+    def _read(self, namespace):
+        """Poster för en namnrymd från disk, tom dict om filen saknas"""
+        try:
+            with np.load(self._path(namespace)) as data:
+                keys, values, used = data['keys'], data['values'], data['used']
+        except (OSError, ValueError, KeyError):
+            return {}
+        fresh = used >= time.time() - self.max_age
+        return {
+            key: (last_used, vector)
+            for key, last_used, vector in zip(keys[fresh].tolist(), used[fresh].tolist(), values[fresh])
+        }
+    
+    def _table(self, namespace):
+        if namespace not in self.tables:
+            self.tables[namespace] = self._read(namespace)
+        return self.tables[namespace]
+    
+    def scores(self, horses_df, track_data=None):
+        """Som score_horses, men återanvänder poäng för rader som setts förut"""
+        track_index = get_track_index(track_data)
+        context = race_context(horses_df)
+        if not self.enabled or len(horses_df) == 0:
+            return score_horses(horses_df, track_index, context)
+        
+        namespace = feature_namespace(horses_df, track_index, context)
+        keys = row_fingerprints(horses_df)
+        vectors = np.empty((len(keys), len(FEATURE_COLUMNS)))
+        now = time.time()
+        missing = []
+        with self.lock:
+            table = self._table(namespace)
+            pending = self.pending.setdefault(namespace, {})
+            for row, key in enumerate(keys):
+                entry = table.get(key)
+                if entry is None:
+                    missing.append(row)
+                else:
+                    vectors[row] = entry[1]
+                    table[key] = pending[key] = (now, entry[1])
+        
+        if missing:
+            computed = score_horses(horses_df.iloc[missing], track_index, context)
+            vectors[missing] = np.column_stack([computed[column] for column in FEATURE_COLUMNS])
+            with self.lock:
+                table = self._table(namespace)
+                pending = self.pending.setdefault(namespace, {})
+                for row in missing:
+                    table[keys[row]] = pending[keys[row]] = (now, vectors[row].copy())
+        
+        self.hits += len(keys) - len(missing)
+        self.misses += len(missing)
+        metrics.increment('feature_cache_hits', len(keys) - len(missing))
+        metrics.increment('feature_cache_misses', len(missing))
+        return {column: vectors[:, index] for index, column in enumerate(FEATURE_COLUMNS)}
+    
+    def export_pending(self):
+        """Poster som lagts till eller använts sedan förra exporten (för arbetsprocesser)"""
+        with self.lock:
+            pending, self.pending = self.pending, {}
+        return pending
+    
+    def merge_pending(self, pending):
+        """Ta emot poster från en arbetsprocess"""
+        with self.lock:
+            for namespace, entries in pending.items():
+                self._table(namespace).update(entries)
+                self.pending.setdefault(namespace, {}).update(entries)
+    
+    def save(self):
+        """Skriv namnrymder som använts till disk och rensa gamla filer"""
+        if not self.enabled or not self.pending:
+            return
+        try:
+            os.makedirs(self.directory, exist_ok=True)
+        except OSError as e:
+            print(f"Kunde inte spara delpoäng i cache: {e}")
+            return
+        
+        with self.lock:
+            for namespace in list(self.pending):
+                # Andra processer kan ha skrivit filen sedan den lästes
+                entries = self._read(namespace)
+                entries.update(self.tables[namespace])
+                if len(entries) > self.max_entries:
+                    recent = sorted(entries.items(), key=lambda item: item[1][0])[-self.max_entries:]
+                    entries = dict(recent)
+                self.tables[namespace] = entries
+                
+                keys = np.fromiter(entries.keys(), dtype=np.uint64, count=len(entries))
+                used = np.array([last_used for last_used, _ in entries.values()])
+                values = np.array([vector for _, vector in entries.values()]).reshape(-1, len(FEATURE_COLUMNS))
+                try:
+                    fd, tmp_path = tempfile.mkstemp(dir=self.directory, suffix='.tmp')
+                    with os.fdopen(fd, 'wb') as f:
+                        np.savez(f, keys=keys, values=values, used=used)
+                    os.replace(tmp_path, self._path(namespace))
+                except OSError as e:
+                    print(f"Kunde inte spara delpoäng i cache: {e}")
+            self.pending = {}
+        self.evict()
+    
+    def _files(self):
+        """Alla namnrymdsfiler som (senast ändrad, storlek, sökväg)"""
+        files = []
+        try:
+            filenames = os.listdir(self.directory)
+        except OSError:
+            return files
+        for filename in filenames:
+            if filename.endswith('.npz'):
+                path = os.path.join(self.directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                files.append((stat.st_mtime, stat.st_size, path))
+        return files
+    
+    def evict(self):
+        """Ta bort namnrymder som är för gamla, därefter de minst nyligen sparade"""
+        files = sorted(self._files())
+        total_bytes = sum(size for _, size, _ in files)
+        oldest_allowed = time.time() - self.max_age
+        for modified, size, path in files:
+            if modified >= oldest_allowed and total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+            total_bytes -= size
+    
+    def clear(self):
+        """Töm cachen i minnet och på disk"""
+        with self.lock:
+            self.tables, self.pending = {}, {}
+        for _, _, path in self._files():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+
+# Delad cache för alla lopp
+feature_cache = FeatureCache()
+
+# Hästhistorik
+#
+# CSV-filerna har bara hästens tre senaste lopp. Historiken sparas därför i en
+# lokal SQLite-databas som byggs upp av varje inläst omgång: de tre senaste
+# loppen ur CSV-filen och, med resultatfil, själva loppet. Loppen saknar datum
+# i CSV-filerna, så varje start nycklas på häst och startens nummer i
+# karriären (antal starter ur career_results). Samma start från olika
+# omgångar blir då samma rad, och datum sparas när loppet självt lästs in.
+# Med HISTORY_DEPTH över tre hämtas äldre lopp med en fråga per lopp och
+# läggs till som previous_race_4.. så att poängmotorn och delpoängscachen
+# hanterar dem som vanliga kolumner.
+
+HISTORY_DB_PATH = 'historik.sqlite'
+HISTORY_DEPTH = 10                     # Antal tidigare lopp med historik påslagen
+
+HISTORY_SCHEMA = """
+CREATE TABLE IF NOT EXISTS races (
+    card TEXT NOT NULL,
+    race_number INTEGER NOT NULL,
+    date TEXT,
+    winner INTEGER,
+    PRIMARY KEY (card, race_number)
+);
+CREATE TABLE IF NOT EXISTS starts (
+    horse TEXT NOT NULL,
+    start_index INTEGER NOT NULL,
+    position TEXT,
+    distance INTEGER,
+    date TEXT,
+    card TEXT,
+    race_number INTEGER,
+    PRIMARY KEY (horse, start_index)
+) WITHOUT ROWID;
+CREATE INDEX IF NOT EXISTS starts_by_date ON starts (horse, date);
+CREATE INDEX IF NOT EXISTS starts_by_race ON starts (card, race_number);
+"""
+
+# Nyare uppgifter ersätter äldre, men en saknad uppgift raderar aldrig en känd
+HISTORY_UPSERT = """
+INSERT INTO starts (horse, start_index, position, distance, date, card, race_number)
+VALUES (?, ?, ?, ?, ?, ?, ?)
+ON CONFLICT (horse, start_index) DO UPDATE SET
+    position = COALESCE(excluded.position, position),
+    distance = COALESCE(excluded.distance, distance),
+    date = COALESCE(excluded.date, date),
+    card = COALESCE(excluded.card, card),
+    race_number = COALESCE(excluded.race_number, race_number)
+"""
+
+CARD_DATE_PATTERN = re.compile(r'(\d{4})-?(\d{2})-?(\d{2})(?!\d)')
+
+def card_date(card):
+    """Datum (ÅÅÅÅ-MM-DD) ur omgångens namn, eller None"""
+    match = CARD_DATE_PATTERN.search(str(card))
+    return '-'.join(match.groups()) if match else None
+
+def _history_value(value):
+    """Cellvärde som text för databasen, None om det saknas"""
+    if value is None or (isinstance(value, float) and np.isnan(value)):
+        return None
+    text = str(value).strip()
+    return text or None
+
+class HistoryStore:
+    """
+    Hästhistorik i SQLite. Avstängd tills path satts. Varje tråd får en egen
+    anslutning, så flera trådar och processer kan läsa samtidigt.
+    """
+    def __init__(self, path=None, depth=HISTORY_DEPTH):
+        self.path = path
+        self.depth = depth
+        self.local = threading.local()
+    
+    @property
+    def enabled(self):
+        return bool(self.path) and self.depth > PREVIOUS_RACES and os.path.exists(self.path)
+    
+    def connect(self):
+        """Trådens anslutning, skapar tabellerna vid behov"""
+        # En ärvd anslutning från föräldern får inte användas efter fork
+        owner = (self.path, os.getpid())
+        connection = getattr(self.local, 'connection', None)
+        if connection is None or self.local.owner != owner:
+            connection = sqlite3.connect(self.path, timeout=30)
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.executescript(HISTORY_SCHEMA)
+            self.local.connection, self.local.owner = connection, owner
+        return connection
+    
+    def close(self):
+        connection = getattr(self.local, 'connection', None)
+        if connection is not None:
+            connection.close()
+            self.local.connection = None
+    
+    @staticmethod
+    def race_rows(horses_df, card, race_number, date=None, winner=None):
+        """Rader till starts för ett lopp: de tidigare loppen och loppet självt"""
+        total_starts, _ = career_starts_and_wins(horses_df)
+        names = _column(horses_df, 'name', None).tolist()
+        start_numbers = pd.to_numeric(_column(horses_df, 'start_number', None), errors='coerce').tolist()
+        previous = [
+            (index,
+             _column(horses_df, f'previous_race_{index}_position', None).tolist(),
+             pd.to_numeric(_column(horses_df, f'previous_race_{index}_distance', None), errors='coerce').tolist())
+            for index in range(1, previous_race_count(horses_df) + 1)
+        ]
+        rows = []
+        for i, (name, starts) in enumerate(zip(names, total_starts)):
+            if _history_value(name) is None or np.isnan(starts) or starts < 0:
+                continue
+            starts = int(starts)
+            for index, positions, distances in previous:
+                if starts - index + 1 < 1:
+                    break
+                distance = distances[i]
+                rows.append((name, starts - index + 1, _history_value(positions[i]),
+                             None if np.isnan(distance) else int(distance), None, None, None))
+            # Själva loppet, med placering om vinnaren är känd
+            position = None
+            if winner is not None and start_numbers[i] == winner:
+                position = '1'
+            rows.append((name, starts + 1, position, None, date, card, race_number))
+        return rows
+    
+    @metrics.timed('history_ingest')
+    def ingest_card(self, card):
+        """Läs in alla lopp i en omgång (från iter_race_cards). Returnerar antal starter."""
+        winners = load_race_results(card['resultat']) if card.get('resultat') else {}
+        date = card_date(card['card'])
+        connection = self.connect()
+        count = 0
+        with connection:
+            for race_csv_path in card['races']:
+                horses_df = read_race_csv(race_csv_path)
+                race_number = determine_race_number(race_csv_path, horses_df)
+                winner = winners.get(race_number)
+                rows = self.race_rows(horses_df, card['card'], race_number, date, winner)
+                connection.executemany(HISTORY_UPSERT, rows)
+                connection.execute(
+                    'INSERT OR REPLACE INTO races (card, race_number, date, winner) VALUES (?, ?, ?, ?)',
+                    (card['card'], race_number, date, winner)
+                )
+                count += len(rows)
+        return count
+    
+    def history(self, names, latest, count):
+        """
+        Upp till count starter per häst med startnummer i karriären högst
+        latest, senaste först. En fråga för hela fältet.
+        Returnerar {häst: [(placering, distans), ...]}.
+        """
+        field = list({name: int(limit) for name, limit in zip(names, latest)}.items())
+        if not field or count <= 0:
+            return {}
+        query = f"""
+            WITH field (horse, latest) AS (VALUES {', '.join(['(?, ?)'] * len(field))})
+            SELECT horse, position, distance FROM (
+                SELECT s.horse, s.position, s.distance,
+                       ROW_NUMBER() OVER (PARTITION BY s.horse ORDER BY s.start_index DESC) AS ago
+                FROM field f JOIN starts s ON s.horse = f.horse AND s.start_index <= f.latest
+            )
+            WHERE ago <= ?
+            ORDER BY horse, ago
+        """
+        result = {}
+        rows = self.connect().execute(query, [value for pair in field for value in pair] + [count])
+        for horse, position, distance in rows:
+            result.setdefault(horse, []).append((position, distance))
+        return result
+    
+    @metrics.timed('history_lookup')
+    def extend(self, horses_df):
+        """
+        Lägg till previous_race_4.. ur historiken. Returnerar en ny DataFrame,
+        eller horses_df oförändrad om historiken är avstängd.
+        """
+        if not self.enabled or 'name' not in horses_df.columns:
+            return horses_df
+        extra = self.depth - PREVIOUS_RACES
+        total_starts, _ = career_starts_and_wins(horses_df)
+        # Starter äldre än CSV-filens egna tidigare lopp
+        latest = total_starts - PREVIOUS_RACES
+        names = horses_df['name'].tolist()
+        known = [i for i, limit in enumerate(latest) if limit >= 1 and _history_value(names[i]) is not None]
+        
+        history = self.history([names[i] for i in known], latest[known], extra)
+        positions = np.full((len(horses_df), extra), None, dtype=object)
+        distances = np.full((len(horses_df), extra), np.nan)
+        for i in known:
+            for ago, (position, distance) in enumerate(history.get(names[i], [])):
+                positions[i, ago] = position
+                distances[i, ago] = np.nan if distance is None else distance
+        
+        columns = {}
+        for ago in range(extra):
+            index = PREVIOUS_RACES + ago + 1
+            columns[f'previous_race_{index}_position'] = positions[:, ago]
+            columns[f'previous_race_{index}_distance'] = distances[:, ago]
+        # Förtolkade kolumner för samma lopp gäller inte längre
+        stale = [f'previous_race_{PREVIOUS_RACES + ago + 1}_{parsed}'
+                 for ago in range(extra) for parsed in PARSED_RACE_COLUMNS.values()]
+        replaced = [column for column in list(columns) + stale if column in horses_df.columns]
+        if replaced:
+            horses_df = horses_df.drop(columns=replaced)
+        return pd.concat([horses_df, pd.DataFrame(columns, index=horses_df.index)], axis=1)
+
+def run_history_ingest(directory, path=HISTORY_DB_PATH):
+    """Läs in alla omgångar under en katalog i hästhistoriken"""
+    store = HistoryStore(path)
+    start = time.perf_counter()
+    cards = starts = 0
+    for card in iter_race_cards(directory):
+        starts += store.ingest_card(card)
+        cards += 1
+    connection = store.connect()
+    horses = connection.execute('SELECT COUNT(DISTINCT horse) FROM starts').fetchone()[0]
+    total = connection.execute('SELECT COUNT(*) FROM starts').fetchone()[0]
+    connection.execute('ANALYZE')
+    store.close()
+    print(f"Läste in {cards} omgångar ({starts} starter) på {time.perf_counter() - start:.2f}s")
+    print(f"Historik i {path}: {total} starter för {horses} hästar")
+    return total
+
+# Delad hästhistorik, påslagen med --history-db
+history_store = HistoryStore()
+
+# Kolumnlager
+#
+# `spelvarde.py ingest` läser alla CSV-filer i en katalog en gång och sparar
+# varje kolumn som en typad .npy-fil med katalogens lopp efter varandra.
+# Fält som annars tolkas om vid varje poängsättning sparas färdiga: starter,
+# vinster och placeringar ur career_results samt distans, placeringar och
+# diskvalifikation för varje tidigare lopp. load_horse_data minnesmappar
+# kolumnerna och bygger loppets DataFrame av vyer, så numeriska kolumner
+# läses utan kopiering. Varje fils egna kolumntyper sparas, så DataFrame blir
+# densamma som från pd.read_csv. Lagret används bara för filer vars mtime och
+# storlek är oförändrade sedan inläsningen, annars läses CSV-filen.
+
+COLUMNAR_DIR = os.path.join('.cache', 'columnar')
+COLUMNAR_VERSION = 1
+
+# Segrar-andra-tredje ur career_results, t.ex. "48 12-2-10"
+CAREER_PLACEMENTS_PATTERN = r'^\s*[+-]?[0-9]+\s+\+?[0-9]+-([0-9]+)-([0-9]+)'
+
+def columnar_path(source, directory=COLUMNAR_DIR):
+    """Lagrets katalog för en katalog med CSV-filer"""
+    key = hashlib.sha1(os.path.abspath(source).encode('utf-8')).hexdigest()[:16]
+    return os.path.join(directory, key)
+
+def parsed_race_fields(horses_df):
+    """Förtolkade fält för ett lopp, samma tolkning som poängmotorn gör"""
+    starts, wins = career_starts_and_wins(horses_df)
+    placements = _column(horses_df, 'career_results', '').astype(str).str.extract(CAREER_PLACEMENTS_PATTERN)
+    fields = {
+        'career_starts': starts.astype(np.float32),
+        'career_wins': wins.astype(np.float32),
+        'career_seconds': placements[0].astype(float).to_numpy(dtype=np.float32),
+        'career_thirds': placements[1].astype(float).to_numpy(dtype=np.float32),
+    }
+    for i in range(1, previous_race_count(horses_df) + 1):
+        for (field, parser), parsed in PARSED_RACE_COLUMNS.items():
+            values = _parse_unique(_column(horses_df, f'previous_race_{i}_{field}'), parser)
+            fields[f'previous_race_{i}_{parsed}'] = values.astype(np.float32)
+        positions = _column(horses_df, f'previous_race_{i}_position', '').astype(str)
+        fields[f'previous_race_{i}_disqualified'] = positions.str.contains('d', regex=False).to_numpy(dtype=bool)
+    return fields
+
+def _stored_column(parts, length):
+    """
+    En kolumn för alla lopp ur [(start, värden)]. Numeriska kolumner sparas
+    med gemensam typ (float64 om loppen skiljer sig), övriga som text där
+    tom sträng är ett saknat värde.
+    """
+    dtypes = {values.dtype for _, values in parts}
+    if all(dtype.kind in 'biuf' for dtype in dtypes):
+        array = np.zeros(length, dtype=dtypes.pop() if len(dtypes) == 1 else float)
+        for start, values in parts:
+            array[start:start + len(values)] = values
+        return array
+    
+    text = [''] * length
+    for start, values in parts:
+        text[start:start + len(values)] = ['' if pd.isna(value) else str(value) for value in values]
+    return np.array(text, dtype=str)
+
+def _typed_column(values, dtype):
+    """En lagrad kolumn som en given pandas-typ, samma array när typen redan stämmer"""
+    if values.dtype.kind != 'U':
+        return values if str(values.dtype) == dtype else values.astype(dtype)
+    if dtype == 'bool':
+        return values == 'True'
+    missing = values == ''
+    if dtype in ('str', 'string', 'object'):
+        text = values.astype(object)
+        text[missing] = np.nan
+        return pd.array(text, dtype=dtype)
+    return np.where(missing, 'nan', values).astype(dtype)
+
+class ColumnarStore:
+    """
+    Minnesmappade kolumnlager per katalog med CSV-filer. Varje process
+    öppnar sina egna mappningar vid första användningen.
+    """
+    def __init__(self, directory=COLUMNAR_DIR):
+        self.directory = directory
+        self.enabled = True
+        self.lock = threading.Lock()
+        self.stores = {}    # Källkatalog -> (manifestets signatur, manifest, kolumner, typade kolumner)
+    
+    def _open(self, source):
+        """Öppna lagret för en katalog, None om det saknas eller har annan version"""
+        path = columnar_path(source, self.directory)
+        manifest_path = os.path.join(path, 'manifest.json')
+        signature = file_signature(manifest_path)
+        cached = self.stores.get(source)
+        if cached is not None and cached[0] == signature:
+            return cached
+        try:
+            with open(manifest_path, 'r', encoding='utf-8') as f:
+                manifest = json.load(f)
+            if manifest.get('version') != COLUMNAR_VERSION:
+                raise ValueError(f"Version {manifest.get('version')} av kolumnlagret stöds inte")
+            # Vanliga ndarray-vyer av mappningen, pandas behandlar np.memmap som en egen klass
+            columns = {
+                name: np.asarray(np.load(os.path.join(path, filename), mmap_mode='r'))
+                for name, filename in manifest['columns'].items()
+            }
+        except (OSError, ValueError) as e:
+            if signature is not None:
+                metrics.record_error('columnar', e)
+            manifest, columns = None, None
+        self.stores[source] = (signature, manifest, columns, {})
+        return self.stores[source]
+    
+    @staticmethod
+    def _race_column(entry, name, dtype, start, stop):
+        """
+        Ett lopps del av en kolumn med loppets typ. Textkolumner görs om till
+        pandas text en gång per kolumn, så varje lopp får en vy i stället för
+        en egen konvertering. Övriga typbyten görs bara för loppet, eftersom
+        andra lopp kan ha annat innehåll i samma kolumn.
+        """
+        _, _, columns, typed = entry
+        values = columns[name]
+        if values.dtype.kind == 'U' and dtype in ('str', 'string', 'object'):
+            if (name, dtype) not in typed:
+                typed[name, dtype] = _typed_column(values, dtype)
+            return typed[name, dtype][start:stop]
+        return _typed_column(values[start:stop], dtype)
+    
+    @metrics.timed('columnar_load')
+    def load(self, race_csv_path):
+        """Loppets DataFrame ur lagret, None om filen inte finns i lagret eller har ändrats"""
+        if not self.enabled:
+            return None
+        source, filename = os.path.split(os.path.abspath(race_csv_path))
+        with self.lock:
+            entry = self._open(source)
+            manifest = entry[1]
+            race = manifest['files'].get(filename) if manifest else None
+            if race is None:
+                return None
+            if race['signature'] != list(file_signature(race_csv_path) or ()):
+                metrics.increment('columnar_stale')
+                return None
+            start, stop = race['start'], race['stop']
+            data = {name: self._race_column(entry, name, dtype, start, stop) for name, dtype in race['columns']}
+        metrics.increment('columnar_hits')
+        return pd.DataFrame(data, copy=False)
+    
+    @metrics.timed('columnar_ingest')
+    def ingest(self, source):
+        """
+        Läs alla CSV-filer i en katalog till ett nytt lager. Kolumnfilerna får
+        ett nytt prefix och manifestet byts atomärt, så processer som redan
+        mappat det gamla lagret kan läsa vidare. Returnerar antal filer.
+        """
+        races, parts, rows = {}, {}, 0
+        for filename in sorted(os.listdir(source)):
+            path = os.path.join(source, filename)
+            if not filename.lower().endswith('.csv') or not os.path.isfile(path):
+                continue
+            signature = file_signature(path)
+            try:
+                horses_df = pd.read_csv(path)
+            except Exception as e:
+                print(f"Varning: Kunde inte läsa {path}: {e}")
+                metrics.record_error('columnar', e)
+                continue
+            
+            # Kolumner med pandas typnamn, så att loppet kan återskapas exakt
+            columns = {column: (horses_df[column].to_numpy(), str(horses_df[column].dtype))
+                       for column in horses_df.columns}
+            columns.update((name, (values, str(values.dtype)))
+                           for name, values in parsed_race_fields(horses_df).items())
+            for name, (values, _) in columns.items():
+                parts.setdefault(name, []).append((rows, values))
+            races[filename] = {
+                'signature': list(signature),
+                'start': rows,
+                'stop': rows + len(horses_df),
+                'columns': [[name, dtype] for name, (_, dtype) in columns.items()],
+            }
+            rows += len(horses_df)
+        
+        path = columnar_path(source, self.directory)
+        os.makedirs(path, exist_ok=True)
+        prefix = f"{time.time_ns():x}"
+        manifest = {
+            'version': COLUMNAR_VERSION,
+            'source': os.path.abspath(source),
+            'rows': rows,
+            'columns': {},
+            'files': races,
+        }
+        for index, (name, column_parts) in enumerate(parts.items()):
+            filename = f"{prefix}-{index}.npy"
+            np.save(os.path.join(path, filename), _stored_column(column_parts, rows))
+            manifest['columns'][name] = filename
+        
+        fd, tmp_path = tempfile.mkstemp(dir=path, suffix='.tmp')
+        with os.fdopen(fd, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f, ensure_ascii=False)
+        os.replace(tmp_path, os.path.join(path, 'manifest.json'))
+        
+        # Ta bort kolumnfiler från tidigare inläsningar
+        current = set(manifest['columns'].values())
+        for filename in os.listdir(path):
+            if filename.endswith('.npy') and filename not in current:
+                try:
+                    os.remove(os.path.join(path, filename))
+                except OSError:
+                    pass
+        with self.lock:
+            self.stores.pop(os.path.abspath(source), None)
+        return len(races)
+
+def read_race_csv(race_csv_path):
+    """Ett lopps DataFrame, ur kolumnlagret om det är aktuellt, annars ur CSV-filen"""
+    horses_df = columnar_store.load(race_csv_path)
+    return horses_df if horses_df is not None else pd.read_csv(race_csv_path)
+
+def run_columnar_ingest(root, directory=COLUMNAR_DIR):
+    """Läs in varje katalog med CSV-filer under root till kolumnlagret"""
+    store = ColumnarStore(directory)
+    start = time.perf_counter()
+    sources = files = 0
+    for source, _, filenames in sorted(os.walk(root)):
+        if not any(f.lower().endswith('.csv') for f in filenames):
+            continue
+        files += store.ingest(source)
+        sources += 1
+    print(f"Läste in {files} CSV-filer i {sources} kataloger på {time.perf_counter() - start:.2f}s")
+    print(f"Kolumnlager i {directory}")
+    return files
+
+# Delat kolumnlager, används automatiskt för inlästa kataloger
+columnar_store = ColumnarStore()
+
+@metrics.timed('calculate_betting_percentages')
+def calculate_betting_percentages(horses_df, betting_data, race_number):
+    """
+    Beräkna och tilldela spelprocentar från JSON-data
+    """
+    # Standardvärde om ingen data finns
+    default_percentage = 100 / len(horses_df)
+    betting_percentages = betting_percentage_lookup(betting_data, race_number)
+    
+    if betting_percentages is not None:
+        # Tilldela spelprocent
+        horses_df['betting_percentage'] = horses_df['start_number'].map(
+            betting_percentages
+        ).fillna(default_percentage)
+    else:
+        # Jämn fördelning om ingen data
+        horses_df['betting_percentage'] = default_percentage
+    
+    return horses_df
+
+def betting_percentage_lookup(betting_data, race_number):
+    """{startnummer: spelprocent} för ett lopp, None om loppet saknas i JSON-data"""
+    race_key = f"V75-{race_number}"
+    if betting_data and race_key in betting_data:
+        return {
+            int(horse['number']): horse['percentage']
+            for horse in betting_data[race_key]['horses']
+        }
+    return None
+
+# Tolkning av AI-svar
+#
+# Svaret tolkas inkrementellt medan det strömmas. Varje hästobjekt i
+# "horses"-listan valideras så fort det är komplett, och ett uppenbart
+# felaktigt svar (okända eller dubbla startnummer, trasiga objekt, ingen lista
+# eller för få hästar när listan stängs) avbryts direkt så att anropet kan
+# göras om utan att vänta på resten. Ett svar som tar slut för tidigt lagas
+# om tillräckligt många hästar hunnit komma.
+
+AI_STREAM_RETRIES = 1        # Nya försök efter ett avbrutet svar
+AI_MIN_COVERAGE = 0.75       # Andel av hästarna som krävs för att laga ett ofullständigt svar
+AI_MAX_PREAMBLE = 400        # Tecken innan "horses"-listan måste ha börjat
+
+HORSES_ARRAY_PATTERN = re.compile(r'"horses"\s*:\s*\[')
+SUMMARY_PATTERN = re.compile(r'"analysis_summary"\s*:\s*("(?:[^"\\]|\\.)*")')
+
+class MalformedResponse(ValueError):
+    """AI-svaret är uppenbart felaktigt och bör göras om"""
+
+class RankingStreamParser:
+    """
+    Inkrementell tolkning av en AI-ranking. feed() tar emot text i valfria
+    bitar och kastar MalformedResponse så fort svaret inte går att använda.
+    result() ger rankingen, lagad om svaret är ofullständigt.
+    """
+    def __init__(self, horses_data):
+        self.expected = {horse['start_number']: horse['name'] for horse in horses_data}
+        self.horses = {}          # startnummer -> hästobjekt, i mottagningsordning
+        self.text = ''
+        self.position = 0
+        self.state = 'preamble'   # preamble -> array -> done
+        self.depth = 0
+        self.in_string = False
+        self.escape = False
+        self.object_start = None
+    
+    def feed(self, chunk):
+        """Ta emot nästa bit av svaret"""
+        self.text += chunk
+        if self.state == 'preamble':
+            match = HORSES_ARRAY_PATTERN.search(self.text)
+            if match is None:
+                if len(self.text) > AI_MAX_PREAMBLE:
+                    raise MalformedResponse("ingen hästlista i svaret")
+                return
+            self.state = 'array'
+            self.position = match.end()
+        if self.state == 'array':
+            self._scan()
+    
+    def _scan(self):
+        """Leta upp kompletta hästobjekt i listan"""
+        text = self.text
+        for index in range(self.position, len(text)):
+            char = text[index]
+            if self.depth == 0:
+                if char == '{':
+                    self.depth = 1
+                    self.object_start = index
+                elif char == ']':
+                    self.state = 'done'
+                    self.position = index + 1
+                    self._check_complete()
+                    return
+                elif not (char.isspace() or char == ','):
+                    raise MalformedResponse(f"oväntat tecken i hästlistan: {char!r}")
+            elif self.in_string:
+                if self.escape:
+                    self.escape = False
+                elif char == '\\':
+                    self.escape = True
+                elif char == '"':
+                    self.in_string = False
+            elif char == '"':
+                self.in_string = True
+            elif char == '{':
+                self.depth += 1
+            elif char == '}':
+                self.depth -= 1
+                if self.depth == 0:
+                    self._accept(text[self.object_start:index + 1])
+        self.position = len(text)
+    
+    def _accept(self, object_text):
+        """Validera ett komplett hästobjekt"""
+        try:
+            horse = json.loads(object_text)
+        except json.JSONDecodeError as e:
+            raise MalformedResponse(f"trasigt hästobjekt: {e}") from None
+        if not isinstance(horse, dict):
+            raise MalformedResponse("hästobjektet är inte ett objekt")
+        
+        start_number = horse.get('start_number')
+        if isinstance(start_number, str) and start_number.strip().isdigit():
+            start_number = int(start_number)
+        if isinstance(start_number, bool) or start_number not in self.expected:
+            raise MalformedResponse(f"okänt startnummer: {horse.get('start_number')!r}")
+        if start_number in self.horses:
+            raise MalformedResponse(f"startnummer {start_number} förekommer två gånger")
+        
+        percentage = horse.get('calculated_percentage')
+        if isinstance(percentage, bool) or not isinstance(percentage, (int, float)) or not 0 <= percentage <= 100:
+            raise MalformedResponse(f"ogiltig procentsats för startnummer {start_number}: {percentage!r}")
+        
+        horse['start_number'] = start_number
+        horse.setdefault('name', self.expected[start_number])
+        self.horses[start_number] = horse
+    
+    def _check_complete(self):
+        """Listan har stängts: för få hästar går inte att laga"""
+        if len(self.horses) < AI_MIN_COVERAGE * len(self.expected):
+            missing = [n for n in self.expected if n not in self.horses]
+            raise MalformedResponse(f"saknade startnummer: {missing}")
+    
+    def result(self):
+        """
+        Rankingen som dict, normaliserad till 100 %. Saknade hästar får lika
+        delar av det som återstår. None om för få hästar kommit.
+        """
+        if not self.expected or len(self.horses) < AI_MIN_COVERAGE * len(self.expected):
+            return None
+        
+        horses = list(self.horses.values())
+        missing = [n for n in self.expected if n not in self.horses]
+        if missing:
+            metrics.increment('json_repairs')
+            total = sum(h['calculated_percentage'] for h in horses)
+            share = (100 - total) / len(missing) if total < 100 else min(h['calculated_percentage'] for h in horses)
+            horses += [
+                {"name": self.expected[n], "start_number": n, "calculated_percentage": share}
+                for n in missing
+            ]
+        
+        # Normalisera procentvärden
+        total_percentage = sum(h['calculated_percentage'] for h in horses)
+        if total_percentage <= 0:
+            return None
+        if abs(total_percentage - 100) > 0.1:
+            metrics.increment('json_normalized')
+            for h in horses:
+                h['calculated_percentage'] *= 100 / total_percentage
+        
+        ranking = {"horses": horses}
+        summary = SUMMARY_PATTERN.search(self.text, self.position)
+        if summary:
+            try:
+                ranking['analysis_summary'] = json.loads(summary.group(1))
+            except json.JSONDecodeError:
+                pass
+        return ranking
+
+@metrics.timed('extract_json')
+def extract_json_safely(text, horses_data):
+    """
+    Tolka ett komplett AI-svar. Kodblock, text före JSON och avhuggna svar
+    hanteras av RankingStreamParser; går svaret inte att använda blir det
+    jämn fördelning.
+    """
+    parser = RankingStreamParser(horses_data)
+    try:
+        parser.feed(text)
+        ranking = parser.result()
+    except MalformedResponse as e:
+        print(f"JSON-tolkningsfel: {e}")
+        ranking = None
+    except Exception as e:
+        print(f"Oväntat fel vid JSON-extrahering: {e}")
+        metrics.record_error('extract_json', e)
+        ranking = None
+    
+    if ranking is None:
+        metrics.increment('json_invalid')
+        return fallback_ranking(horses_data)
+    return ranking
+
+def deviation_status(deviation):
+    """Klassificera avvikelsen mellan AI-ranking och spelad procent"""
+    if deviation > 1:
+        return 'Överspelad'
+    if deviation < -1:
+        return 'Underspelad'
+    return 'Normal'
+
+@metrics.timed('compare')
+def compare_ai_ranking_with_betting_percentages(ai_ranking, horses):
+    """
+    Jämför AI:ns ranking med faktiska spelade procenten.
+    horses är en HorseTable eller ett poängsatt lopp som DataFrame.
+    """
+    print("\n=== JÄMFÖRELSE: AI-RANKING MOT SPELAD PROCENT ===")
+    
+    # Skapa dictionary för enkel sökning
+    records = as_horse_table(horses).records
+    betting_percentages = dict(zip(
+        records['start_number'].tolist(),
+        records['betting_percentage'].tolist()
+    ))
+    
+    # Sortera hästar efter AI:ns ranking
+    sorted_horses = sorted(
+        ai_ranking['horses'], 
         key=lambda x: x.get('calculated_percentage', 0), 
         reverse=True
     )
@@ -538,37 +1871,59 @@ def compare_ai_ranking_with_betting_percentages(ai_ranking, horses_df):
         print(f"\nHäst {start_number}:")
         print(f"  Namn: {horse['name']}")
         print(f"  AI-ranking: {ai_percentage:.1f}%")
+        if 'dispersion' in horse:
+            print(f"  Spridning mellan AI-svar: ±{horse['dispersion']:.1f}%")
         print(f"  Faktisk spelad: {actual_percentage:.1f}%")
         print(f"  Avvikelse: {deviation:.1f}%")
-        print(f"  Status: {'Överspelad' if deviation > 1 else 'Underspelad' if deviation < -1 else 'Normal'}")
+        print(f"  Status: {deviation_status(deviation)}")
     
     # Skriv ut AI:ns övergripande analys
     print("\nAI:ns analyssammanfattning:")
     print(ai_ranking.get('analysis_summary', 'Ingen övergripande analys tillgänglig'))
 
-def analyze_horse_with_ai(horses_df):
+# Inställningar för AI-analys
+AI_MODEL = "gpt-3.5-turbo"
+AI_TEMPERATURE = 0.7
+AI_MAX_TOKENS = 300
+AI_SYSTEM_PROMPT = "Du är en expert på travanalys som gör kvantitativa bedömningar."
+AI_FALLBACK_SUMMARY = "Kunde inte genomföra fullständig analys"
+
+def prepare_horses_data(horses):
     """
-    AI analyserar och rankar hästar baserat på förberedda data
+    Förbered hästdata för AI från en HorseTable (eller DataFrame)
     """
-    try:
-        # Förbered data för AI
-        horses_data = []
-        for _, horse in horses_df.iterrows():
-            horse_info = {
-                "name": horse['name'],
-                "start_number": horse['start_number'],
-                "form_score": round(horse['form_score'], 2),
-                "career_earnings": horse['earnings'],
-                "distance_1640_score": round(horse['distance_1640_score'], 2),
-                "distance_2140_score": round(horse['distance_2140_score'], 2),
-                "distance_2640_score": round(horse['distance_2640_score'], 2),
-                "track_position_score": round(horse['track_position_score'], 2),
-                "betting_percentage": round(horse['betting_percentage'], 2)
-            }
-            horses_data.append(horse_info)
-        
-        # Skapa prompt för AI
-        prompt = f"""Analysera och fördela exakt 100% mellan dessa hästar:
+    table = as_horse_table(horses)
+    records = table.records
+    rounded = {
+        column: [round(value, 2) for value in records[column].tolist()]
+        for column in ('form_score', 'distance_1640_score', 'distance_2140_score',
+                       'distance_2640_score', 'track_position_score', 'betting_percentage')
+    }
+    horses_data = []
+    # earnings lagras som float64; heltal skickas som heltal så att prompten
+    # och AI-cachens nycklar blir desamma som från CSV-filens heltalskolumn
+    for i, (name, start_number, earnings) in enumerate(zip(
+        table.horse_names(), records['start_number'].tolist(), records['earnings'].tolist()
+    )):
+        horse_info = {
+            "name": name,
+            "start_number": start_number,
+            "form_score": rounded['form_score'][i],
+            "career_earnings": int(earnings) if earnings.is_integer() else earnings,
+            "distance_1640_score": rounded['distance_1640_score'][i],
+            "distance_2140_score": rounded['distance_2140_score'][i],
+            "distance_2640_score": rounded['distance_2640_score'][i],
+            "track_position_score": rounded['track_position_score'][i],
+            "betting_percentage": rounded['betting_percentage'][i]
+        }
+        horses_data.append(horse_info)
+    return horses_data
+
+def build_ai_prompt(horses_data):
+    """
+    Skapa prompt för AI
+    """
+    return f"""Analysera och fördela exakt 100% mellan dessa hästar:
 
 Hästdata:
 {json.dumps(horses_data, indent=2)}
@@ -590,140 +1945,3379 @@ JSON-FORMAT:
     ],
     "analysis_summary": "Förklaring"
 }}"""
-        
-        response = client.chat.completions.create(
-            model="gpt-3.5-turbo",
-            messages=[
-                {"role": "system", "content": "Du är en expert på travanalys som gör kvantitativa bedömningar."},
-                {"role": "user", "content": prompt}
-            ],
-            temperature=0.7,
-            max_tokens=300
+
+def build_ai_messages(prompt):
+    """Meddelanden till chat-API:t"""
+    return [
+        {"role": "system", "content": AI_SYSTEM_PROMPT},
+        {"role": "user", "content": prompt}
+    ]
+
+def fallback_ranking(horses_data):
+    """
+    Fallback-svar med jämn fördelning mellan hästarna
+    """
+    return {
+        "horses": [
+            {
+                "name": horse['name'], 
+                "start_number": horse['start_number'], 
+                "calculated_percentage": 100/len(horses_data)
+            } 
+            for horse in horses_data
+        ],
+        "analysis_summary": AI_FALLBACK_SUMMARY
+    }
+
+def is_fallback_ranking(ai_ranking):
+    """Sant om rankingen saknas eller är en jämn fallback-fördelning"""
+    return not ai_ranking or ai_ranking.get('analysis_summary') == AI_FALLBACK_SUMMARY
+
+# Cache för AI-svar
+#
+# Svaren sparas på disk under en nyckel som är en hash av modell, prompt,
+# temperatur och hästdata. Identiska anrop besvaras direkt från cachen.
+# Filerna skrivs atomärt så att flera processer kan dela samma katalog.
+
+AI_CACHE_DIR = os.path.join('.cache', 'ai')
+AI_CACHE_MAX_BYTES = 50 * 1024 * 1024
+AI_CACHE_MAX_AGE = 30 * 24 * 3600  # Sekunder
+AI_CACHE_EVICT_INTERVAL = 20  # Rensa efter så här många skrivningar
+
+class ResponseCache:
+    """
+    Innehållsadresserad diskcache för AI-svar med LRU-rensning på storlek och ålder.
+    
+    enabled=False stänger av cachen helt, refresh=True hoppar över läsning men
+    skriver nya svar (ogiltigförklarar befintliga poster).
+    """
+    def __init__(self, directory=AI_CACHE_DIR, max_bytes=AI_CACHE_MAX_BYTES,
+                 max_age=AI_CACHE_MAX_AGE, enabled=True, refresh=False):
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.max_age = max_age
+        self.enabled = enabled
+        self.refresh = refresh
+        self.hits = 0
+        self.misses = 0
+        self.writes = 0
+        self.evictions = 0
+    
+    @staticmethod
+    def make_key(model, messages, temperature, horses_data, sample=None):
+        """Hash av allt som påverkar svaret. sample skiljer svaren åt i en ensemble."""
+        entry = {
+            'model': model,
+            'messages': messages,
+            'temperature': temperature,
+            'horses': horses_data
+        }
+        if sample is not None:
+            entry['sample'] = sample
+        payload = json.dumps(
+            entry,
+            sort_keys=True,
+            ensure_ascii=False,
+            default=str
         )
+        return hashlib.sha256(payload.encode('utf-8')).hexdigest()
+    
+    def _path(self, key):
+        return os.path.join(self.directory, key[:2], f'{key}.json')
+    
+    def get(self, key):
+        """Hämta sparat svar, eller None vid miss"""
+        if not self.enabled or self.refresh:
+            return None
         
-        # Hämta och skriv ut det fullständiga svaret
-        full_response = response.choices[0].message.content.strip()
-        print("\n===== FULLSTÄNDIGT AI-SVAR =====")
-        print(full_response)
-        print("===== SLUT PÅ AI-SVAR =====\n")
+        path = self._path(key)
+        try:
+            with open(path, 'r', encoding='utf-8') as f:
+                entry = json.load(f)
+            if time.time() - entry['created'] > self.max_age:
+                os.remove(path)
+                raise FileNotFoundError(path)
+            # Uppdatera senaste användning för LRU
+            os.utime(path)
+        except (OSError, ValueError, KeyError):
+            self.misses += 1
+            metrics.increment('ai_cache_misses')
+            return None
+        
+        self.hits += 1
+        metrics.increment('ai_cache_hits')
+        return entry['response']
+    
+    def put(self, key, response, model=None):
+        """Spara ett svar atomärt"""
+        if not self.enabled:
+            return
         
-        # Använd robust JSON-extrahering
-        parsed_response = extract_json_safely(full_response, horses_data)
+        path = self._path(key)
+        entry = {'created': time.time(), 'model': model, 'response': response}
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            fd, tmp_path = tempfile.mkstemp(dir=os.path.dirname(path), suffix='.tmp')
+            with os.fdopen(fd, 'w', encoding='utf-8') as f:
+                json.dump(entry, f, ensure_ascii=False)
+            os.replace(tmp_path, path)
+            self.writes += 1
+        except OSError as e:
+            print(f"Kunde inte spara AI-svar i cache: {e}")
+            return
         
-        return parsed_response
+        if self.writes % AI_CACHE_EVICT_INTERVAL == 0:
+            self.evict()
     
-    except Exception as e:
-        print(f"Fel vid AI-analys: {e}")
+    def _entries(self):
+        """Alla cacheposter som (senast använd, storlek, sökväg)"""
+        entries = []
+        for directory, _, filenames in os.walk(self.directory):
+            for filename in filenames:
+                if not filename.endswith('.json'):
+                    continue
+                path = os.path.join(directory, filename)
+                try:
+                    stat = os.stat(path)
+                except OSError:
+                    continue
+                entries.append((stat.st_mtime, stat.st_size, path))
+        return entries
+    
+    def evict(self):
+        """Ta bort poster som är för gamla, därefter de minst nyligen använda"""
+        entries = sorted(self._entries())
+        total_bytes = sum(size for _, size, _ in entries)
+        oldest_allowed = time.time() - self.max_age
         
-        # Skapa fallback-svar
-        return {
-            "horses": [
-                {
-                    "name": horse['name'], 
-                    "start_number": horse['start_number'], 
-                    "calculated_percentage": 100/len(horses_df)
-                } 
-                for _, horse in horses_df.iterrows()
-            ],
-            "analysis_summary": "Kunde inte genomföra fullständig analys"
-        }
+        for last_used, size, path in entries:
+            if last_used >= oldest_allowed and total_bytes <= self.max_bytes:
+                break
+            try:
+                os.remove(path)
+                self.evictions += 1
+            except OSError:
+                pass
+            total_bytes -= size
+    
+    def clear(self):
+        """Töm hela cachen"""
+        for _, _, path in self._entries():
+            try:
+                os.remove(path)
+            except OSError:
+                pass
+    
+    def summary(self):
+        """Kort sammanfattning av träffar och missar"""
+        return f"AI-cache: {self.hits} träffar, {self.misses} missar, {self.writes} sparade, {self.evictions} rensade"
+
+# Delad cache för alla AI-anrop
+ai_cache = ResponseCache()
+
+# Robust AI-transport
+#
+# Alla AI-anrop går genom LLMTransport: en tidsgräns per anrop och en total
+# tidsbudget inklusive nya försök, exponentiell backoff med jitter vid
+# tillfälliga fel (anslutning, timeout, 429 och 5xx), en kretsbrytare som
+# slutar anropa API:t efter upprepade fel och valfria hedgade anrop: dröjer
+# ett svar längre än en percentil av de senaste svarstiderna skickas samma
+# anrop en gång till och det första svaret vinner. Klienterna skapas utan
+# SDK:ns egna omförsök och återanvänder keep-alive-anslutningar, den
+# synkrona klienten i hela processen och den asynkrona för alla lopp i en
+# omgång.
+
+AI_CALL_TIMEOUT = 45.0          # Sekunder per försök
+AI_CALL_DEADLINE = 90.0         # Sekunder totalt per anrop, inklusive nya försök
+AI_MAX_ATTEMPTS = 3
+AI_BACKOFF_BASE = 0.5           # Sekunder före första nya försöket
+AI_BACKOFF_MAX = 8.0
+AI_HEDGE_PERCENTILE = 95        # Hedga när ett försök tar längre än denna percentil
+AI_HEDGE_MIN_SAMPLES = 20       # Svarstider som krävs innan hedging används
+AI_HEDGE_WINDOW = 200           # Antal svarstider som percentilen räknas på
+AI_BREAKER_WINDOW = 20          # Antal senaste försök som kretsbrytaren bedömer
+AI_BREAKER_FAILURE_RATIO = 0.8  # Andel fel i fönstret som öppnar kretsbrytaren
+AI_BREAKER_COOLDOWN = 30.0      # Sekunder innan ett nytt provanrop släpps igenom
+
+# HTTP-status som är värda att försöka igen
+RETRYABLE_STATUS = (408, 409, 429)
+
+class CircuitOpen(RuntimeError):
+    """Kretsbrytaren är öppen, anropet görs inte"""
+
+class CallCancelled(Exception):
+    """Ett hedgat försök avbröts eftersom det andra svarade först"""
 
-def analyze_race(race_csv_path, spelprocent_json_path, banstatistik_json_path=None):
+def is_retryable(error):
+    """Sant om felet är tillfälligt och anropet kan göras om"""
+    import openai
+    if isinstance(error, openai.APIStatusError):
+        return error.status_code in RETRYABLE_STATUS or error.status_code >= 500
+    if isinstance(error, (openai.APIConnectionError, TimeoutError, ConnectionError)):
+        return True
+    # Avbrott mitt i en ström kommer direkt från httpx
+    httpx = sys.modules.get('httpx')
+    return httpx is not None and isinstance(error, httpx.TransportError)
+
+class CircuitBreaker:
     """
-    Huvudfunktion för att analysera ett lopp
+    Öppnar när minst failure_ratio av de senaste window försöken misslyckats.
+    När cooldown gått släpps ett provanrop igenom; lyckas det stängs
+    brytaren, annars öppnar den igen.
     """
-    # Läs in data
-    horses_df, betting_data, race_number = load_horse_data(race_csv_path, spelprocent_json_path)
-    
-    # Läs in banstatistik om tillgänglig
-    track_data = None
-    if banstatistik_json_path and os.path.exists(banstatistik_json_path):
-        with open(banstatistik_json_path, 'r', encoding='utf-8') as f:
-            track_data = json.load(f)
-    
-    if horses_df is None:
-        print("Kunde inte läsa in hästdata.")
-        return None
-    
-    # Beräkna och sortera efter spelvärde
-    result_df = calculate_betting_value(horses_df, betting_data, race_number, track_data)
+    def __init__(self, window=AI_BREAKER_WINDOW, failure_ratio=AI_BREAKER_FAILURE_RATIO,
+                 cooldown=AI_BREAKER_COOLDOWN):
+        self.failure_ratio = failure_ratio
+        self.cooldown = cooldown
+        self.outcomes = collections.deque(maxlen=window)
+        self.opened_at = None
+        self.probing = False
+        self.lock = threading.Lock()
     
-    # AI-ranking
-    ai_ranking = analyze_horse_with_ai(result_df)
+    def allow(self):
+        """Sant om ett anrop får göras nu"""
+        with self.lock:
+            if self.opened_at is None:
+                return True
+            if not self.probing and time.monotonic() - self.opened_at >= self.cooldown:
+                self.probing = True
+                return True
+            return False
     
-    # Jämför AI-ranking med spelade procent
-    if ai_ranking:
-        compare_ai_ranking_with_betting_percentages(ai_ranking, result_df)
+    def success(self):
+        with self.lock:
+            self.outcomes.append(True)
+            if self.probing:
+                self.outcomes.clear()
+                self.opened_at = None
+                self.probing = False
     
-    return result_df
+    def failure(self):
+        with self.lock:
+            self.outcomes.append(False)
+            failures = self.outcomes.count(False)
+            tripped = (len(self.outcomes) == self.outcomes.maxlen
+                       and failures >= self.failure_ratio * len(self.outcomes))
+            if self.probing or (self.opened_at is None and tripped):
+                self.opened_at = time.monotonic()
+                metrics.increment('ai_breaker_opened')
+            self.probing = False
 
-def calculate_betting_value(horses_df, betting_data, race_number, track_data=None):
+class LLMTransport:
     """
-    Beräkna spelvärde för hästar
+    Gör ett AI-anrop med tidsgränser, nya försök, kretsbrytare och hedging.
+    request är en funktion som gör ett försök och får sin deadline
+    (time.monotonic()) samt, i den synkrona varianten, en threading.Event som
+    sätts om försöket ska avbrytas.
     """
-    # Beräkna distanspoäng
-    def extract_distance_score(row, target_distance):
-        return row['distance_performance'].get(target_distance, 0)
+    def __init__(self, timeout=AI_CALL_TIMEOUT, deadline=AI_CALL_DEADLINE, max_attempts=AI_MAX_ATTEMPTS,
+                 hedge=False, hedge_percentile=AI_HEDGE_PERCENTILE, breaker=None):
+        self.timeout = timeout
+        self.deadline = deadline
+        self.max_attempts = max_attempts
+        self.hedge = hedge
+        self.hedge_percentile = hedge_percentile
+        self.breaker = breaker or CircuitBreaker()
+        self.latencies = collections.deque(maxlen=AI_HEDGE_WINDOW)
+        self.executor = None
+        self.lock = threading.Lock()
     
-    # Lägg till distansanalys
-    horses_df['distance_performance'] = horses_df.apply(analyze_distance_performance, axis=1)
-    horses_df['distance_1640_score'] = horses_df.apply(lambda row: extract_distance_score(row, 1640), axis=1)
-    horses_df['distance_2140_score'] = horses_df.apply(lambda row: extract_distance_score(row, 2140), axis=1)
-    horses_df['distance_2640_score'] = horses_df.apply(lambda row: extract_distance_score(row, 2640), axis=1)
+    def hedge_delay(self):
+        """Sekunder innan ett hedgat försök skickas, None om hedging inte används"""
+        if not self.hedge or len(self.latencies) < AI_HEDGE_MIN_SAMPLES:
+            return None
+        latencies = sorted(self.latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * self.hedge_percentile / 100))]
     
-    # Beräkna formvärde
-    horses_df['form_score'] = horses_df.apply(calculate_form_score, axis=1)
+    def backoff(self, attempt):
+        """Väntetid före försök attempt + 1, exponentiell med full jitter"""
+        return random.uniform(0, min(AI_BACKOFF_MAX, AI_BACKOFF_BASE * 2 ** attempt))
     
-    # Beräkna karriärvärde
-    horses_df['career_score'] = horses_df.apply(calculate_career_score, axis=1)
+    def _admit(self):
+        if not self.breaker.allow():
+            metrics.increment('ai_breaker_rejected')
+            raise CircuitOpen("för många AI-fel, försöker igen senare")
     
-    # Beräkna spårplaceringspoäng
-    horses_df['track_position_score'] = horses_df.apply(
-        lambda row: calculate_track_position_score(row, track_data), 
-        axis=1
-    )
+    def _failed(self, error, attempt, deadline):
+        """Bokför ett misslyckat försök. Returnerar väntetid före nästa, eller kastar vidare."""
+        if isinstance(error, MalformedResponse):
+            # API:t svarar, det är svaret som är fel
+            self.breaker.success()
+            raise error
+        self.breaker.failure()
+        metrics.record_error('ai_transport', error)
+        delay = self.backoff(attempt)
+        if (not is_retryable(error) or attempt + 1 >= self.max_attempts
+                or time.monotonic() + delay >= deadline):
+            raise error
+        metrics.increment('ai_retries')
+        return delay
     
-    # Lägg till spelprocentar
-    horses_df = calculate_betting_percentages(horses_df, betting_data, race_number)
+    def _succeeded(self, started):
+        self.breaker.success()
+        self.latencies.append(time.monotonic() - started)
     
-    # Beräkna totalvärde
-    horses_df['total_score'] = (
-        horses_df['form_score'] * 0.3 +
-        horses_df['career_score'] * 0.2 +
-        horses_df['distance_1640_score'] * 0.1 +
-        horses_df['distance_2140_score'] * 0.1 +
-        horses_df['distance_2640_score'] * 0.1 +
-        horses_df['track_position_score'] * 0.2
-    )
+    def call(self, request):
+        """Synkront anrop, request(deadline, cancelled)"""
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.max_attempts):
+            self._admit()
+            started = time.monotonic()
+            try:
+                result = self._hedged(request, min(started + self.timeout, deadline))
+            except Exception as e:
+                time.sleep(self._failed(e, attempt, deadline))
+                continue
+            self._succeeded(started)
+            return result
     
-    # Sortera efter totalvärde
-    result_df = horses_df.sort_values('total_score', ascending=False)
+    def _hedged(self, request, deadline):
+        delay = self.hedge_delay()
+        if delay is None:
+            return request(deadline, threading.Event())
+        
+        with self.lock:
+            if self.executor is None:
+                self.executor = futures.ThreadPoolExecutor(max_workers=2 * AI_CONCURRENCY,
+                                                           thread_name_prefix='ai-hedge')
+        attempts = {}
+        primary = self.executor.submit(request, deadline, attempts.setdefault('primary', threading.Event()))
+        done, _ = futures.wait([primary], timeout=delay)
+        if done:
+            return primary.result()
+        
+        metrics.increment('ai_hedged')
+        hedge = self.executor.submit(request, deadline, attempts.setdefault('hedge', threading.Event()))
+        pending = {primary: attempts['primary'], hedge: attempts['hedge']}
+        error = None
+        while pending:
+            done, _ = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+            for future in done:
+                pending.pop(future)
+                if future.exception() is not None:
+                    error = future.exception()
+                    continue
+                for cancelled in pending.values():
+                    cancelled.set()
+                if future is hedge:
+                    metrics.increment('ai_hedge_wins')
+                return future.result()
+        raise error
     
-    return result_df
-
+    async def call_async(self, request):
+        """Asynkront anrop, request(deadline)"""
+        deadline = time.monotonic() + self.deadline
+        for attempt in range(self.max_attempts):
+            self._admit()
+            started = time.monotonic()
+            try:
+                result = await self._hedged_async(request, min(started + self.timeout, deadline))
+            except Exception as e:
+                await asyncio.sleep(self._failed(e, attempt, deadline))
+                continue
+            self._succeeded(started)
+            return result
+    
+    async def _hedged_async(self, request, deadline):
+        delay = self.hedge_delay()
+        if delay is None:
+            return await request(deadline)
+        
+        primary = asyncio.ensure_future(request(deadline))
+        done, _ = await asyncio.wait({primary}, timeout=delay)
+        if done:
+            return primary.result()
+        
+        metrics.increment('ai_hedged')
+        hedge = asyncio.ensure_future(request(deadline))
+        pending = {primary, hedge}
+        error = None
+        try:
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is not None:
+                        error = task.exception()
+                        continue
+                    if task is hedge:
+                        metrics.increment('ai_hedge_wins')
+                    return task.result()
+            raise error
+        finally:
+            for task in pending:
+                task.cancel()
+
+# Delad transport för alla AI-anrop
+ai_transport = LLMTransport()
+
+class RankingStream:
+    """
+    Bokföring för ett strömmat AI-anrop: matar parsern med varje bit och
+    mäter tid till första token, total latens och tokens.
+    """
+    def __init__(self, horses_data):
+        self.parser = RankingStreamParser(horses_data)
+        self.started = time.perf_counter()
+        self.first_token = None
+        self.usage = None
+    
+    def feed(self, chunk):
+        """Ta emot en händelse från strömmen"""
+        if getattr(chunk, 'usage', None) is not None:
+            self.usage = chunk.usage
+        if not chunk.choices:
+            return
+        content = chunk.choices[0].delta.content
+        if content:
+            if self.first_token is None:
+                self.first_token = time.perf_counter() - self.started
+                metrics.record_stage('ai_first_token', self.first_token)
+            self.parser.feed(content)
+    
+    def abort(self, error):
+        """Strömmen avbröts: räkna tokens som kommit hittills"""
+        received = len(self.parser.text) // 4
+        metrics.record_llm_call(time.perf_counter() - self.started)
+        metrics.increment('ai_stream_aborts')
+        metrics.increment('ai_stream_aborted_tokens', received)
+        print(f"Avbröt AI-svar efter ca {received} tokens: {error}")
+    
+    def finish(self):
+        """Strömmen är slut. Returnerar (ranking, fullständigt svar)"""
+        metrics.record_llm_call(time.perf_counter() - self.started, self.usage)
+        ranking = self.parser.result()
+        if ranking is None:
+            raise MalformedResponse("för få hästar i svaret")
+        return ranking, self.parser.text.strip()
+
+def stream_request(messages, deadline):
+    """Argument för ett strömmat chat-anrop med tidsgräns fram till deadline"""
+    request = {
+        'model': AI_MODEL,
+        'messages': messages,
+        'temperature': AI_TEMPERATURE,
+        'max_tokens': AI_MAX_TOKENS,
+        'stream': True,
+        'stream_options': {'include_usage': True},
+    }
+    if deadline is not None:
+        request['timeout'] = max(deadline - time.monotonic(), 0.001)
+    return request
+
+def check_stream(deadline, cancelled=None):
+    """Avbryt strömmen om tiden gått ut eller försöket inte längre behövs"""
+    if cancelled is not None and cancelled.is_set():
+        raise CallCancelled("ett annat försök svarade först")
+    if deadline is not None and time.monotonic() > deadline:
+        raise TimeoutError("AI-svaret tog för lång tid")
+
+def stream_ai_ranking(messages, horses_data, deadline=None, cancelled=None):
+    """
+    Strömma ett AI-svar och tolka det under tiden. Avbryter och kastar
+    MalformedResponse så fort svaret inte går att använda.
+    """
+    ranking_stream = RankingStream(horses_data)
+    stream = get_client().chat.completions.create(**stream_request(messages, deadline))
+    with stream:
+        try:
+            for chunk in stream:
+                check_stream(deadline, cancelled)
+                ranking_stream.feed(chunk)
+        except MalformedResponse as e:
+            ranking_stream.abort(e)
+            raise
+    return ranking_stream.finish()
+
+def log_ai_analysis(table, started, ranking, fallback_used, **fields):
+    """Skriv en AI-analys till körloggen och returnera rankingen"""
+    run_log.log(
+        'ai_analysis',
+        race=list(table.races[0]) if len(table.races) == 1 else None,
+        model=AI_MODEL,
+        ranking=ranking,
+        fallback=fallback_used,
+        seconds=time.perf_counter() - started,
+        **fields
+    )
+    return ranking
+
+@metrics.timed('ai_analysis')
+def analyze_horse_with_ai(horses, fallback='equal'):
+    """
+    AI analyserar och rankar hästar baserat på förberedda data.
+    fallback väljer jämn fördelning ('equal') eller lokal modell ('local') vid fel.
+    """
+    horses = as_horse_table(horses)
+    if ai_ensemble.samples > 1:
+        # Ensemblens anrop skickas samtidigt med den asynkrona klienten
+        return analyze_card_with_ai([horses], fallback=fallback)[0]
+    started = time.perf_counter()
+    fields = {}
+    try:
+        # Förbered data för AI
+        horses_data = prepare_horses_data(horses)
+        
+        # Skapa prompt för AI
+        prompt = build_ai_prompt(horses_data)
+        messages = build_ai_messages(prompt)
+        fields.update(horses=horses_data, messages=messages)
+        
+        # Använd sparat svar om exakt samma anrop gjorts tidigare
+        cache_key = ai_cache.make_key(AI_MODEL, messages, AI_TEMPERATURE, horses_data)
+        full_response = ai_cache.get(cache_key)
+        from_cache = full_response is not None
+        
+        if from_cache:
+            parsed_response = extract_json_safely(full_response, horses_data)
+        else:
+            # Strömma svaret och gör om anropet om det avbryts
+            parsed_response = None
+            for _ in range(AI_STREAM_RETRIES + 1):
+                try:
+                    parsed_response, full_response = ai_transport.call(
+                        functools.partial(stream_ai_ranking, messages, horses_data)
+                    )
+                    break
+                except MalformedResponse:
+                    continue
+        fields.update(response=full_response, from_cache=from_cache)
+        
+        if is_fallback_ranking(parsed_response):
+            return log_ai_analysis(horses, started, fallback_for(horses, fallback), True, **fields)
+        
+        # Spara bara nya svar som gick att tolka
+        if not from_cache:
+            ai_cache.put(cache_key, full_response, AI_MODEL)
+        
+        return log_ai_analysis(horses, started, parsed_response, False, **fields)
+    
+    except Exception as e:
+        print(f"Fel vid AI-analys: {e}")
+        metrics.record_error('ai_analysis', e)
+        
+        # Skapa fallback-svar
+        return log_ai_analysis(horses, started, fallback_for(horses, fallback), True, error=str(e), **fields)
+
+# Asynkron AI-analys av flera lopp
+#
+# Alla lopp i en omgång skickas samtidigt med en asynkron klient. Antalet
+# samtidiga anrop begränsas, liksom anrop och tokens per minut.
+
+# Standardgränser för asynkron AI-analys
+AI_CONCURRENCY = 7
+AI_REQUESTS_PER_MINUTE = 500
+AI_TOKENS_PER_MINUTE = 90000
+
+class RateLimiter:
+    """
+    Begränsar anrop och tokens per minut med två hinkar som fylls på
+    kontinuerligt (token bucket).
+    """
+    def __init__(self, requests_per_minute=AI_REQUESTS_PER_MINUTE, tokens_per_minute=AI_TOKENS_PER_MINUTE):
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.available_requests = float(requests_per_minute)
+        self.available_tokens = float(tokens_per_minute)
+        self.updated = time.monotonic()
+        self.lock = asyncio.Lock()
+    
+    def _refill(self):
+        now = time.monotonic()
+        elapsed = now - self.updated
+        self.updated = now
+        self.available_requests = min(
+            self.requests_per_minute,
+            self.available_requests + elapsed * self.requests_per_minute / 60
+        )
+        self.available_tokens = min(
+            self.tokens_per_minute,
+            self.available_tokens + elapsed * self.tokens_per_minute / 60
+        )
+    
+    async def acquire(self, tokens):
+        """Vänta tills ett anrop med angivet antal tokens ryms inom gränserna"""
+        # Ett enskilt anrop får aldrig kräva mer än en hel minuts kvot
+        tokens = min(tokens, self.tokens_per_minute)
+        async with self.lock:
+            while True:
+                self._refill()
+                if self.available_requests >= 1 and self.available_tokens >= tokens:
+                    self.available_requests -= 1
+                    self.available_tokens -= tokens
+                    return
+                wait = max(
+                    (1 - self.available_requests) * 60 / self.requests_per_minute,
+                    (tokens - self.available_tokens) * 60 / self.tokens_per_minute
+                )
+                await asyncio.sleep(wait)
+
+def estimate_tokens(messages, max_tokens=AI_MAX_TOKENS):
+    """Grov uppskattning av tokens för ett anrop (ca 4 tecken per token)"""
+    return sum(len(message['content']) for message in messages) // 4 + max_tokens
+
+async def stream_ai_ranking_async(messages, horses_data, async_client, deadline=None):
+    """
+    Asynkron motsvarighet till stream_ai_ranking
+    """
+    ranking_stream = RankingStream(horses_data)
+    stream = await async_client.chat.completions.create(**stream_request(messages, deadline))
+    async with stream:
+        try:
+            async for chunk in stream:
+                check_stream(deadline)
+                ranking_stream.feed(chunk)
+        except MalformedResponse as e:
+            ranking_stream.abort(e)
+            raise
+    return ranking_stream.finish()
+
+async def request_ai_ranking_async(messages, horses_data, async_client, limiter, semaphore, cache_key):
+    """
+    Ett AI-svar för ett lopp, från cachen eller strömmat inom gränserna.
+    Returnerar (ranking, fullständigt svar, från cache). Rankingen är None om
+    inget försök gav ett användbart svar.
+    """
+    full_response = ai_cache.get(cache_key)
+    if full_response is not None:
+        return extract_json_safely(full_response, horses_data), full_response, True
+    
+    async with semaphore:
+        for _ in range(AI_STREAM_RETRIES + 1):
+            # Väntan på kvoten räknas inte in i anropets tidsgräns
+            await limiter.acquire(estimate_tokens(messages))
+            try:
+                parsed_response, full_response = await ai_transport.call_async(
+                    functools.partial(stream_ai_ranking_async, messages, horses_data, async_client)
+                )
+                return parsed_response, full_response, False
+            except MalformedResponse:
+                continue
+    return None, None, False
+
+async def analyze_horse_with_ai_async(horses, async_client, limiter, semaphore, fallback='equal'):
+    """
+    Asynkron motsvarighet till analyze_horse_with_ai för ett lopp
+    """
+    horses = as_horse_table(horses)
+    started = time.perf_counter()
+    fields = {}
+    try:
+        horses_data = prepare_horses_data(horses)
+        messages = build_ai_messages(build_ai_prompt(horses_data))
+        fields.update(horses=horses_data, messages=messages)
+        
+        if ai_ensemble.samples > 1:
+            parsed_response, ensemble_fields = await ai_ensemble.rank_async(
+                messages, horses_data, async_client, limiter, semaphore
+            )
+            fields.update(ensemble_fields)
+            if parsed_response is None:
+                return log_ai_analysis(horses, started, fallback_for(horses, fallback), True, **fields)
+            return log_ai_analysis(horses, started, parsed_response, False, **fields)
+        
+        cache_key = ai_cache.make_key(AI_MODEL, messages, AI_TEMPERATURE, horses_data)
+        parsed_response, full_response, from_cache = await request_ai_ranking_async(
+            messages, horses_data, async_client, limiter, semaphore, cache_key
+        )
+        fields.update(response=full_response, from_cache=from_cache)
+        
+        if is_fallback_ranking(parsed_response):
+            return log_ai_analysis(horses, started, fallback_for(horses, fallback), True, **fields)
+        
+        if not from_cache:
+            ai_cache.put(cache_key, full_response, AI_MODEL)
+        return log_ai_analysis(horses, started, parsed_response, False, **fields)
+    
+    except Exception as e:
+        print(f"Fel vid AI-analys: {e}")
+        metrics.record_error('ai_analysis', e)
+        return log_ai_analysis(horses, started, fallback_for(horses, fallback), True, error=str(e), **fields)
+
+async def rank_races_async(races, async_client, limiter, semaphore, fallback='equal'):
+    """Analysera lopp samtidigt med en befintlig klient och gemensamma gränser"""
+    return await asyncio.gather(*[
+        analyze_horse_with_ai_async(horses, async_client, limiter, semaphore, fallback)
+        for horses in races
+    ])
+
+async def analyze_card_with_ai_async(races, concurrency=AI_CONCURRENCY,
+                                     requests_per_minute=AI_REQUESTS_PER_MINUTE,
+                                     tokens_per_minute=AI_TOKENS_PER_MINUTE, fallback='equal'):
+    """
+    Analysera alla lopp samtidigt. Returnerar en ranking per lopp i samma ordning.
+    """
+    limiter = RateLimiter(requests_per_minute, tokens_per_minute)
+    semaphore = asyncio.Semaphore(concurrency)
+    
+    async with create_async_client() as async_client:
+        return await rank_races_async(races, async_client, limiter, semaphore, fallback)
+
+@metrics.timed('ai_card_analysis')
+def analyze_card_with_ai(races, **limits):
+    """
+    Synkront gränssnitt för asynkron AI-analys av flera lopp
+    """
+    return asyncio.run(analyze_card_with_ai_async(races, **limits))
+
+# Ensemble av AI-svar
+#
+# Vid temperatur AI_TEMPERATURE skiljer sig procentsatserna mellan anrop. Med
+# --ai-samples N får varje lopp upp till N anrop, inom samma gränser för
+# samtidighet, anrop och tokens, och svaren medelvärdesbildas i den ordning de
+# blir klara efter samma tolkning och normalisering som ett enskilt svar.
+# Först skickas AI_ENSEMBLE_MIN_SAMPLES anrop samtidigt för alla lopp, så en
+# omgång tar ungefär lika lång tid som med ett anrop per lopp. Är medelfelet
+# för någon hästs medelvärde fortfarande större än toleransen skickas
+# resten samtidigt, och så fort medelvärdet är stabilt avbryts de som
+# återstår: anrop som väntar på kvoten skickas aldrig och pågående strömmar
+# stängs. Spridningen (standardavvikelsen mellan svaren) redovisas per häst.
+# Varje svar sparas i AI-cachen under sitt eget nummer, så en omkörning ger
+# samma ensemble.
+
+AI_ENSEMBLE_SAMPLES = 1          # Anrop per lopp, 1 stänger av ensemblen
+AI_ENSEMBLE_MIN_SAMPLES = 3      # Svar som krävs innan ensemblen kan avslutas
+AI_ENSEMBLE_TOLERANCE = 2.0      # Största medelfel i procentenheter för ett stabilt medelvärde
+
+class RankingConsensus:
+    """Löpande medelvärde och spridning av flera AI-rankingar för ett lopp"""
+    def __init__(self, horses_data, min_samples=AI_ENSEMBLE_MIN_SAMPLES, tolerance=AI_ENSEMBLE_TOLERANCE):
+        self.horses_data = horses_data
+        self.positions = {horse['start_number']: index for index, horse in enumerate(horses_data)}
+        self.min_samples = min_samples
+        self.tolerance = tolerance
+        self.samples = []
+        self.summary = None
+    
+    def add(self, ranking):
+        """Lägg till en tolkad ranking. Hästar som saknas i svaret räknas som 0 %."""
+        percentages = np.zeros(len(self.horses_data))
+        for horse in ranking['horses']:
+            index = self.positions.get(horse.get('start_number'))
+            if index is not None:
+                percentages[index] = horse.get('calculated_percentage', 0)
+        total = percentages.sum()
+        if total <= 0:
+            return
+        self.samples.append(percentages * 100 / total)
+        if self.summary is None:
+            self.summary = ranking.get('analysis_summary')
+    
+    def dispersion(self):
+        """Standardavvikelse per häst mellan svaren"""
+        if len(self.samples) < 2:
+            return np.zeros(len(self.horses_data))
+        return np.std(self.samples, axis=0, ddof=1)
+    
+    def standard_error(self):
+        """Största medelfelet för en hästs medelvärde"""
+        if len(self.samples) < 2:
+            return float('inf')
+        return float(self.dispersion().max() / np.sqrt(len(self.samples)))
+    
+    def stable(self):
+        return len(self.samples) >= self.min_samples and self.standard_error() <= self.tolerance
+    
+    def ranking(self):
+        """Medelvärdet i samma format som en enskild ranking, med spridning per häst"""
+        mean = np.mean(self.samples, axis=0)
+        return {
+            "horses": [
+                {
+                    "name": horse['name'],
+                    "start_number": horse['start_number'],
+                    "calculated_percentage": float(percentage),
+                    "dispersion": float(dispersion)
+                }
+                for horse, percentage, dispersion in zip(self.horses_data, mean, self.dispersion())
+            ],
+            "analysis_summary": f"{self.summary or 'AI-analys'} (medel av {len(self.samples)} svar)"
+        }
+
+class AIEnsemble:
+    """Ensemble av AI-anrop per lopp, inställd från --ai-samples och --ai-tolerance"""
+    def __init__(self, samples=AI_ENSEMBLE_SAMPLES, min_samples=AI_ENSEMBLE_MIN_SAMPLES,
+                 tolerance=AI_ENSEMBLE_TOLERANCE):
+        self.samples = samples
+        self.min_samples = min_samples
+        self.tolerance = tolerance
+    
+    async def rank_async(self, messages, horses_data, async_client, limiter, semaphore):
+        """
+        Skicka anropen för ett lopp i två omgångar och medelvärdesbilda svaren
+        tills medelvärdet är stabilt. Returnerar (ranking, fält för körloggen),
+        där rankingen är None om inget svar gick att använda.
+        """
+        first_wave = min(self.min_samples, self.samples)
+        consensus = RankingConsensus(horses_data, first_wave, self.tolerance)
+        keys = {}
+        
+        def launch(samples):
+            tasks = set()
+            for sample in samples:
+                key = ai_cache.make_key(AI_MODEL, messages, AI_TEMPERATURE, horses_data, sample)
+                task = asyncio.ensure_future(
+                    request_ai_ranking_async(messages, horses_data, async_client, limiter, semaphore, key)
+                )
+                keys[task] = key
+                tasks.add(task)
+            return tasks
+        
+        pending, responses, from_cache = launch(range(first_wave)), [], 0
+        try:
+            while pending and not consensus.stable():
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    try:
+                        parsed_response, full_response, cached = task.result()
+                    except Exception as e:
+                        print(f"Fel vid AI-analys: {e}")
+                        metrics.record_error('ai_analysis', e)
+                        continue
+                    if is_fallback_ranking(parsed_response):
+                        continue
+                    if not cached:
+                        ai_cache.put(keys[task], full_response, AI_MODEL)
+                    consensus.add(parsed_response)
+                    responses.append(full_response)
+                    from_cache += cached
+                if not pending and len(keys) < self.samples and not consensus.stable():
+                    pending = launch(range(len(keys), self.samples))
+        finally:
+            for task in pending:
+                task.cancel()
+            if pending:
+                await asyncio.gather(*pending, return_exceptions=True)
+        
+        metrics.increment('ai_ensemble_samples', len(consensus.samples))
+        metrics.increment('ai_ensemble_cancelled', len(pending))
+        if pending:
+            metrics.increment('ai_ensemble_early_stops')
+        fields = {
+            'responses': responses,
+            'from_cache': from_cache,
+            'samples': len(consensus.samples),
+            'cancelled': len(pending),
+            'standard_error': consensus.standard_error() if consensus.samples else None,
+        }
+        if not consensus.samples:
+            return None, fields
+        return consensus.ranking(), fields
+
+# Delade inställningar för ensemble av AI-svar
+ai_ensemble = AIEnsemble()
+
+# Lokal sannolikhetsmodell
+#
+# Conditional logit: varje häst får nyttan koefficienter · delpoäng och
+# vinstchansen inom loppet är softmax över fältet. Ger deterministiska
+# procentsatser utan nätverksanrop, i samma format som AI-rankingen.
+
+# Koefficienter per delpoäng, skalade vikter från total_score
+LOCAL_MODEL_SCALE = 0.8
+LOCAL_MODEL_PARAMS = {
+    'features': list(TOTAL_SCORE_WEIGHTS),
+    'coefficients': [weight * LOCAL_MODEL_SCALE for weight in TOTAL_SCORE_WEIGHTS.values()],
+}
+LOCAL_MODEL_SUMMARY = "Lokal modell (conditional logit över delpoängen)"
+
+# Val av rankingmotor och fallback
+RANKING_ENGINES = ('ai', 'local')
+RANKING_FALLBACKS = ('equal', 'local')
+
+def softmax(utilities, axis=-1):
+    """Numeriskt stabil softmax"""
+    utilities = np.asarray(utilities, dtype=float)
+    shifted = utilities - np.max(utilities, axis=axis, keepdims=True)
+    exp = np.exp(shifted)
+    return exp / exp.sum(axis=axis, keepdims=True)
+
+def local_win_probabilities(horses, params=None):
+    """
+    Vinstsannolikhet per häst inom loppet (summerar till 1)
+    """
+    params = params or scoring_params.local_model
+    records = as_horse_table(horses).records
+    features = np.column_stack([records[feature] for feature in params['features']]).astype(float)
+    utilities = features @ np.asarray(params['coefficients'], dtype=float)
+    return softmax(utilities)
+
+@metrics.timed('local_model')
+def analyze_horse_with_local_model(horses, params=None):
+    """
+    Ranka hästar med den lokala modellen, i samma format som analyze_horse_with_ai
+    """
+    table = as_horse_table(horses)
+    percentages = local_win_probabilities(table, params) * 100
+    return {
+        "horses": [
+            {
+                "name": name,
+                "start_number": start_number,
+                "calculated_percentage": percentage
+            }
+            for name, start_number, percentage in zip(
+                table.horse_names(),
+                table.records['start_number'].tolist(),
+                percentages.tolist()
+            )
+        ],
+        "analysis_summary": LOCAL_MODEL_SUMMARY
+    }
+
+def fallback_for(horses, fallback='equal'):
+    """
+    Fallback-ranking när AI-analysen misslyckas: jämn fördelning eller lokal modell
+    """
+    metrics.increment('ai_fallbacks')
+    table = as_horse_table(horses)
+    if fallback == 'local':
+        try:
+            return analyze_horse_with_local_model(table)
+        except Exception as e:
+            print(f"Fel i lokal modell: {e}")
+    return fallback_ranking([
+        {"name": name, "start_number": start_number}
+        for name, start_number in zip(table.horse_names(), table.records['start_number'].tolist())
+    ])
+
+def rank_horses(horses, engine='ai', fallback='equal'):
+    """
+    Ranka hästarna i ett lopp med vald motor
+    """
+    if engine == 'local':
+        return analyze_horse_with_local_model(horses)
+    return analyze_horse_with_ai(horses, fallback=fallback)
+
+def analyze_race(race_csv_path, spelprocent_json_path, banstatistik_json_path=None,
+                 engine='ai', fallback='equal'):
+    """
+    Huvudfunktion för att analysera ett lopp
+    """
+    # Läs in data
+    horses_df, betting_data, race_number = load_horse_data(race_csv_path, spelprocent_json_path)
+    
+    # Läs in och kompilera banstatistik om tillgänglig
+    track_data = get_track_index(load_track_data(banstatistik_json_path))
+    
+    if horses_df is None:
+        print("Kunde inte läsa in hästdata.")
+        return None
+    
+    return analyze_loaded_race(horses_df, betting_data, race_number, track_data, race_csv_path, engine, fallback)
+
+def analyze_loaded_race(horses_df, betting_data, race_number, track_data, race_csv_path,
+                        engine='ai', fallback='equal'):
+    """
+    Analysera ett lopp vars filer redan lästs in. horses_df får kolumnen
+    track om banan bara framgår av filnamnet.
+    """
+    detect_track(horses_df, race_csv_path, track_data)
+    
+    # Beräkna och sortera efter spelvärde
+    result_df = calculate_betting_value(horses_df, betting_data, race_number, track_data)
+    
+    # AI-ranking (eller lokal modell) och jämförelse på kompakta poster
+    horses = HorseTable.from_frame(result_df, race_number=race_number)
+    ai_ranking = rank_horses(horses, engine, fallback)
+    
+    # Jämför AI-ranking med spelade procent
+    if ai_ranking:
+        compare_ai_ranking_with_betting_percentages(ai_ranking, horses)
+    
+    return result_df
+
+@metrics.timed('calculate_betting_value')
+def calculate_betting_value(horses_df, betting_data, race_number, track_data=None):
+    """
+    Beräkna spelvärde för hästar. Returnerar en ny DataFrame, horses_df ändras inte.
+    """
+    # Beräkna delpoäng kolumnvis, eller hämta dem från cachen. Med
+    # hästhistorik räknas form och distans även på äldre lopp.
+    with metrics.profile():
+        scores = feature_cache.scores(history_store.extend(horses_df), track_data)
+    
+    # Beräkna totalvärde
+    total_score = sum(scores[column] * weight for column, weight in scoring_params.total_score_weights.items())
+    
+    # Lägg till poängen i en ny DataFrame
+    columns = {**scores, 'total_score': total_score}
+    replaced = [column for column in columns if column in horses_df.columns]
+    if replaced:
+        horses_df = horses_df.drop(columns=replaced)
+    horses_df = pd.concat([horses_df, pd.DataFrame(columns, index=horses_df.index)], axis=1)
+    
+    # Lägg till spelprocentar
+    horses_df = calculate_betting_percentages(horses_df, betting_data, race_number)
+    
+    # Sortera efter totalvärde
+    result_df = horses_df.sort_values('total_score', ascending=False)
+    
+    return result_df
+
+# Poängparametrar
+#
+# Vikterna för total_score, poängtabellen för placeringar, toleransen för
+# distansgrupperna och den lokala modellens koefficienter. Standardvärdena är
+# konstanterna ovan. `spelvarde.py fit` anpassar dem mot historiska resultat
+# och sparar dem som JSON, som läses in med --params.
+
+SCORING_PARAMS_VERSION = 1
+
+class ScoringParams:
+    """Aktiva poängparametrar, standardvärden tills en parameterfil lästs in"""
+    def __init__(self):
+        self.reset()
+    
+    def reset(self):
+        self.path = None
+        self.total_score_weights = dict(TOTAL_SCORE_WEIGHTS)
+        self.placement_points = PLACEMENT_POINTS
+        self.distance_tolerance = DISTANCE_TOLERANCE
+        self.local_model = LOCAL_MODEL_PARAMS
+        self.fit = None
+    
+    def to_dict(self):
+        return {
+            'version': SCORING_PARAMS_VERSION,
+            'total_score_weights': self.total_score_weights,
+            'placement_points': list(self.placement_points),
+            'distance_tolerance': self.distance_tolerance,
+            'local_model': self.local_model,
+            'fit': self.fit,
+        }
+    
+    def update(self, params):
+        """Ta över värden ur en dict i samma format som to_dict(). Ogiltiga värden ger ValueError."""
+        weights = params.get('total_score_weights', self.total_score_weights)
+        if set(weights) != set(FEATURE_COLUMNS):
+            raise ValueError(f"total_score_weights måste ha vikter för {', '.join(FEATURE_COLUMNS)}")
+        points = tuple(float(value) for value in params.get('placement_points', self.placement_points))
+        if len(points) != len(PLACEMENT_POINTS):
+            raise ValueError(f"placement_points måste ha {len(PLACEMENT_POINTS)} värden")
+        local_model = params.get('local_model', self.local_model)
+        if (len(local_model['features']) != len(local_model['coefficients'])
+                or not set(local_model['features']) <= set(FEATURE_COLUMNS)):
+            raise ValueError("local_model måste ha en koefficient per känd delpoäng")
+        
+        self.total_score_weights = {column: float(weight) for column, weight in weights.items()}
+        self.placement_points = points
+        self.distance_tolerance = float(params.get('distance_tolerance', self.distance_tolerance))
+        self.local_model = {
+            'features': list(local_model['features']),
+            'coefficients': [float(value) for value in local_model['coefficients']],
+        }
+        self.fit = params.get('fit', self.fit)
+    
+    def load(self, path):
+        with open(path, 'r', encoding='utf-8') as f:
+            params = json.load(f)
+        if params.get('version') != SCORING_PARAMS_VERSION:
+            raise ValueError(f"Version {params.get('version')} av parameterfilen stöds inte")
+        self.update(params)
+        self.path = path
+    
+    def save(self, path):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        with open(path, 'w', encoding='utf-8') as f:
+            json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+
+# Delade poängparametrar, från --params
+scoring_params = ScoringParams()
+
+# Kompakta hästposter
+#
+# Efter poängsättningen behövs bara ett fåtal fält per häst. HorseTable håller
+# dem i en strukturerad NumPy-array (int8 startnummer, float32 poäng) med namn
+# och lopp som koder mot delade listor, i stället för en DataFrame med alla
+# CSV-kolumner. Ranking, prompter, jämförelse, backtest och batchresultat
+# arbetar direkt på arrayen. float32 räcker gott för poäng som avrundas till
+# två decimaler.
+
+HORSE_SCORE_COLUMNS = FEATURE_COLUMNS + ('total_score', 'betting_percentage', 'ai_percentage', 'ai_dispersion',
+                                         'deviation')
+
+@functools.lru_cache(maxsize=None)
+def horse_dtype():
+    """Fälten i en hästpost"""
+    return np.dtype(
+        [('race', np.int32), ('start_number', np.int8), ('name', np.int32), ('earnings', np.float64)]
+        + [(column, np.float32) for column in HORSE_SCORE_COLUMNS]
+    )
+
+class HorseTable:
+    """
+    Hästar från ett eller flera lopp som en strukturerad array med horse_dtype().
+    Fältet name indexerar names och fältet race indexerar races, en lista med
+    (omgång, loppnummer). Startnummer som inte går att tolka lagras som -1.
+    """
+    __slots__ = ('records', 'names', 'races')
+    
+    def __init__(self, records, names, races):
+        self.records = records
+        self.names = names
+        self.races = races
+    
+    @classmethod
+    def from_frame(cls, horses_df, card=None, race_number=None):
+        """Kompakt kopia av ett poängsatt lopp"""
+        records = np.zeros(len(horses_df), dtype=horse_dtype())
+        start_numbers = pd.to_numeric(horses_df['start_number'], errors='coerce').to_numpy(dtype=float)
+        valid = (start_numbers >= 0) & (start_numbers <= np.iinfo(np.int8).max) & (start_numbers % 1 == 0)
+        records['start_number'] = np.where(valid, start_numbers, -1)
+        codes, names = pd.factorize(horses_df['name'], use_na_sentinel=False)
+        records['name'] = codes
+        records['earnings'] = pd.to_numeric(_column(horses_df, 'earnings', np.nan), errors='coerce')
+        for column in HORSE_SCORE_COLUMNS:
+            records[column] = _column(horses_df, column, np.nan).to_numpy(dtype=float)
+        
+        if card is None:
+            card = _race_context(horses_df, 'card')
+        if race_number is None:
+            race_number = _race_context(horses_df, 'race_number')
+        return cls(records, names.tolist(), [(card, race_number)])
+    
+    @classmethod
+    def concat(cls, tables):
+        """Slå ihop tabeller, namn och lopp kodas om mot gemensamma listor"""
+        names, name_codes, races, parts = [], {}, [], []
+        for table in tables:
+            records = table.records.copy()
+            remap = []
+            for name in table.names:
+                if name not in name_codes:
+                    name_codes[name] = len(names)
+                    names.append(name)
+                remap.append(name_codes[name])
+            if len(records):
+                records['name'] = np.asarray(remap, dtype=np.int32)[records['name']]
+            records['race'] += len(races)
+            races.extend(table.races)
+            parts.append(records)
+        records = np.concatenate(parts) if parts else np.zeros(0, dtype=horse_dtype())
+        return cls(records, names, races)
+    
+    def __len__(self):
+        return len(self.records)
+    
+    def horse_names(self):
+        """Hästnamnen i postordning"""
+        return [self.names[code] for code in self.records['name'].tolist()]
+    
+    def to_frame(self):
+        """DataFrame med kolumnerna i BATCH_COLUMNS (AI-kolumner bara om hästarna rankats)"""
+        records = self.records
+        race = records['race']
+        data = {
+            'card': [self.races[i][0] for i in race.tolist()],
+            'race_number': [self.races[i][1] for i in race.tolist()],
+            'start_number': records['start_number'],
+            'name': pd.Categorical.from_codes(records['name'], categories=pd.Index(self.names, dtype=object)),
+        }
+        ranked = not np.isnan(records['ai_percentage']).all()
+        for column in HORSE_SCORE_COLUMNS:
+            if column == 'ai_dispersion':
+                # Spridning finns bara när en ensemble av AI-svar använts
+                if not np.isnan(records[column]).all():
+                    data[column] = records[column]
+            elif ranked or column not in ('ai_percentage', 'deviation'):
+                data[column] = records[column]
+        if ranked:
+            data['status'] = deviation_statuses(records['deviation'])
+        return pd.DataFrame(data)
+
+def as_horse_table(horses):
+    """HorseTable oförändrad, eller en kompakt kopia av ett poängsatt lopp"""
+    if isinstance(horses, HorseTable):
+        return horses
+    return HorseTable.from_frame(horses)
+
+def deviation_statuses(deviations):
+    """deviation_status för en hel array av avvikelser"""
+    deviations = np.asarray(deviations)
+    return np.select([deviations > 1, deviations < -1], ['Överspelad', 'Underspelad'], 'Normal')
+
+# Batchläge
+#
+# Analyserar hela V75-omgångar (eller kataloger med många historiska omgångar)
+# utan interaktiva val. Poängberäkningen sprids över en processpool och
+# resultatet skrivs till en samlad fil.
+
+# Kolumner som skrivs till den samlade resultatfilen
+BATCH_COLUMNS = [
+    'card', 'race_number', 'start_number', 'name',
+    'form_score', 'career_score',
+    'distance_1640_score', 'distance_2140_score', 'distance_2640_score',
+    'track_position_score', 'total_score', 'betting_percentage',
+    'ai_percentage', 'ai_dispersion', 'deviation', 'status'
+]
+
+# Kompilerad banstatistik per arbetsprocess, delas av alla lopp i en omgång
+_worker_track_indexes = {}
+
+def _init_score_worker(track_indexes):
+    """Ta emot kompilerad banstatistik en gång per arbetsprocess"""
+    _worker_track_indexes.update(track_indexes)
+
+def find_race_csv_files(directory):
+    """Hitta "Lopp N"-filer i en katalog, sorterade efter loppnummer"""
+    races = []
+    for filename in os.listdir(directory):
+        match = re.search(r'Lopp\s*(\d+)', filename, re.IGNORECASE)
+        if match and filename.lower().endswith('.csv'):
+            races.append((int(match.group(1)), os.path.join(directory, filename)))
+    return [path for _, path in sorted(races)]
+
+def is_result_file(filename):
+    """Sant för resultatfiler (t.ex. resultat.json)"""
+    return 'resultat' in filename.lower()
+
+def iter_race_cards(root, spelprocent_path=None, banstatistik_path=None):
+    """
+    Gå igenom alla omgångar under en katalog, en i taget.
+    Varje katalog med "Lopp N"-filer räknas som en omgång. Spelprocent- och
+    banstatistikfil tas från argumenten, annars från JSON-filer i samma katalog.
+    En eventuell resultatfil (namn med "resultat") tas med för backtest.
+    """
+    for directory, _, filenames in sorted(os.walk(root)):
+        race_files = find_race_csv_files(directory)
+        if not race_files:
+            continue
+        
+        json_files = sorted(f for f in filenames if f.lower().endswith('.json'))
+        card_spelprocent = spelprocent_path or next(
+            (os.path.join(directory, f) for f in json_files if 'spelprocent' in f.lower()), None
+        )
+        card_banstatistik = banstatistik_path or next(
+            (os.path.join(directory, f) for f in json_files
+             if 'spelprocent' not in f.lower() and not is_result_file(f)), None
+        )
+        card_results = next(
+            (os.path.join(directory, f) for f in json_files if is_result_file(f)), None
+        )
+        
+        if not card_spelprocent:
+            print(f"Varning: Ingen spelprocentfil för {directory}, hoppar över.")
+            continue
+        
+        yield {
+            'card': os.path.relpath(directory, root),
+            'races': race_files,
+            'spelprocent': card_spelprocent,
+            'banstatistik': card_banstatistik,
+            'resultat': card_results
+        }
+
+def find_race_cards(root, spelprocent_path=None, banstatistik_path=None):
+    """Alla omgångar under en katalog som lista"""
+    return list(iter_race_cards(root, spelprocent_path, banstatistik_path))
+
+def score_race_job(job):
+    """
+    Poängsätt ett lopp i en arbetsprocess.
+    job är en tuple (omgång, CSV-fil, spelprocentfil, banstatistikfil).
+    """
+    card, race_csv_path, spelprocent_path, banstatistik_path = job
+    
+    horses_df, betting_data, race_number = load_horse_data(race_csv_path, spelprocent_path)
+    if horses_df is None:
+        return None
+    
+    if banstatistik_path not in _worker_track_indexes:
+        _worker_track_indexes[banstatistik_path] = get_track_index(load_track_data(banstatistik_path))
+    track_index = _worker_track_indexes[banstatistik_path]
+    detect_track(horses_df, race_csv_path, track_index)
+    
+    result_df = calculate_betting_value(horses_df, betting_data, race_number, track_index)
+    return HorseTable.from_frame(result_df, card, race_number)
+
+def score_race_job_with_metrics(job):
+    """score_race_job som även returnerar arbetsprocessens mätvärden och delpoäng för jobbet"""
+    metrics.reset()
+    return score_race_job(job), metrics.export_raw(), feature_cache.export_pending()
+
+def add_ranking_columns(horses, ai_ranking):
+    """Lägg till AI-procent och avvikelse per häst i en HorseTable"""
+    ai_percentages = {
+        horse['start_number']: horse.get('calculated_percentage', 0)
+        for horse in ai_ranking['horses']
+    }
+    horses.records['ai_percentage'] = [
+        ai_percentages.get(start_number, 0) for start_number in horses.records['start_number'].tolist()
+    ]
+    # Spridning mellan svaren när rankingen är ett medel av flera AI-svar
+    dispersions = {
+        horse['start_number']: horse['dispersion']
+        for horse in ai_ranking['horses'] if 'dispersion' in horse
+    }
+    if dispersions:
+        horses.records['ai_dispersion'] = [
+            dispersions.get(start_number, np.nan) for start_number in horses.records['start_number'].tolist()
+        ]
+    return update_deviation(horses)
+
+def update_betting_percentages(horses, betting_data, race_number):
+    """Sätt spelprocent i en HorseTable, som calculate_betting_percentages"""
+    betting_percentages = betting_percentage_lookup(betting_data, race_number) or {}
+    default_percentage = 100 / len(horses)
+    horses.records['betting_percentage'] = [
+        betting_percentages.get(start_number, default_percentage)
+        for start_number in horses.records['start_number'].tolist()
+    ]
+    return horses
+
+def update_deviation(horses):
+    """Räkna om avvikelsen från AI-procent och spelprocent (status följer av avvikelsen)"""
+    records = horses.records
+    records['deviation'] = records['ai_percentage'] - records['betting_percentage']
+    return horses
+
+def write_batch_results(results_df, output_path):
+    """Skriv samlat resultat som CSV eller JSON beroende på filändelse"""
+    directory = os.path.dirname(output_path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    
+    columns = [c for c in BATCH_COLUMNS if c in results_df.columns]
+    if output_path.lower().endswith('.json'):
+        results_df[columns].to_json(output_path, orient='records', force_ascii=False, indent=2)
+    else:
+        results_df[columns].to_csv(output_path, index=False)
+
+def rank_batch_tables(tables, engine='ai', fallback='equal', ai_limits=None):
+    """Ranka poängsatta lopp och lägg till AI-procent och avvikelse, AI-anropen för alla lopp samtidigt"""
+    if engine == 'local':
+        rankings = [analyze_horse_with_local_model(table) for table in tables]
+    else:
+        rankings = analyze_card_with_ai(tables, fallback=fallback, **(ai_limits or {}))
+    for table, ai_ranking in zip(tables, rankings):
+        add_ranking_columns(table, ai_ranking)
+    return tables
+
+def run_batch(root, spelprocent_path=None, banstatistik_path=None, output_path='resultat.csv',
+              workers=None, use_ai=True, ai_limits=None, engine='ai', fallback='equal'):
+    """
+    Analysera alla omgångar under root och skriv ett samlat resultat
+    """
+    cards = find_race_cards(root, spelprocent_path, banstatistik_path)
+    jobs = [
+        (card['card'], race_csv_path, card['spelprocent'], card['banstatistik'])
+        for card in cards
+        for race_csv_path in card['races']
+    ]
+    
+    if not jobs:
+        print("Inga lopp hittades.")
+        return None
+    
+    print(f"Analyserar {len(jobs)} lopp i {len(cards)} omgångar...")
+    
+    # Kompilera varje banstatistikfil en gång
+    track_indexes = {
+        path: get_track_index(load_track_data(path))
+        for path in {card['banstatistik'] for card in cards}
+    }
+    
+    # Poängsätt alla lopp parallellt. Vid profilering (eller workers=0) körs
+    # poängberäkningen i huvudprocessen så att profilen täcker den.
+    # Arbetsprocesserna returnerar kompakta HorseTable-poster.
+    with metrics.stage('batch_scoring'):
+        if workers == 0 or metrics.profiler is not None:
+            _init_score_worker(track_indexes)
+            results = [table for table in map(score_race_job, jobs) if table is not None]
+        else:
+            with futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_score_worker,
+                                             initargs=(track_indexes,)) as executor:
+                chunksize = max(1, len(jobs) // ((workers or os.cpu_count() or 1) * 4))
+                results = []
+                for table, raw, features in executor.map(score_race_job_with_metrics, jobs,
+                                                         chunksize=chunksize):
+                    metrics.merge_raw(raw)
+                    feature_cache.merge_pending(features)
+                    if table is not None:
+                        results.append(table)
+    
+    if not results:
+        print("Inga lopp kunde analyseras.")
+        return None
+    
+    # Ranking görs i huvudprocessen, AI-anropen för alla lopp samtidigt
+    if use_ai:
+        rank_batch_tables(results, engine, fallback, ai_limits)
+        if engine != 'local':
+            print(ai_cache.summary())
+    
+    results_df = HorseTable.concat(results).to_frame()
+    write_batch_results(results_df, output_path)
+    print(f"Resultat för {len(results)} lopp sparat i: {output_path}")
+    
+    return results_df
+
+# Strömmande batch
+#
+# `batch --stream` går igenom omgångarna med en generator och poängsätter
+# loppen i block om ett fast antal. Varje block rankas och skrivs direkt till
+# resultatfilen, så bara blocket som skrivs och nästa block i poolen finns i
+# minnet, oavsett hur många säsonger katalogen innehåller. Banstatistiken
+# kompileras i arbetsprocesserna när den först behövs, och delpoängscachen
+# sparas med jämna mellanrum så att den hålls inom sina gränser.
+
+STREAM_CHUNK_RACES = 200
+STREAM_CACHE_SAVE_CHUNKS = 10   # Spara delpoängscachen efter så många block
+
+def iter_race_jobs(root, spelprocent_path=None, banstatistik_path=None):
+    """Poängsättningsjobb för alla lopp under root, en omgång i taget"""
+    for card in iter_race_cards(root, spelprocent_path, banstatistik_path):
+        for race_csv_path in card['races']:
+            yield card['card'], race_csv_path, card['spelprocent'], card['banstatistik']
+
+def iter_chunks(items, size):
+    """Dela upp en iterator i listor om högst size element"""
+    chunk = []
+    for item in items:
+        chunk.append(item)
+        if len(chunk) >= size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+class BatchResultWriter:
+    """
+    Skriver batchresultat block för block, som CSV eller som JSON-lista
+    beroende på filändelse. Kolumnerna bestäms av första blocket.
+    """
+    def __init__(self, output_path):
+        directory = os.path.dirname(output_path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.json = output_path.lower().endswith('.json')
+        self.file = open(output_path, 'w', encoding='utf-8', newline='')
+        self.columns = None
+        self.rows = 0
+    
+    def write(self, results_df):
+        if self.columns is None:
+            self.columns = [c for c in BATCH_COLUMNS if c in results_df.columns]
+        block = results_df.reindex(columns=self.columns)
+        if self.json:
+            if len(block):
+                # Samma format som write_batch_results: blockets lista utan
+                # "[\n" och "\n]", posterna skiljda med ",\n"
+                records = block.to_json(orient='records', force_ascii=False, indent=2)[2:-2]
+                self.file.write((',\n' if self.rows else '[\n') + records)
+        else:
+            block.to_csv(self.file, header=self.rows == 0, index=False)
+        self.rows += len(block)
+        self.file.flush()
+    
+    def close(self):
+        if self.json:
+            self.file.write('\n]' if self.rows else '[\n\n]')
+        self.file.close()
+
+def _score_chunk(executor, jobs, workers):
+    """
+    Lämna ett block till poolen. Returnerar en iterator över (tabell, mätvärden, delpoäng).
+    Utan pool körs score_race_job direkt; mätvärdena hamnar då redan i metrics.
+    """
+    if executor is None:
+        return ((score_race_job(job), None, None) for job in jobs)
+    return executor.map(score_race_job_with_metrics, jobs, chunksize=max(1, len(jobs) // (workers * 4)))
+
+def _write_chunk(writer, scored, engine, fallback, use_ai, ai_limits):
+    """Samla ett poängsatt block, ranka det och skriv det. Returnerar (lopp, hästar)."""
+    tables = []
+    for table, raw, features in scored:
+        if raw is not None:
+            metrics.merge_raw(raw)
+            feature_cache.merge_pending(features)
+        if table is not None:
+            tables.append(table)
+    if not tables:
+        return 0, 0
+    if use_ai:
+        rank_batch_tables(tables, engine, fallback, ai_limits)
+    horses = HorseTable.concat(tables)
+    writer.write(horses.to_frame())
+    return len(tables), len(horses)
+
+def run_batch_stream(root, spelprocent_path=None, banstatistik_path=None, output_path='resultat.csv',
+                     workers=None, use_ai=True, ai_limits=None, engine='ai', fallback='equal',
+                     chunk_races=STREAM_CHUNK_RACES):
+    """
+    Analysera alla omgångar under root block för block och skriv resultatet
+    löpande. Returnerar antal analyserade lopp och hästar.
+    """
+    workers = os.cpu_count() or 1 if workers is None else workers
+    chunks = iter_chunks(iter_race_jobs(root, spelprocent_path, banstatistik_path), chunk_races)
+    writer = BatchResultWriter(output_path)
+    totals = {'chunks': 0, 'races': 0, 'horses': 0}
+    start = finished = time.perf_counter()
+    
+    def finish(scored, size, submitted):
+        # Ett blocks tid räknas från att det lämnades till poolen, eller från
+        # att föregående block blev klart om det kom senare
+        nonlocal finished
+        started = max(submitted, finished)
+        races, horses = _write_chunk(writer, scored, engine, fallback, use_ai, ai_limits)
+        finished = time.perf_counter()
+        seconds = finished - started
+        totals['chunks'] += 1
+        totals['races'] += races
+        totals['horses'] += horses
+        metrics.record_stage('stream_chunk', seconds)
+        metrics.increment('stream_races', races)
+        print(f"Block {totals['chunks']}: {races}/{size} lopp, {horses} hästar på {seconds:.2f} s "
+              f"({races / max(seconds, 1e-9):.0f} lopp/s), totalt {totals['races']} lopp")
+        if totals['chunks'] % STREAM_CACHE_SAVE_CHUNKS == 0:
+            feature_cache.save()
+    
+    # Poängsättning i huvudprocessen vid profilering eller workers=0, annars
+    # ligger nästa block i poolen medan föregående rankas och skrivs
+    in_process = workers == 0 or metrics.profiler is not None
+    try:
+        with contextlib.ExitStack() as stack:
+            executor = None
+            if not in_process:
+                executor = stack.enter_context(futures.ProcessPoolExecutor(
+                    max_workers=workers, initializer=_init_score_worker, initargs=({},)
+                ))
+            pending = collections.deque()
+            for jobs in chunks:
+                pending.append((_score_chunk(executor, jobs, workers), len(jobs), time.perf_counter()))
+                if in_process or len(pending) > 1:
+                    finish(*pending.popleft())
+            while pending:
+                finish(*pending.popleft())
+    finally:
+        writer.close()
+    
+    if not totals['races']:
+        print("Inga lopp kunde analyseras.")
+        return None
+    
+    seconds = time.perf_counter() - start
+    if use_ai and engine != 'local':
+        print(ai_cache.summary())
+    print(f"Resultat för {totals['races']} lopp i {totals['chunks']} block sparat i: {output_path} "
+          f"({totals['races'] / max(seconds, 1e-9):.0f} lopp/s)")
+    return totals
+
+# V75-systemoptimering
+#
+# Söker det system (urval av hästar per lopp) som ger störst förväntat
+# överskott för 7 rätt inom en radbudget. Utdelningen för en vinnande rad är
+# omvänt proportionell mot andelen spelade rader på samma kombination, så
+# förväntad utdelning för ett system faktoriserar per lopp:
+#
+#   E[utdelning] = pott * radpris * prod_lopp( sum_valda p / q )
+#
+# där p är modellens sannolikhet och q spelad procent. För ett givet antal
+# hästar i ett lopp är det därför optimalt att ta hästarna med högst p/q.
+# Kvar är att välja antal hästar per lopp, vilket görs med dynamisk
+# programmering över radantal i logaritmisk skala, där dominerade tillstånd
+# (fler rader utan högre värde) rensas bort efter varje lopp.
+
+V75_ROW_PRICE = 0.5       # Kronor per rad
+V75_PAYOUT_RATE = 0.65    # Andel av omsättningen som betalas tillbaka
+V75_POOL_SHARES = {7: 0.40, 6: 0.20, 5: 0.40}  # Fördelning av utdelningen per vinstgrupp
+V75_RACES = 7
+
+def race_probabilities(result_df, model_column='ai_percentage'):
+    """
+    Startnummer, modellsannolikhet och spelad andel för ett lopp, normaliserade till 1
+    """
+    model = result_df[model_column].to_numpy(dtype=float)
+    public = result_df['betting_percentage'].to_numpy(dtype=float)
+    model = np.clip(model, 0, None)
+    public = np.clip(public, 1e-6, None)
+    return {
+        'start_numbers': result_df['start_number'].to_numpy(),
+        'model': model / model.sum() if model.sum() > 0 else np.full(len(model), 1 / len(model)),
+        'public': public / public.sum()
+    }
+
+def card_probabilities(card_df, model_column='ai_percentage'):
+    """Sannolikheter för alla lopp i en omgång, sorterade efter loppnummer"""
+    return [
+        race_probabilities(race_df, model_column)
+        for _, race_df in sorted(card_df.groupby('race_number'), key=lambda item: item[0])
+    ]
+
+def optimize_v75_system(races, budget, row_price=V75_ROW_PRICE,
+                        payout_share=V75_PAYOUT_RATE * V75_POOL_SHARES[7]):
+    """
+    Bästa V75-system inom budget (kronor).
+    races är en lista med dicts från race_probabilities.
+    Returnerar en dict med urval per lopp, radantal, kostnad och förväntat utfall.
+    """
+    max_rows = int(budget // row_price)
+    if max_rows < 1:
+        raise ValueError("Budgeten räcker inte till en rad")
+    
+    # Per lopp: hästar sorterade efter p/q och log(summa p/q) för de k bästa
+    orders = []
+    log_values = []
+    for race in races:
+        ratio = race['model'] / race['public']
+        order = np.argsort(-ratio, kind='stable')
+        orders.append(order)
+        log_values.append(np.log(np.cumsum(ratio[order])))
+    
+    # dp[r] = bästa summa log-värden med exakt r rader, -inf om ej nåbart
+    dp = np.full(max_rows + 1, -np.inf)
+    dp[1] = 0.0
+    choices = []
+    
+    for log_value in log_values:
+        new_dp = np.full(max_rows + 1, -np.inf)
+        choice = np.zeros(max_rows + 1, dtype=int)
+        states = np.flatnonzero(np.isfinite(dp))
+        
+        for k in range(1, len(log_value) + 1):
+            reachable = states[states * k <= max_rows]
+            if not len(reachable):
+                break
+            targets = reachable * k
+            candidates = dp[reachable] + log_value[k - 1]
+            better = candidates > new_dp[targets]
+            new_dp[targets[better]] = candidates[better]
+            choice[targets[better]] = k
+        
+        # Rensa dominerade tillstånd: fler rader måste ge högre värde
+        best_so_far = np.maximum.accumulate(new_dp)
+        dominated = np.zeros(len(new_dp), dtype=bool)
+        dominated[1:] = new_dp[1:] <= best_so_far[:-1]
+        new_dp[dominated] = -np.inf
+        
+        dp = new_dp
+        choices.append(choice)
+    
+    # Välj radantal med störst förväntat överskott
+    rows = np.arange(max_rows + 1)
+    finite = np.isfinite(dp)
+    expected_return = np.where(finite, payout_share * row_price * np.exp(np.where(finite, dp, 0)), -np.inf)
+    expected_profit = expected_return - rows * row_price
+    best_rows = int(np.argmax(expected_profit))
+    
+    # Spåra tillbaka antal hästar per lopp
+    counts = []
+    remaining = best_rows
+    for choice in reversed(choices):
+        k = int(choice[remaining])
+        counts.append(k)
+        remaining //= k
+    counts.reverse()
+    
+    selections = [race['start_numbers'][order[:k]].tolist() for race, order, k in zip(races, orders, counts)]
+    hit_probability = float(np.prod([
+        race['model'][order[:k]].sum() for race, order, k in zip(races, orders, counts)
+    ]))
+    cost = best_rows * row_price
+    
+    return {
+        'selections': selections,
+        'rows': best_rows,
+        'cost': cost,
+        'hit_probability': hit_probability,
+        'expected_return': float(expected_return[best_rows]),
+        'expected_profit': float(expected_profit[best_rows]),
+        'edge': float(expected_return[best_rows] / cost)
+    }
+
+def print_v75_system(system):
+    """Skriv ut ett V75-system"""
+    print("\n=== V75-SYSTEM ===")
+    for race_number, selection in enumerate(system['selections'], 1):
+        print(f"  Avd {race_number}: {', '.join(str(number) for number in selection)}")
+    print(f"\nRader: {system['rows']}  Kostnad: {system['cost']:.2f} kr")
+    print(f"Sannolikhet för 7 rätt: {system['hit_probability'] * 100:.4f}%")
+    print(f"Förväntad utdelning (7 rätt): {system['expected_return']:.2f} kr")
+    print(f"Förväntat överskott: {system['expected_profit']:.2f} kr  (kvot {system['edge']:.2f})")
+
+def run_system(results_path, budget, card=None, model_column='ai_percentage'):
+    """
+    Optimera V75-system från en resultatfil från batchläget
+    """
+    if results_path.lower().endswith('.json'):
+        results_df = pd.read_json(results_path)
+    else:
+        results_df = pd.read_csv(results_path)
+    
+    if model_column not in results_df.columns:
+        print(f"Resultatfilen saknar kolumnen {model_column}. Kör batch med AI eller lokal modell.")
+        return None
+    
+    cards = results_df['card'].astype(str).unique().tolist()
+    card = str(card) if card is not None else cards[0]
+    card_df = results_df[results_df['card'].astype(str) == card]
+    if card_df.empty:
+        print(f"Omgången {card} finns inte i resultatfilen.")
+        return None
+    
+    races = card_probabilities(card_df, model_column)
+    if len(races) != V75_RACES:
+        print(f"Varning: Omgången {card} har {len(races)} lopp, inte {V75_RACES}.")
+    
+    system = optimize_v75_system(races, budget)
+    print(f"Omgång: {card}")
+    print_v75_system(system)
+    return system
+
+# Monte Carlo-simulering av V75
+#
+# Drar miljontals kompletta omgångar (en vinnare per lopp) enligt modellens
+# sannolikheter och räknar ut systemets antal rätt och utdelning. Utdelningen
+# per vinstgrupp skattas från spelad procent: andelen spelade rader med exakt
+# j rätt ges av ett polynom över loppen, och utdelningen per rad är pottens
+# andel delad med den andelen. Samma polynom räknar systemets egna rader.
+
+SIMULATION_BATCH_SIZE = 200000
+
+@functools.lru_cache(maxsize=None)
+def simulation_bins():
+    """Gränser för utbetalningshistogram (kr), logaritmiska upp till 100 miljoner"""
+    return np.concatenate([[0.0], np.logspace(-1, 8, 181), [np.inf]])
+
+def probability_matrices(races):
+    """Modell- och spelsannolikheter som matriser (lopp x häst), utfyllda med nollor"""
+    width = max(len(race['model']) for race in races)
+    model = np.zeros((len(races), width))
+    public = np.zeros((len(races), width))
+    for index, race in enumerate(races):
+        model[index, :len(race['model'])] = race['model']
+        public[index, :len(race['public'])] = race['public']
+    return model, public
+
+def selection_matrix(races, selections):
+    """Systemets urval som 0/1-matris (lopp x häst)"""
+    width = max(len(race['model']) for race in races)
+    selected = np.zeros((len(races), width))
+    for index, (race, selection) in enumerate(zip(races, selections)):
+        selected[index, :len(race['start_numbers'])] = np.isin(race['start_numbers'], selection)
+    return selected
+
+def _correct_polynomial(hit, miss):
+    """
+    Antal (eller andel) rader med exakt j rätt, j = 0..antal lopp.
+    hit och miss är (utfall x lopp): bidrag per lopp om raden har rätt respektive fel.
+    """
+    samples, races = hit.shape
+    poly = np.zeros((samples, races + 1))
+    poly[:, 0] = 1.0
+    for race in range(races):
+        shifted = np.zeros_like(poly)
+        shifted[:, 1:] = poly[:, :-1] * hit[:, race, None]
+        poly = poly * miss[:, race, None] + shifted
+    return poly
+
+def _empty_simulation_stats(races):
+    """Tomma summeringar för en simulering"""
+    tiers = sorted(V75_POOL_SHARES, reverse=True)
+    return {
+        'samples': 0,
+        'correct_counts': np.zeros(races + 1),
+        'payout_sum': 0.0,
+        'payout_sum_squares': 0.0,
+        'profit_count': 0.0,
+        'payout_histogram': np.zeros(len(simulation_bins()) - 1),
+        'tier_histograms': {tier: np.zeros(len(simulation_bins()) - 1) for tier in tiers},
+        'tier_sums': {tier: 0.0 for tier in tiers},
+    }
+
+def _merge_simulation_stats(total, part):
+    """Lägg ihop summeringar från flera batcher eller processer"""
+    for key in ('samples', 'correct_counts', 'payout_sum', 'payout_sum_squares', 'profit_count', 'payout_histogram'):
+        total[key] = total[key] + part[key]
+    for tier in total['tier_sums']:
+        total['tier_sums'][tier] += part['tier_sums'][tier]
+        total['tier_histograms'][tier] = total['tier_histograms'][tier] + part['tier_histograms'][tier]
+    return total
+
+def simulate_v75_batch(model, public, selected, samples, rng, row_price=V75_ROW_PRICE,
+                       payout_rate=V75_PAYOUT_RATE):
+    """
+    Simulera ett antal omgångar och returnera summeringar
+    """
+    races = model.shape[0]
+    stats = _empty_simulation_stats(races)
+    cumulative = np.cumsum(model, axis=1)
+    rows_per_race = selected.sum(axis=1)
+    
+    # Dra vinnare per lopp
+    draws = rng.random((samples, races))
+    winners = np.empty((samples, races), dtype=np.intp)
+    for race in range(races):
+        winners[:, race] = np.searchsorted(cumulative[race], draws[:, race] * cumulative[race, -1], side='right')
+        # Avrundning kan ge index efter fältet; hästar med 0 % kan stå var som helst
+        winners[:, race] = np.minimum(winners[:, race], np.flatnonzero(model[race])[-1])
+    
+    race_index = np.arange(races)
+    hit = selected[race_index, winners]
+    winner_public = public[race_index, winners]
+    
+    # Systemets rader och spelade andelen rader per antal rätt
+    system_rows = _correct_polynomial(hit, rows_per_race - hit)
+    public_share = _correct_polynomial(winner_public, 1 - winner_public)
+    
+    payout = np.zeros(samples)
+    for tier, share in V75_POOL_SHARES.items():
+        with np.errstate(divide='ignore'):
+            tier_payout = payout_rate * share * row_price / public_share[:, tier]
+        payout += system_rows[:, tier] * tier_payout
+        stats['tier_sums'][tier] = float(tier_payout.sum())
+        stats['tier_histograms'][tier] = np.histogram(tier_payout, simulation_bins())[0].astype(float)
+    
+    stats['samples'] = samples
+    stats['correct_counts'] = np.bincount(hit.sum(axis=1).astype(int), minlength=races + 1).astype(float)
+    stats['payout_sum'] = float(payout.sum())
+    stats['payout_sum_squares'] = float((payout ** 2).sum())
+    # Räknas exakt, histogrammets fack är för grova runt kostnaden
+    stats['profit_count'] = float((payout > np.prod(rows_per_race) * row_price).sum())
+    stats['payout_histogram'] = np.histogram(payout, simulation_bins())[0].astype(float)
+    return stats
+
+def _simulate_in_shared_memory(job):
+    """
+    Arbetsprocess: läs matriserna direkt ur delat minne och simulera
+    job är (minnesnamn, form, antal utfall, seed).
+    """
+    shm_name, shape, samples, seed = job
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        matrices = np.ndarray((3,) + shape, dtype=float, buffer=shm.buf)
+        rng = np.random.default_rng(seed)
+        stats = _empty_simulation_stats(shape[0])
+        done = 0
+        while done < samples:
+            batch = min(SIMULATION_BATCH_SIZE, samples - done)
+            _merge_simulation_stats(stats, simulate_v75_batch(matrices[0], matrices[1], matrices[2], batch, rng))
+            done += batch
+        return stats
+    finally:
+        del matrices
+        shm.close()
+
+def _histogram_quantile(histogram, quantile):
+    """Ungefärlig kvantil från histogram över simulation_bins()"""
+    cumulative = np.cumsum(histogram)
+    if cumulative[-1] == 0:
+        return 0.0
+    index = int(np.searchsorted(cumulative, quantile * cumulative[-1]))
+    bins = simulation_bins()
+    return float(bins[min(index + 1, len(bins) - 2)])
+
+def summarize_simulation(stats, cost):
+    """Sammanfatta simuleringen: träffsannolikheter, medel, varians och kvantiler"""
+    samples = stats['samples']
+    mean = stats['payout_sum'] / samples
+    variance = max(stats['payout_sum_squares'] / samples - mean ** 2, 0.0)
+    races = len(stats['correct_counts']) - 1
+    
+    return {
+        'samples': samples,
+        'cost': cost,
+        'hit_probability': {
+            tier: float(stats['correct_counts'][tier] / samples) for tier in sorted(V75_POOL_SHARES, reverse=True)
+        },
+        'max_correct_distribution': (stats['correct_counts'] / samples).tolist(),
+        'payout_mean': mean,
+        'payout_variance': variance,
+        'payout_std': variance ** 0.5,
+        'payout_median': _histogram_quantile(stats['payout_histogram'], 0.5),
+        'payout_p95': _histogram_quantile(stats['payout_histogram'], 0.95),
+        'profit_probability': float(stats['profit_count'] / samples),
+        'expected_profit': mean - cost,
+        'tier_payout': {
+            tier: {
+                'mean': stats['tier_sums'][tier] / samples,
+                'median': _histogram_quantile(stats['tier_histograms'][tier], 0.5),
+                'p95': _histogram_quantile(stats['tier_histograms'][tier], 0.95),
+            }
+            for tier in stats['tier_sums']
+        },
+        'races': races
+    }
+
+def simulate_v75(races, selections, samples=1000000, seed=None, workers=1):
+    """
+    Simulera ett V75-system. workers > 1 delar upp simuleringen på processer
+    som läser sannolikhetsmatriserna ur delat minne i stället för att få kopior.
+    """
+    model, public = probability_matrices(races)
+    selected = selection_matrix(races, selections)
+    cost = float(np.prod(selected.sum(axis=1))) * V75_ROW_PRICE
+    seeds = np.random.SeedSequence(seed).spawn(max(1, workers))
+    
+    if workers <= 1:
+        rng = np.random.default_rng(seeds[0])
+        stats = _empty_simulation_stats(len(races))
+        done = 0
+        while done < samples:
+            batch = min(SIMULATION_BATCH_SIZE, samples - done)
+            _merge_simulation_stats(stats, simulate_v75_batch(model, public, selected, batch, rng))
+            done += batch
+        return summarize_simulation(stats, cost)
+    
+    shm = shared_memory.SharedMemory(create=True, size=3 * model.nbytes)
+    try:
+        matrices = np.ndarray((3,) + model.shape, dtype=float, buffer=shm.buf)
+        matrices[0], matrices[1], matrices[2] = model, public, selected
+        per_worker = [samples // workers + (1 if i < samples % workers else 0) for i in range(workers)]
+        jobs = [(shm.name, model.shape, count, seed_seq) for count, seed_seq in zip(per_worker, seeds) if count]
+        
+        stats = _empty_simulation_stats(len(races))
+        with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+            for part in executor.map(_simulate_in_shared_memory, jobs):
+                _merge_simulation_stats(stats, part)
+        del matrices
+    finally:
+        shm.close()
+        shm.unlink()
+    
+    return summarize_simulation(stats, cost)
+
+def print_simulation(summary):
+    """Skriv ut simuleringsresultat"""
+    print(f"\n=== SIMULERING ({summary['samples']:,} omgångar) ===")
+    for tier, probability in summary['hit_probability'].items():
+        tier_payout = summary['tier_payout'][tier]
+        print(f"  {tier} rätt: {probability * 100:.4f}%  "
+              f"(utdelning per rad: median {tier_payout['median']:,.0f} kr, medel {tier_payout['mean']:,.0f} kr)")
+    print(f"\nKostnad: {summary['cost']:.2f} kr")
+    print(f"Förväntad utdelning: {summary['payout_mean']:,.2f} kr  (std {summary['payout_std']:,.2f} kr)")
+    print(f"Förväntat överskott: {summary['expected_profit']:,.2f} kr")
+    print(f"Sannolikhet för vinst: {summary['profit_probability'] * 100:.2f}%")
+    print(f"Utdelning median / 95:e percentil: {summary['payout_median']:,.0f} / {summary['payout_p95']:,.0f} kr")
+
+def parse_selections(text):
+    """Tolka system som '1,4;2;7,8,9' (lopp separerade med semikolon)"""
+    return [[int(number) for number in race.split(',') if number.strip()] for race in text.split(';')]
+
+def run_simulation(results_path, budget=None, selections=None, card=None, model_column='ai_percentage',
+                   samples=1000000, workers=1, seed=None):
+    """
+    Simulera ett system från en resultatfil, antingen angivet eller optimerat inom budget
+    """
+    results_df = pd.read_json(results_path) if results_path.lower().endswith('.json') else pd.read_csv(results_path)
+    card = str(card) if card is not None else results_df['card'].astype(str).iloc[0]
+    races = card_probabilities(results_df[results_df['card'].astype(str) == card], model_column)
+    
+    if selections is None:
+        if budget is None:
+            print("Ange antingen ett system eller en budget.")
+            return None
+        system = optimize_v75_system(races, budget)
+        print_v75_system(system)
+        selections = system['selections']
+    
+    start = time.perf_counter()
+    summary = simulate_v75(races, selections, samples=samples, seed=seed, workers=workers)
+    print_simulation(summary)
+    print(f"\nSimuleringstid: {time.perf_counter() - start:.2f} s")
+    return summary
+
+# Backtest
+#
+# Kör historiska omgångar genom calculate_betting_value och vald rankingmotor
+# och jämför modellens sannolikheter med spelad procent mot faktiska vinnare.
+# Omgångarna läses en i taget och körs parallellt med ett begränsat antal
+# omgångar i arbete, så minnesåtgången är oberoende av säsongens storlek.
+
+WIN_POOL_PAYOUT_RATE = 0.80   # Ungefärlig återbetalning i vinnarspelet
+CALIBRATION_BINS = 10
+BACKTEST_SOURCES = ('model', 'public')
+
+def load_race_results(results_json_path):
+    """
+    Läs vinnare per lopp från en resultatfil.
+    Format: {"V75-1": 5, ...} eller {"V75-1": {"winner": 5}, ...}
+    Returnerar {loppnummer: startnummer}.
+    """
+    with open(results_json_path, 'r', encoding='utf-8') as f:
+        results = json.load(f)
+    
+    winners = {}
+    for key, value in results.items():
+        match = re.search(r'(\d+)$', str(key))
+        if not match:
+            continue
+        if isinstance(value, dict):
+            value = value.get('winner', value.get('vinnare'))
+        try:
+            winners[int(match.group(1))] = int(value)
+        except (TypeError, ValueError):
+            continue
+    return winners
+
+def _empty_backtest_stats():
+    """Tomma summeringar för backtest"""
+    return {
+        'races': 0,
+        'horses': 0,
+        'log_loss': {source: 0.0 for source in BACKTEST_SOURCES},
+        'brier': {source: 0.0 for source in BACKTEST_SOURCES},
+        'calibration': {
+            source: {
+                'predicted': np.zeros(CALIBRATION_BINS),
+                'wins': np.zeros(CALIBRATION_BINS),
+                'count': np.zeros(CALIBRATION_BINS)
+            }
+            for source in BACKTEST_SOURCES
+        },
+        'roi': {
+            status: {'bets': 0, 'wins': 0, 'returned': 0.0}
+            for status in ('Underspelad', 'Normal', 'Överspelad')
+        }
+    }
+
+def _merge_backtest_stats(total, part):
+    """Lägg ihop summeringar från flera omgångar"""
+    total['races'] += part['races']
+    total['horses'] += part['horses']
+    for source in BACKTEST_SOURCES:
+        total['log_loss'][source] += part['log_loss'][source]
+        total['brier'][source] += part['brier'][source]
+        for key in ('predicted', 'wins', 'count'):
+            total['calibration'][source][key] += part['calibration'][source][key]
+    for status, roi in part['roi'].items():
+        for key in roi:
+            total['roi'][status][key] += roi[key]
+    return total
+
+def backtest_race_stats(horses, winner, stats):
+    """
+    Lägg till ett lopps bidrag till summeringarna.
+    horses är en rankad HorseTable (med ai_percentage och deviation).
+    """
+    records = horses.records
+    won = (records['start_number'] == winner).astype(float)
+    if won.sum() != 1:
+        return stats
+    
+    probabilities = {
+        'model': records['ai_percentage'].astype(float),
+        'public': records['betting_percentage'].astype(float)
+    }
+    for source, p in probabilities.items():
+        p = np.clip(p, 0, None)
+        p = p / p.sum() if p.sum() > 0 else np.full(len(p), 1 / len(p))
+        stats['log_loss'][source] += float(-np.log(max(p[won == 1][0], 1e-12)))
+        stats['brier'][source] += float(((p - won) ** 2).sum())
+        bins = np.minimum((p * CALIBRATION_BINS).astype(int), CALIBRATION_BINS - 1)
+        calibration = stats['calibration'][source]
+        calibration['predicted'] += np.bincount(bins, weights=p, minlength=CALIBRATION_BINS)
+        calibration['wins'] += np.bincount(bins, weights=won, minlength=CALIBRATION_BINS)
+        calibration['count'] += np.bincount(bins, minlength=CALIBRATION_BINS)
+    
+    # Spela 1 kr vinnare på varje häst per status, odds skattade från spelad procent
+    public = np.clip(probabilities['public'] / 100, 1e-6, None)
+    returned = np.where(won == 1, WIN_POOL_PAYOUT_RATE / public, 0.0)
+    statuses = deviation_statuses(records['deviation'])
+    for status, roi in stats['roi'].items():
+        mask = statuses == status
+        roi['bets'] += int(mask.sum())
+        roi['wins'] += int(won[mask].sum())
+        roi['returned'] += float(returned[mask].sum())
+    
+    stats['races'] += 1
+    stats['horses'] += len(horses)
+    return stats
+
+def backtest_card_job(job):
+    """
+    Arbetsprocess: poängsätt, ranka och utvärdera en omgång.
+    job är en tuple (omgång, motor, fallback).
+    """
+    card, engine, fallback = job
+    metrics.reset()
+    stats = _empty_backtest_stats()
+    if not card['resultat']:
+        return stats, metrics.export_raw(), feature_cache.export_pending()
+    
+    winners = load_race_results(card['resultat'])
+    for race_csv_path in card['races']:
+        horses = score_race_job((card['card'], race_csv_path, card['spelprocent'], card['banstatistik']))
+        if horses is None:
+            continue
+        race_number = horses.races[0][1]
+        if race_number not in winners:
+            continue
+        add_ranking_columns(horses, rank_horses(horses, engine, fallback))
+        backtest_race_stats(horses, winners[race_number], stats)
+    return stats, metrics.export_raw(), feature_cache.export_pending()
+
+def summarize_backtest(stats):
+    """Sammanfatta summeringar till nyckeltal"""
+    races = max(stats['races'], 1)
+    summary = {
+        'races': stats['races'],
+        'horses': stats['horses'],
+        'log_loss': {source: value / races for source, value in stats['log_loss'].items()},
+        'brier': {source: value / races for source, value in stats['brier'].items()},
+        'calibration': {},
+        'roi': {}
+    }
+    for source, calibration in stats['calibration'].items():
+        count = calibration['count']
+        with np.errstate(divide='ignore', invalid='ignore'):
+            summary['calibration'][source] = [
+                {
+                    'bin': f"{index / CALIBRATION_BINS:.1f}-{(index + 1) / CALIBRATION_BINS:.1f}",
+                    'count': int(count[index]),
+                    'predicted': float(calibration['predicted'][index] / count[index]) if count[index] else None,
+                    'observed': float(calibration['wins'][index] / count[index]) if count[index] else None
+                }
+                for index in range(CALIBRATION_BINS)
+            ]
+    for status, roi in stats['roi'].items():
+        summary['roi'][status] = {
+            'bets': roi['bets'],
+            'wins': roi['wins'],
+            'roi': (roi['returned'] - roi['bets']) / roi['bets'] if roi['bets'] else None
+        }
+    return summary
+
+def print_backtest(summary):
+    """Skriv ut backtest-resultat"""
+    print(f"\n=== BACKTEST ({summary['races']} lopp, {summary['horses']} starter) ===")
+    print(f"{'':12}{'Modell':>10}{'Spelad':>10}")
+    print(f"{'Log-loss':12}{summary['log_loss']['model']:>10.4f}{summary['log_loss']['public']:>10.4f}")
+    print(f"{'Brier':12}{summary['brier']['model']:>10.4f}{summary['brier']['public']:>10.4f}")
+    
+    print("\nROI per status (1 kr vinnare per häst):")
+    for status, roi in summary['roi'].items():
+        value = f"{roi['roi'] * 100:+.1f}%" if roi['roi'] is not None else "-"
+        print(f"  {status:12} {roi['bets']:>6} spel  {roi['wins']:>5} vinster  ROI {value}")
+    
+    print("\nKalibrering (förväntad / utfall):")
+    for model_bin, public_bin in zip(summary['calibration']['model'], summary['calibration']['public']):
+        def fmt(entry):
+            if entry['predicted'] is None:
+                return f"{'-':>17}"
+            return f"{entry['predicted']:.3f}/{entry['observed']:.3f} ({entry['count']})".rjust(17)
+        print(f"  {model_bin['bin']}  modell {fmt(model_bin)}  spelad {fmt(public_bin)}")
+
+def _merge_card_result(stats, card_result):
+    """Lägg ihop en omgångs summeringar, mätvärden och delpoäng"""
+    card_stats, raw, features = card_result
+    metrics.merge_raw(raw)
+    feature_cache.merge_pending(features)
+    return _merge_backtest_stats(stats, card_stats)
+
+def run_backtest(root, engine='local', fallback='equal', workers=None, output_path=None,
+                 max_in_flight=None):
+    """
+    Backtesta alla omgångar med resultatfil under root
+    """
+    workers = workers or os.cpu_count() or 1
+    max_in_flight = max_in_flight or workers * 2
+    stats = _empty_backtest_stats()
+    cards = iter_race_cards(root)
+    start = time.perf_counter()
+    
+    with futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending = set()
+        for card in cards:
+            pending.add(executor.submit(backtest_card_job, (card, engine, fallback)))
+            # Begränsa antalet omgångar i arbete
+            if len(pending) >= max_in_flight:
+                done, pending = futures.wait(pending, return_when=futures.FIRST_COMPLETED)
+                for future in done:
+                    _merge_card_result(stats, future.result())
+        for future in pending:
+            _merge_card_result(stats, future.result())
+    
+    summary = summarize_backtest(stats)
+    print_backtest(summary)
+    print(f"\nTid: {time.perf_counter() - start:.1f} s")
+    
+    if output_path:
+        with open(output_path, 'w', encoding='utf-8') as f:
+            json.dump(summary, f, ensure_ascii=False, indent=2)
+        print(f"Backtest sparad i: {output_path}")
+    
+    return summary
+
+# Anpassning av vikter
+#
+# `spelvarde.py fit` anpassar vikterna i total_score och den lokala modellens
+# koefficienter mot faktiska vinnare, och väljer poängtabell för placeringar
+# och distanstolerans ur ett rutnät. Modellen är samma conditional logit som
+# local_win_probabilities: sannolikheten att vinna är softmax av delpoäng
+# gånger koefficienter inom loppet. Log-likelihood, gradient och Hessian räknas
+# för alla lopp på en gång, med loppen efter varandra i en matris och summor
+# per lopp med np.add.reduceat, och koefficienterna anpassas med Newtons
+# metod. Delpoängen per rutnätspunkt, och varje kombination av rutnätspunkt,
+# L2-straff och korsvalideringsdel, körs parallellt i en processpool. Delarna
+# bildas per omgång, så lopp från samma dag hamnar aldrig på båda sidor.
+
+FIT_PARAMS_PATH = 'parametrar.json'
+FIT_FOLDS = 5
+FIT_L2_PENALTIES = (0.0, 0.01, 0.1, 1.0)
+FIT_PLACEMENT_POINTS = (
+    PLACEMENT_POINTS,
+    (10.0, 7.0, 5.0, 3.0, 1.0),
+    (10.0, 6.0, 3.0, 1.0, 0.0),
+    (10.0, 9.0, 7.0, 5.0, 2.0),
+)
+FIT_DISTANCE_TOLERANCES = (50, DISTANCE_TOLERANCE, 200)
+FIT_MAX_ITERATIONS = 50
+FIT_CONVERGENCE = 1e-10   # Minsta förbättring av målfunktionen per Newtonsteg
+
+def load_fit_races(root):
+    """
+    Läs alla lopp med känd vinnare under root.
+    Returnerar (lopp, omgångar), där varje lopp är en tuple
+    (omgångens index, hästdata, banstatistik, vinnarens rad).
+    """
+    races, cards, track_indexes = [], [], {}
+    for card in iter_race_cards(root):
+        if not card['resultat']:
+            continue
+        winners = load_race_results(card['resultat'])
+        if card['banstatistik'] not in track_indexes:
+            track_indexes[card['banstatistik']] = get_track_index(load_track_data(card['banstatistik']))
+        track_index = track_indexes[card['banstatistik']]
+        
+        for race_csv_path in card['races']:
+            try:
+                horses_df = read_race_csv(race_csv_path)
+            except Exception as e:
+                print(f"Fel vid inläsning av {race_csv_path}: {e}")
+                metrics.record_error('load_fit_races', e)
+                continue
+            winner = winners.get(determine_race_number(race_csv_path, horses_df))
+            start_numbers = pd.to_numeric(horses_df['start_number'], errors='coerce').to_numpy()
+            rows = np.flatnonzero(start_numbers == winner)
+            if winner is None or len(rows) != 1:
+                continue
+            detect_track(horses_df, race_csv_path, track_index)
+            races.append((len(cards), horses_df, track_index, int(rows[0])))
+        cards.append(card['card'])
+    return races, cards
+
+def race_index(starts, rows):
+    """Loppets index för varje rad, givet loppens första rader"""
+    return np.repeat(np.arange(len(starts)), np.diff(starts, append=rows))
+
+def subset_races(features, starts, winners, mask):
+    """Plocka ut loppen där mask är sann. Returnerar (delpoäng, första rader, vinnarrader)."""
+    sizes = np.diff(starts, append=len(features))
+    kept = np.cumsum(sizes[mask]) - sizes[mask]
+    return features[np.repeat(mask, sizes)], kept, kept + (winners - starts)[mask]
+
+def conditional_logit(features, starts, winners, coefficients, derivatives=True):
+    """
+    Log-likelihood för conditional logit över alla lopp.
+    features är (hästar x delpoäng) med loppen efter varandra, starts loppens
+    första rad och winners vinnarens rad. Med derivatives returneras
+    (log-likelihood, gradient, Hessian).
+    """
+    race = race_index(starts, len(features))
+    utilities = features @ coefficients
+    maxima = np.maximum.reduceat(utilities, starts)
+    exp = np.exp(utilities - maxima[race])
+    sums = np.add.reduceat(exp, starts)
+    log_likelihood = float((utilities[winners] - maxima - np.log(sums)).sum())
+    if not derivatives:
+        return log_likelihood
+    
+    p = exp / sums[race]
+    weighted = features * p[:, None]
+    expected = np.add.reduceat(weighted, starts)   # Väntevärde av delpoängen per lopp
+    gradient = features[winners].sum(axis=0) - expected.sum(axis=0)
+    hessian = expected.T @ expected - weighted.T @ features
+    return log_likelihood, gradient, hessian
+
+def fit_conditional_logit(features, starts, winners, l2=0.0):
+    """
+    Anpassa koefficienterna med Newtons metod. Målfunktionen är medelvärdet av
+    log-likelihood per lopp minus l2/2 * |koefficienter|^2. Steget halveras
+    tills målfunktionen inte minskar.
+    """
+    races = len(starts)
+    identity = np.eye(features.shape[1])
+    coefficients = np.zeros(features.shape[1])
+    
+    def objective(candidate):
+        return (conditional_logit(features, starts, winners, candidate, derivatives=False) / races
+                - l2 / 2 * candidate @ candidate)
+    
+    for _ in range(FIT_MAX_ITERATIONS):
+        log_likelihood, gradient, hessian = conditional_logit(features, starts, winners, coefficients)
+        current = log_likelihood / races - l2 / 2 * coefficients @ coefficients
+        gradient = gradient / races - l2 * coefficients
+        hessian = hessian / races - (l2 + 1e-9) * identity
+        try:
+            step = np.linalg.solve(hessian, gradient)
+        except np.linalg.LinAlgError:
+            step = np.linalg.lstsq(hessian, gradient, rcond=None)[0]
+        
+        scale = 1.0
+        while scale > 1e-6:
+            candidate = coefficients - scale * step
+            value = objective(candidate)
+            if value >= current:
+                break
+            scale /= 2
+        else:
+            break
+        coefficients = candidate
+        if value - current < FIT_CONVERGENCE:
+            break
+    return coefficients
+
+_worker_fit_data = {}
+
+def _init_fit_worker(data):
+    """Ta emot loppen eller delpoängen en gång per arbetsprocess"""
+    _worker_fit_data.update(data)
+
+def fit_features_job(job):
+    """
+    Arbetsprocess: delpoäng för alla lopp med en poängtabell och distanstolerans.
+    Returnerar en matris (hästar x FEATURE_COLUMNS) med loppen efter varandra.
+    Delpoängscachen används inte, rutnätspunkterna ska inte fylla den.
+    """
+    points, tolerance = job
+    active = scoring_params.placement_points, scoring_params.distance_tolerance
+    scoring_params.placement_points, scoring_params.distance_tolerance = points, tolerance
+    try:
+        features = []
+        for _, horses_df, track_index, _ in _worker_fit_data['races']:
+            scores = score_horses(history_store.extend(horses_df), track_index)
+            features.append(np.column_stack([scores[column] for column in FEATURE_COLUMNS]))
+        return np.concatenate(features).astype(float)
+    finally:
+        scoring_params.placement_points, scoring_params.distance_tolerance = active
+
+def fit_fold_job(job):
+    """
+    Arbetsprocess: anpassa på alla delar utom en och utvärdera på den.
+    job är en tuple (rutnätspunkt, L2-straff, del). Returnerar jobbet
+    tillsammans med summerad log loss och antal lopp i delen.
+    """
+    point, l2, fold = job
+    data = _worker_fit_data
+    features, starts, winners = data['features'][point], data['starts'], data['winners']
+    held_out = data['folds'] == fold
+    coefficients = fit_conditional_logit(*subset_races(features, starts, winners, ~held_out), l2=l2)
+    log_likelihood = conditional_logit(*subset_races(features, starts, winners, held_out), coefficients,
+                                       derivatives=False)
+    return point, l2, fold, -log_likelihood, int(held_out.sum())
+
+def _map_fit_jobs(function, jobs, data, workers):
+    """Kör jobben i arbetsprocesser som fått data vid start, eller i huvudprocessen med workers=0"""
+    if workers == 0:
+        _init_fit_worker(data)
+        return list(map(function, jobs))
+    with futures.ProcessPoolExecutor(max_workers=workers, initializer=_init_fit_worker,
+                                     initargs=(data,)) as executor:
+        return list(executor.map(function, jobs, chunksize=max(1, len(jobs) // (workers * 4))))
+
+def fitted_params(coefficients, point, fit):
+    """Parameterfil för anpassade koefficienter och vald rutnätspunkt"""
+    weights = dict(zip(FEATURE_COLUMNS, coefficients.tolist()))
+    total = sum(weights.values())
+    # Vikterna skalas så att total_score behåller skalan 0-10
+    scale = total if total > 0 else sum(abs(weight) for weight in weights.values()) or 1.0
+    params = ScoringParams()
+    params.update({
+        'total_score_weights': {column: weights[column] / scale for column in TOTAL_SCORE_WEIGHTS},
+        'placement_points': point[0],
+        'distance_tolerance': point[1],
+        'local_model': {'features': list(FEATURE_COLUMNS), 'coefficients': coefficients.tolist()},
+        'fit': fit,
+    })
+    return params
+
+def print_fit(fit, params):
+    """Skriv ut resultatet av en anpassning"""
+    print(f"\nAnpassning mot {fit['races']} lopp i {fit['cards']} omgångar ({fit['folds']} delar)")
+    print(f"{'Poängtabell':<26}{'Tolerans':>10}{'L2':>8}{'Log loss':>10}")
+    for row in fit['grid'][:5]:
+        points = '/'.join(f"{value:g}" for value in row['placement_points'])
+        print(f"{points:<26}{row['distance_tolerance']:>10g}{row['l2']:>8g}{row['log_loss']:>10.4f}")
+    
+    log_loss = fit['log_loss']
+    print(f"\nLog loss per lopp: anpassad {log_loss['fitted']:.4f} (korsvaliderad), "
+          f"nuvarande {log_loss['baseline']:.4f}, jämn fördelning {log_loss['uniform']:.4f}")
+    print("Vikter för total_score:")
+    for column, weight in params.total_score_weights.items():
+        print(f"  {column:<22}{weight:>8.3f}")
+
+def run_fit(root, output_path=FIT_PARAMS_PATH, folds=FIT_FOLDS, workers=None, seed=0):
+    """
+    Anpassa poängparametrarna mot alla omgångar med resultatfil under root
+    och spara dem i output_path
+    """
+    workers = os.cpu_count() or 1 if workers is None else workers
+    start = time.perf_counter()
+    
+    with metrics.stage('fit_loading'):
+        races, cards = load_fit_races(root)
+    folds = min(folds, len(cards))
+    if folds < 2:
+        print("För få omgångar med resultat för korsvalidering.")
+        return None
+    
+    sizes = np.array([len(horses_df) for _, horses_df, _, _ in races])
+    starts = np.cumsum(sizes) - sizes
+    winners = starts + np.array([winner for _, _, _, winner in races])
+    card_folds = np.random.default_rng(seed).permutation(len(cards)) % folds
+    race_folds = card_folds[[card for card, _, _, _ in races]]
+    
+    # Första rutnätspunkten är de aktiva parametrarna, som jämförelse
+    grid = list(dict.fromkeys(
+        [(tuple(scoring_params.placement_points), scoring_params.distance_tolerance)]
+        + [(points, tolerance) for points in FIT_PLACEMENT_POINTS for tolerance in FIT_DISTANCE_TOLERANCES]
+    ))
+    print(f"Anpassar mot {len(races)} lopp i {len(cards)} omgångar, {len(grid)} rutnätspunkter...")
+    
+    with metrics.stage('fit_features'):
+        features = _map_fit_jobs(fit_features_job, grid, {'races': races}, workers)
+    
+    # Lopp där någon delpoäng saknas i någon rutnätspunkt tas bort
+    finite = np.logical_and.reduce([np.isfinite(matrix).all(axis=1) for matrix in features])
+    valid = np.logical_and.reduceat(finite, starts)
+    if not valid.all():
+        features = [subset_races(matrix, starts, winners, valid)[0] for matrix in features]
+        _, starts, winners = subset_races(finite, starts, winners, valid)
+        race_folds = race_folds[valid]
+    
+    jobs = [(point, l2, fold) for point in range(len(grid)) for l2 in FIT_L2_PENALTIES for fold in range(folds)]
+    with metrics.stage('fit_cross_validation'):
+        results = _map_fit_jobs(fit_fold_job, jobs, {
+            'features': features, 'starts': starts, 'winners': winners, 'folds': race_folds
+        }, workers)
+    
+    losses = collections.defaultdict(float)
+    for point, l2, _, loss, _ in results:
+        losses[point, l2] += loss
+    ranking = sorted(losses, key=losses.get)
+    best_point, best_l2 = ranking[0]
+    
+    coefficients = fit_conditional_logit(features[best_point], starts, winners, l2=best_l2)
+    local_model = dict(zip(scoring_params.local_model['features'], scoring_params.local_model['coefficients']))
+    baseline = np.array([local_model.get(column, 0.0) for column in FEATURE_COLUMNS])
+    race_count = len(starts)
+    fit = {
+        'created': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'root': root,
+        'races': race_count,
+        'cards': len(cards),
+        'folds': folds,
+        'l2': best_l2,
+        'log_loss': {
+            'fitted': losses[ranking[0]] / race_count,
+            'baseline': -conditional_logit(features[0], starts, winners, baseline, derivatives=False) / race_count,
+            'uniform': float(np.log(np.diff(starts, append=len(features[0]))).mean()),
+        },
+        'grid': [
+            {'placement_points': list(grid[point][0]), 'distance_tolerance': grid[point][1], 'l2': l2,
+             'log_loss': losses[point, l2] / race_count}
+            for point, l2 in ranking
+        ],
+    }
+    params = fitted_params(coefficients, grid[best_point], fit)
+    print_fit(fit, params)
+    print(f"\nTid: {time.perf_counter() - start:.1f} s")
+    
+    params.save(output_path)
+    print(f"Parametrar sparade i: {output_path} (använd med --params)")
+    return params
+
+# Live-bevakning av spelprocent
+#
+# Analyserar en omgång en gång och bevakar sedan spelprocentfilen. När filen
+# ändras räknas bara spelprocent, avvikelse och status om, och bara för de
+# lopp vars andelar ändrats. Delpoäng, totalvärde och modellens procent
+# behålls från första analysen, så ingen ny AI-körning behövs.
+
+WATCH_INTERVAL = 0.1   # Sekunder mellan kontroller av filen
+
+def file_signature(path):
+    """(mtime, storlek) för en fil, None om den inte finns"""
+    try:
+        stat = os.stat(path)
+    except OSError:
+        return None
+    return stat.st_mtime_ns, stat.st_size
+
+def read_spelprocent(path):
+    """Läs spelprocentfilen, None om den saknas eller är halvskriven"""
+    try:
+        with open(path, 'r', encoding='utf-8') as f:
+            return json.load(f)
+    except (OSError, ValueError) as e:
+        metrics.record_error('watch', e)
+        return None
+
+def changed_races(previous, current):
+    """Loppnummer vars spelprocent skiljer sig mellan två ögonblicksbilder"""
+    previous, current = previous or {}, current or {}
+    changed = []
+    for key in set(previous) | set(current):
+        match = re.fullmatch(r'V75-(\d+)', str(key))
+        if match and previous.get(key) != current.get(key):
+            changed.append(int(match.group(1)))
+    return sorted(changed)
+
+class LiveCard:
+    """Analyserade lopp i en omgång, uppdateras med nya spelprocent"""
+    def __init__(self, races, betting_data):
+        self.races = races                # {loppnummer: rankad HorseTable}
+        self.betting_data = betting_data
+    
+    def update(self, betting_data):
+        """Räkna om ändrade lopp, returnerar deras loppnummer"""
+        changed = [n for n in changed_races(self.betting_data, betting_data) if n in self.races]
+        for race_number in changed:
+            update_betting_percentages(self.races[race_number], betting_data, race_number)
+            update_deviation(self.races[race_number])
+        self.betting_data = betting_data
+        return changed
+    
+    def results(self):
+        """Alla lopp i en DataFrame"""
+        return HorseTable.concat([self.races[n] for n in sorted(self.races)]).to_frame()
+
+def print_live_race(horses, race_number):
+    """Skriv ut aktuell avvikelse för ett lopp"""
+    print(f"\nLopp {race_number}:")
+    print(f"{'Nr':>4}  {'Namn':24}{'AI':>8}{'Spelad':>8}{'Avvik.':>8}  Status")
+    records = horses.records
+    order = np.argsort(-records['ai_percentage'], kind='stable')
+    names = horses.horse_names()
+    for i, status in zip(order.tolist(), deviation_statuses(records['deviation'][order]).tolist()):
+        horse = records[i]
+        print(f"{horse['start_number']:>4}  {str(names[i])[:23]:24}{horse['ai_percentage']:>7.1f}%"
+              f"{horse['betting_percentage']:>7.1f}%{horse['deviation']:>+7.1f}%  {status}")
+
+def start_live_card(card, betting_data, engine='ai', fallback='equal'):
+    """
+    Poängsätt och ranka alla lopp i en omgång en gång. Alla lopp får
+    spelprocent från betting_data, som blir utgångsläget för bevakningen.
+    """
+    _init_score_worker({card['banstatistik']: get_track_index(load_track_data(card['banstatistik']))})
+    jobs = [(card['card'], path, card['spelprocent'], card['banstatistik']) for path in card['races']]
+    results = [table for table in map(score_race_job, jobs) if table is not None]
+    if not results:
+        return None
+    
+    if engine == 'local':
+        rankings = [analyze_horse_with_local_model(table) for table in results]
+    else:
+        rankings = analyze_card_with_ai(results, fallback=fallback)
+    races = {
+        table.races[0][1]: add_ranking_columns(table, ai_ranking)
+        for table, ai_ranking in zip(results, rankings)
+    }
+    # Filen kan ha ändrats medan loppen poängsattes och rankades. Alla lopp
+    # får spelprocent från samma ögonblicksbild som bevakningen utgår från.
+    for race_number, horses in races.items():
+        update_betting_percentages(horses, betting_data, race_number)
+        update_deviation(horses)
+    return LiveCard(races, betting_data)
+
+def run_watch(directory, spelprocent_path=None, banstatistik_path=None, engine='ai', fallback='equal',
+              interval=WATCH_INTERVAL, output_path=None, duration=None):
+    """
+    Analysera en omgång och uppdatera avvikelserna varje gång spelprocentfilen ändras
+    """
+    cards = find_race_cards(directory, spelprocent_path, banstatistik_path)
+    if len(cards) != 1:
+        print(f"Bevakning kräver exakt en omgång, hittade {len(cards)}.")
+        return None
+    card = cards[0]
+    
+    # Signatur och ögonblicksbild läses före analysen, så att en ändring under
+    # poängsättning och AI-anrop upptäcks vid första kontrollen
+    signature = file_signature(card['spelprocent'])
+    betting_data = read_spelprocent(card['spelprocent'])
+    if betting_data is None:
+        print(f"Kunde inte läsa {card['spelprocent']}.")
+        return None
+    live = start_live_card(card, betting_data, engine, fallback)
+    if live is None:
+        print("Inga lopp kunde analyseras.")
+        return None
+    
+    for race_number in sorted(live.races):
+        print_live_race(live.races[race_number], race_number)
+    if output_path:
+        write_batch_results(live.results(), output_path)
+    
+    print(f"\nBevakar {card['spelprocent']} (Ctrl+C avslutar)...")
+    deadline = time.monotonic() + duration if duration else None
+    try:
+        while deadline is None or time.monotonic() < deadline:
+            time.sleep(interval)
+            current = file_signature(card['spelprocent'])
+            if current == signature:
+                continue
+            
+            started = time.perf_counter()
+            betting_data = read_spelprocent(card['spelprocent'])
+            if betting_data is None:
+                continue   # Halvskriven fil, försök igen vid nästa kontroll
+            signature = current
+            with metrics.stage('watch_update'):
+                changed = live.update(betting_data)
+            elapsed = time.perf_counter() - started
+            
+            if not changed:
+                continue
+            print(f"\n=== {time.strftime('%H:%M:%S')}: ny spelprocent för lopp "
+                  f"{', '.join(map(str, changed))} ({elapsed * 1000:.1f} ms) ===")
+            for race_number in changed:
+                print_live_race(live.races[race_number], race_number)
+            if output_path:
+                write_batch_results(live.results(), output_path)
+    except KeyboardInterrupt:
+        pass
+    
+    return live.results()
+
+# Tidigare körningar
+#
+# Läser körloggen och sammanfattar körningar, eller listar enskilda
+# AI-analyser filtrerade på körning, häst, tid och fallback.
+
+def parse_since(value):
+    """Tidpunkt som 2024-05-01 eller 2024-05-01T18:00, som Unix-tid"""
+    from datetime import datetime
+    return datetime.fromisoformat(value).timestamp()
+
+def filter_run_log(entries, run=None, horse=None, fallbacks=False, since=None):
+    """AI-analyser i körloggen som matchar filtren"""
+    horse = horse.lower() if horse else None
+    for entry in entries:
+        if entry.get('kind') != 'ai_analysis':
+            continue
+        if run and not entry['run'].startswith(run):
+            continue
+        if since is not None and entry['time'] < since:
+            continue
+        if fallbacks and not entry.get('fallback'):
+            continue
+        if horse and not any(horse in str(h.get('name', '')).lower() for h in entry.get('horses') or []):
+            continue
+        yield entry
+
+def summarize_runs(entries):
+    """Nyckeltal per körning, i den ordning körningarna loggades"""
+    runs = {}
+    for entry in entries:
+        run = runs.setdefault(entry['run'], {
+            'run': entry['run'], 'started': entry['time'], 'analyses': 0,
+            'fallbacks': 0, 'cached': 0, 'seconds': 0.0, 'command': None
+        })
+        if entry.get('kind') == 'ai_analysis':
+            run['analyses'] += 1
+            run['fallbacks'] += bool(entry.get('fallback'))
+            run['cached'] += bool(entry.get('from_cache'))
+            run['seconds'] += entry.get('seconds') or 0.0
+        elif entry.get('kind') == 'run_end':
+            run['command'] = entry.get('command')
+    return list(runs.values())
+
+def format_top_horses(ranking, count=3):
+    """De högst rankade hästarna som '3 Namn 24.1%'"""
+    horses = sorted((ranking or {}).get('horses', []), key=lambda h: -h.get('calculated_percentage', 0))
+    return ', '.join(f"{h.get('start_number')} {h.get('name')} {h.get('calculated_percentage', 0):.1f}%"
+                     for h in horses[:count])
+
+def run_log_report(directory=RUN_LOG_DIR, run=None, horse=None, fallbacks=False, since=None,
+                   as_json=False, limit=None):
+    """
+    Skriv ut tidigare körningar. Utan filter listas körningarna, med filter
+    de AI-analyser som matchar (som JSONL med as_json).
+    """
+    entries = read_run_log(directory)
+    since = parse_since(since) if since else None
+    
+    if not (run or horse or fallbacks or since is not None or as_json):
+        runs = summarize_runs(entries)[-limit:] if limit else summarize_runs(entries)
+        if not runs:
+            print(f"Inga körningar loggade i {directory}.")
+            return runs
+        print(f"{'Körning':24}{'Start':>21}{'Analyser':>10}{'Fallback':>10}{'Cache':>8}{'Snitt':>9}  Kommando")
+        for item in runs:
+            started = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(item['started']))
+            mean = item['seconds'] / item['analyses'] if item['analyses'] else 0.0
+            print(f"{item['run']:24}{started:>21}{item['analyses']:>10}{item['fallbacks']:>10}"
+                  f"{item['cached']:>8}{mean:>8.2f}s  {item['command'] or ''}")
+        return runs
+    
+    matches = list(filter_run_log(entries, run, horse, fallbacks, since))
+    if limit:
+        matches = matches[-limit:]
+    for entry in matches:
+        if as_json:
+            print(json.dumps(entry, ensure_ascii=False))
+            continue
+        when = time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(entry['time']))
+        race = entry.get('race') or [None, None]
+        flags = ' '.join(flag for flag, on in (('cache', entry.get('from_cache')), ('fallback', entry.get('fallback'))) if on)
+        print(f"{when}  {entry['run']}  {race[0] or '-'} lopp {race[1] or '-'}  "
+              f"{len(entry.get('horses') or [])} hästar  {entry.get('seconds', 0):.2f}s  {flags}")
+        print(f"    {format_top_horses(entry.get('ranking'))}")
+        if entry.get('error'):
+            print(f"    Fel: {entry['error']}")
+    if not matches and not as_json:
+        print("Inga analyser matchar.")
+    return matches
+
+# Analystjänst
+#
+# `spelvarde.py serve` startar en lokal HTTP/JSON-tjänst för dashboards och
+# skript. Tjänsten håller allt som annars läses om vid varje körning varmt i
+# minnet: kompilerad banstatistik, spelprocent och loppdata per fil (lästa
+# om först när filen ändrats), delpoängscachen, hästhistoriken och en
+# asynkron AI-klient med keep-alive-anslutningar och gemensamma
+# anropsgränser för alla förfrågningar. Förfrågningarna hanteras i egna
+# trådar och AI-anropen körs i en gemensam händelseloop.
+#
+#   GET  /health                        Status, antal filer i minnet och rensade poster
+#   GET  /metrics                       Mätvärden sedan start
+#   POST /race  {"race": "...csv"}      Ett lopp
+#   POST /card  {"directory": "..."}    Alla lopp i en omgång
+#
+# Förfrågningarna kan även ange spelprocent, banstatistik, engine och
+# fallback. Sökvägar tolkas relativt tjänstens rotkatalog och får inte
+# peka utanför den.
+
+SERVICE_HOST = '127.0.0.1'
+SERVICE_PORT = 8750
+SERVICE_SAVE_INTERVAL = 60.0    # Sekunder mellan sparningar av delpoängscachen
+SERVICE_MAX_BODY = 1024 * 1024
+SERVICE_BACKLOG = 128           # Anslutningar som får vänta på att tas emot
+SERVICE_MAX_ENTRIES = 2000      # Poster per cache i minnet (filer eller poängsatta lopp)
+
+class ServiceError(ValueError):
+    """Fel i en förfrågan, med HTTP-status"""
+    def __init__(self, status, message):
+        super().__init__(message)
+        self.status = status
+
+def load_json(path):
+    """Läs en JSON-fil"""
+    with open(path, 'r', encoding='utf-8') as f:
+        return json.load(f)
+
+class BoundedCache:
+    """
+    Poster i minnet, högst max_entries (None för obegränsat). När gränsen
+    nås tas den post bort som använts längst tillbaka.
+    """
+    def __init__(self, max_entries=None):
+        self.max_entries = max_entries
+        self.entries = collections.OrderedDict()
+        self.evictions = 0
+        self.lock = threading.Lock()
+    
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+    
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while self.max_entries is not None and len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+                self.evictions += 1
+    
+    def __len__(self):
+        return len(self.entries)
+
+class FileSnapshots:
+    """
+    Tolkat innehåll per fil i minnet. Filen läses och tolkas om först när
+    dess mtime eller storlek ändrats. Med max_entries hålls bara de senast
+    använda filerna kvar.
+    """
+    def __init__(self, loader, max_entries=None):
+        self.loader = loader
+        self.entries = BoundedCache(max_entries)    # sökväg -> (signatur, värde)
+    
+    def get(self, path):
+        if path is None:
+            return None
+        signature = file_signature(path)
+        entry = self.entries.get(path)
+        if entry is not None and entry[0] == signature:
+            return entry[1]
+        value = self.loader(path)
+        self.entries.put(path, (signature, value))
+        return value
+    
+    @property
+    def evictions(self):
+        return self.entries.evictions
+    
+    def __len__(self):
+        return len(self.entries)
+
+class AnalysisService:
+    """Varma cacher och AI-klient för analystjänsten"""
+    def __init__(self, root='.', engine='ai', fallback='equal', ai_limits=None, max_entries=SERVICE_MAX_ENTRIES):
+        load_modules(pd, np, asyncio, sqlite3, http_server)
+        self.root = os.path.realpath(root)
+        self.engine = engine
+        self.fallback = fallback
+        self.ai_limits = {
+            'concurrency': AI_CONCURRENCY,
+            'requests_per_minute': AI_REQUESTS_PER_MINUTE,
+            'tokens_per_minute': AI_TOKENS_PER_MINUTE,
+            **(ai_limits or {})
+        }
+        self.max_entries = max_entries
+        self.track_indexes = FileSnapshots(lambda path: get_track_index(load_track_data(path)), max_entries)
+        self.spelprocent = FileSnapshots(load_json, max_entries)
+        self.race_frames = FileSnapshots(read_race_csv, max_entries)
+        # (lopp, spelprocent, banstatistik) -> (filernas signaturer, HorseTable)
+        self.scored = BoundedCache(max_entries)
+        self.lock = threading.Lock()
+        self.started = time.time()
+        # Händelseloop och klient för AI-anrop, startas vid första AI-analysen
+        self.loop = None
+        self.async_client = None
+        self.limiter = None
+        self.semaphore = None
+    
+    def start_ai(self):
+        """Starta händelseloopen och den delade AI-klienten"""
+        with self.lock:
+            if self.loop is not None:
+                return
+            loop = asyncio.new_event_loop()
+            threading.Thread(target=loop.run_forever, name='ai-loop', daemon=True).start()
+            try:
+                asyncio.run_coroutine_threadsafe(self._open_ai(), loop).result()
+            except BaseException:
+                loop.call_soon_threadsafe(loop.stop)
+                raise
+            self.loop = loop
+    
+    async def _open_ai(self):
+        self.async_client = create_async_client()
+        self.limiter = RateLimiter(self.ai_limits['requests_per_minute'], self.ai_limits['tokens_per_minute'])
+        self.semaphore = asyncio.Semaphore(self.ai_limits['concurrency'])
+    
+    def close(self):
+        """Stäng AI-klienten och händelseloopen"""
+        with self.lock:
+            loop, self.loop = self.loop, None
+        if loop is not None:
+            try:
+                asyncio.run_coroutine_threadsafe(self.async_client.close(), loop).result(timeout=5)
+            except Exception as e:
+                metrics.record_error('serve', e)
+            loop.call_soon_threadsafe(loop.stop)
+    
+    def resolve(self, path, required=True):
+        """Sökväg relativt rotkatalogen, None om den saknas och inte krävs"""
+        if not path:
+            if required:
+                raise ServiceError(400, "Sökväg saknas i förfrågan")
+            return None
+        resolved = os.path.realpath(os.path.join(self.root, str(path)))
+        if os.path.commonpath([resolved, self.root]) != self.root:
+            raise ServiceError(403, f"{path} ligger utanför {self.root}")
+        if not os.path.exists(resolved):
+            raise ServiceError(404, f"Hittar inte {path}")
+        return resolved
+    
+    def find_card(self, directory, spelprocent=None, banstatistik=None):
+        """Omgången i en katalog, med spelprocent och banstatistik"""
+        cards = [card for card in iter_race_cards(directory, spelprocent, banstatistik) if card['card'] == '.']
+        if not cards:
+            raise ServiceError(404, f"Ingen omgång med spelprocentfil i {os.path.relpath(directory, self.root)}")
+        return cards[0]
+    
+    def score(self, race_csv_path, spelprocent_path, banstatistik_path):
+        """
+        Poängsatt lopp. Poängen räknas om först när loppfilen, spelprocent,
+        banstatistiken eller hästhistoriken ändrats. Returnerar en egen kopia
+        som kan rankas.
+        """
+        key = (race_csv_path, spelprocent_path, banstatistik_path)
+        signatures = tuple(file_signature(path) for path in key if path)
+        if history_store.enabled:
+            signatures += (file_signature(history_store.path), file_signature(history_store.path + '-wal'))
+        cached = self.scored.get(key)
+        if cached is not None and cached[0] == signatures:
+            metrics.increment('service_score_hits')
+            table = cached[1]
+        else:
+            table = self._score(race_csv_path, spelprocent_path, banstatistik_path)
+            self.scored.put(key, (signatures, table))
+        return HorseTable(table.records.copy(), table.names, table.races)
+    
+    def _score(self, race_csv_path, spelprocent_path, banstatistik_path):
+        """Poängsätt ett lopp ur cachade filer"""
+        track_index = self.track_indexes.get(banstatistik_path)
+        # Grund kopia, så att den cachade DataFrame inte får kolumnen track
+        horses_df = self.race_frames.get(race_csv_path).copy(deep=False)
+        try:
+            race_number = determine_race_number(race_csv_path, horses_df)
+        except RaceNumberError as e:
+            raise ServiceError(400, str(e))
+        detect_track(horses_df, race_csv_path, track_index)
+        result_df = calculate_betting_value(horses_df, self.spelprocent.get(spelprocent_path), race_number,
+                                            track_index)
+        card = os.path.relpath(os.path.dirname(race_csv_path), self.root)
+        return HorseTable.from_frame(result_df, card, race_number)
+    
+    def ranking_options(self, request):
+        """Förfrågans (eller tjänstens) rankingmotor och fallback"""
+        engine = request.get('engine', self.engine)
+        fallback = request.get('fallback', self.fallback)
+        if engine not in RANKING_ENGINES or fallback not in RANKING_FALLBACKS:
+            raise ServiceError(400, f"Okänd motor eller fallback: {engine}, {fallback}")
+        return engine, fallback
+    
+    def rank(self, tables, engine, fallback):
+        """Ranka loppen, AI-anropen i tjänstens händelseloop"""
+        if engine == 'local':
+            rankings = [analyze_horse_with_local_model(table) for table in tables]
+        else:
+            self.start_ai()
+            rankings = asyncio.run_coroutine_threadsafe(
+                rank_races_async(tables, self.async_client, self.limiter, self.semaphore, fallback), self.loop
+            ).result()
+        for table, ranking in zip(tables, rankings):
+            add_ranking_columns(table, ranking)
+        return tables
+    
+    @staticmethod
+    def response(tables, **fields):
+        """Svar med hästarna i samma format som batchlägets JSON"""
+        results_df = HorseTable.concat(tables).to_frame()
+        columns = [c for c in BATCH_COLUMNS if c in results_df.columns]
+        horses = json.loads(results_df[columns].to_json(orient='records', force_ascii=False))
+        return {**fields, 'horses': horses}
+    
+    @metrics.timed('service_race')
+    def analyze_race(self, request):
+        """POST /race: ett lopp"""
+        engine, fallback = self.ranking_options(request)
+        race_csv_path = self.resolve(request.get('race'))
+        spelprocent_path = self.resolve(request.get('spelprocent'), required=False)
+        banstatistik_path = self.resolve(request.get('banstatistik'), required=False)
+        if spelprocent_path is None:
+            card = self.find_card(os.path.dirname(race_csv_path), banstatistik=banstatistik_path)
+            spelprocent_path, banstatistik_path = card['spelprocent'], card['banstatistik']
+        
+        table = self.score(race_csv_path, spelprocent_path, banstatistik_path)
+        self.rank([table], engine, fallback)
+        card, race_number = table.races[0]
+        return self.response([table], card=card, race_number=race_number)
+    
+    @metrics.timed('service_card')
+    def analyze_card(self, request):
+        """POST /card: alla lopp i en omgång"""
+        engine, fallback = self.ranking_options(request)
+        directory = self.resolve(request.get('directory'))
+        card = self.find_card(directory, self.resolve(request.get('spelprocent'), required=False),
+                              self.resolve(request.get('banstatistik'), required=False))
+        tables = [self.score(path, card['spelprocent'], card['banstatistik']) for path in card['races']]
+        self.rank(tables, engine, fallback)
+        return self.response(tables, card=os.path.relpath(directory, self.root), races=len(tables))
+    
+    def warm(self, directory):
+        """Läs in och poängsätt alla omgångar under en katalog i förväg, utan ranking"""
+        races = 0
+        for card in iter_race_cards(directory):
+            for race_csv_path in card['races']:
+                self.score(race_csv_path, card['spelprocent'], card['banstatistik'])
+                races += 1
+        return races
+    
+    def health(self):
+        """GET /health"""
+        return {
+            'status': 'ok',
+            'uptime': time.time() - self.started,
+            'root': self.root,
+            'ai_client': self.loop is not None,
+            'scored_races': len(self.scored),
+            'cached_files': {
+                'races': len(self.race_frames),
+                'spelprocent': len(self.spelprocent),
+                'banstatistik': len(self.track_indexes),
+            },
+            'max_entries': self.max_entries,
+            'evictions': {
+                'scored_races': self.scored.evictions,
+                'races': self.race_frames.evictions,
+                'spelprocent': self.spelprocent.evictions,
+                'banstatistik': self.track_indexes.evictions,
+            },
+        }
+
+def make_service_handler(service):
+    """Skapa request-hanterare för en AnalysisService"""
+    routes = {
+        ('GET', '/health'): lambda request: service.health(),
+        ('GET', '/metrics'): lambda request: metrics.summary(),
+        ('POST', '/race'): service.analyze_race,
+        ('POST', '/card'): service.analyze_card,
+    }
+    
+    class ServiceHandler(http_server.BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+        
+        def log_message(self, format, *args):
+            pass
+        
+        def send_json(self, status, payload):
+            body = json.dumps(payload, ensure_ascii=False, default=str).encode('utf-8')
+            try:
+                self.send_response(status)
+                self.send_header('Content-Type', 'application/json; charset=utf-8')
+                self.send_header('Content-Length', str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+            except (BrokenPipeError, ConnectionResetError):
+                self.close_connection = True
+        
+        def handle_request(self, method):
+            started = time.perf_counter()
+            path = self.path.split('?', 1)[0].rstrip('/')
+            route = routes.get((method, path))
+            metrics.increment('service_requests')
+            status = 200
+            try:
+                if route is None:
+                    raise ServiceError(404, f"Okänd sökväg: {method} {path}")
+                length = int(self.headers.get('Content-Length') or 0)
+                if length > SERVICE_MAX_BODY:
+                    raise ServiceError(413, "För stor förfrågan")
+                try:
+                    request = json.loads(self.rfile.read(length) or b'{}')
+                except ValueError as e:
+                    raise ServiceError(400, f"Ogiltig JSON: {e}")
+                if not isinstance(request, dict):
+                    raise ServiceError(400, "Förfrågan måste vara ett JSON-objekt")
+                payload = route(request)
+            except ServiceError as e:
+                status, payload = e.status, {'error': str(e)}
+            except Exception as e:
+                metrics.record_error('serve', e)
+                status, payload = 500, {'error': str(e)}
+            if status >= 400:
+                metrics.increment('service_errors')
+            self.send_json(status, payload)
+            run_log.log('request', method=method, path=path, status=status,
+                        elapsed=time.perf_counter() - started)
+        
+        def do_GET(self):
+            self.handle_request('GET')
+        
+        def do_POST(self):
+            self.handle_request('POST')
+    
+    return ServiceHandler
+
+def create_service_server(service, host=SERVICE_HOST, port=SERVICE_PORT):
+    """Skapa tjänstens HTTP-server utan att starta den"""
+    server = http_server.ThreadingHTTPServer((host, port), make_service_handler(service), bind_and_activate=False)
+    server.daemon_threads = True
+    # Standardkön på 5 anslutningar ger sekundlånga omförsök när många klienter ansluter samtidigt
+    server.request_queue_size = SERVICE_BACKLOG
+    try:
+        server.server_bind()
+        server.server_activate()
+    except OSError:
+        server.server_close()
+        raise
+    return server
+
+def run_service(root='.', host=SERVICE_HOST, port=SERVICE_PORT, engine='ai', fallback='equal',
+                ai_limits=None, preload=None, max_entries=SERVICE_MAX_ENTRIES):
+    """Kör analystjänsten tills den avbryts"""
+    service = AnalysisService(root, engine, fallback, ai_limits, max_entries)
+    if preload:
+        started = time.perf_counter()
+        races = service.warm(service.resolve(preload))
+        print(f"Läste in {races} lopp från {preload} på {time.perf_counter() - started:.2f}s")
+    if engine == 'ai':
+        try:
+            service.start_ai()
+        except Exception as e:
+            print(f"Varning: AI-klienten kunde inte startas ({e}), försöker igen vid första analysen.")
+    
+    # Delpoängscachen sparas med jämna mellanrum, inte bara vid avslut
+    stop = threading.Event()
+    def save_periodically():
+        while not stop.wait(SERVICE_SAVE_INTERVAL):
+            feature_cache.save()
+    threading.Thread(target=save_periodically, name='feature-cache-save', daemon=True).start()
+    
+    server = create_service_server(service, host, port)
+    print(f"Analystjänsten lyssnar på http://{host}:{server.server_port} (Ctrl+C avslutar)")
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        stop.set()
+        server.server_close()
+        service.close()
+    return service
+
+# Filkatalog
+#
+# Interaktivt läge läser lopp från csv/ och spelprocent och banstatistik från
+# json/. FileCatalog indexerar katalogerna en gång och gör om indexeringen
+# först när en fil lagts till, tagits bort eller ändrats. JSON-filerna delas
+# upp efter innehåll: spelprocentfiler har nycklar V75-N med en hästlista och
+# banstatistikfiler har minst en bana. Varje lopp-CSV paras med den
+# spelprocentfil som har loppets V75-N och vars startnummer bäst stämmer med
+# loppets, och med den banstatistikfil vars bana nämns i filnamnet eller i
+# loppdata. Tolkat innehåll hålls i FileSnapshots, så varje fil läses och
+# tolkas en gång så länge den inte ändras.
+
+CSV_DIR = 'csv'
+JSON_DIR = 'json'
+SPELPROCENT_KEY_PATTERN = re.compile(r'V75-(\d+)')
+
+# Ord i filnamn som inte säger något om vilken omgång filen hör till
+FILENAME_STOPWORDS = {'lopp', 'v75', 'spelprocent', 'csv', 'json'}
+
+def spelprocent_races(data):
+    """{loppnummer: startnummer} i en spelprocentfil, tom dict om data inte är spelprocent"""
+    races = {}
+    if not isinstance(data, dict):
+        return races
+    for key, value in data.items():
+        match = SPELPROCENT_KEY_PATTERN.fullmatch(str(key))
+        if not match or not isinstance(value, dict) or not isinstance(value.get('horses'), list):
+            continue
+        numbers = set()
+        for horse in value['horses']:
+            try:
+                numbers.add(int(horse['number']))
+            except (KeyError, TypeError, ValueError):
+                continue
+        races[int(match.group(1))] = numbers
+    return races
+
+def filename_words(path):
+    """Ord i ett filnamn, för att para filer från samma omgång"""
+    words = re.findall(r'[^\W_]+', os.path.splitext(os.path.basename(path))[0].lower())
+    return {word for word in words if word not in FILENAME_STOPWORDS and not word.isdigit()}
+
+class FileCatalog:
+    """Index över lopp-CSV:er och JSON-filer med parning och tolkat innehåll per fil"""
+    def __init__(self, csv_dir=CSV_DIR, json_dir=JSON_DIR):
+        self.csv_dir = csv_dir
+        self.json_dir = json_dir
+        self.race_frames = FileSnapshots(read_race_csv)
+        self.json_files = FileSnapshots(load_json)
+        self.track_indexes = FileSnapshots(lambda path: get_track_index(self.json_files.get(path)))
+        self.signature = None
+        self.entries = []
+        self.spelprocent_files = []   # Sökvägar, i namnordning
+        self.track_files = []
+        self.races = {}               # Spelprocentfil -> {loppnummer: startnummer}
+        self.tracks = {}              # Banstatistikfil -> banor med små bokstäver
+    
+    def _signature(self):
+        """Katalogernas och de indexerade filernas (mtime, storlek)"""
+        paths = [self.csv_dir, self.json_dir] + [entry['path'] for entry in self.entries]
+        paths += self.spelprocent_files + self.track_files
+        return tuple(file_signature(path) for path in paths)
+    
+    def refresh(self):
+        """Lopp i csv/ med parade JSON-filer. Indexerar bara om något ändrats."""
+        signature = self._signature()
+        if signature == self.signature:
+            return self.entries
+        
+        metrics.increment('catalog_scans')
+        self._index_json()
+        self.entries = [
+            self._pair(os.path.join(self.csv_dir, filename))
+            for filename in sorted(list_csv_files(self.csv_dir))
+        ]
+        self.signature = self._signature()
+        return self.entries
+    
+    def _index_json(self):
+        """Dela upp JSON-filerna i spelprocent och banstatistik efter innehåll"""
+        self.spelprocent_files, self.track_files, self.races, self.tracks = [], [], {}, {}
+        for filename in sorted(list_json_files(self.json_dir)):
+            if is_result_file(filename):
+                continue
+            path = os.path.join(self.json_dir, filename)
+            try:
+                races = spelprocent_races(self.json_files.get(path))
+                if races:
+                    self.spelprocent_files.append(path)
+                    self.races[path] = races
+                    continue
+                track_index = self.track_indexes.get(path)
+                tracks = track_index.tracks() if track_index is not None else []
+            except Exception as e:
+                print(f"Kunde inte läsa {path}: {e}")
+                metrics.record_error('catalog', e)
+                continue
+            if tracks:
+                self.track_files.append(path)
+                self.tracks[path] = [str(track).lower() for track in tracks]
+    
+    def _frame(self, path):
+        """Loppdata ur cachen, None om filen inte går att läsa"""
+        try:
+            return self.race_frames.get(path)
+        except Exception as e:
+            print(f"Kunde inte läsa {path}: {e}")
+            metrics.record_error('catalog', e)
+            return None
+    
+    def _pair(self, path):
+        """Loppnummer, spelprocentfil och banstatistikfil för en lopp-CSV"""
+        entry = {'path': path, 'race_number': None, 'spelprocent': None, 'banstatistik': None, 'problem': None}
+        race_number = race_number_from_filename(path)
+        if race_number is None:
+            try:
+                race_number = determine_race_number(path, self._frame(path))
+            except RaceNumberError as e:
+                entry['problem'] = str(e)
+                return entry
+        entry['race_number'] = race_number
+        entry['spelprocent'] = self.match_spelprocent(path, race_number)
+        entry['banstatistik'] = self.match_track(path)
+        if entry['spelprocent'] is None:
+            entry['problem'] = f"ingen spelprocentfil har V75-{race_number}"
+        return entry
+    
+    def match_spelprocent(self, path, race_number):
+        """Spelprocentfilen med loppets V75-N, vid flera den som bäst stämmer med loppet"""
+        candidates = [sp for sp in self.spelprocent_files if race_number in self.races[sp]]
+        if len(candidates) <= 1:
+            return candidates[0] if candidates else None
+        
+        horses_df = self._frame(path)
+        start_numbers = set()
+        if horses_df is not None:
+            start_numbers = set(pd.to_numeric(horses_df['start_number'], errors='coerce').dropna().astype(int))
+        words = filename_words(path)
+        
+        def score(candidate):
+            overlap = len(start_numbers & self.races[candidate][race_number]) / max(len(start_numbers), 1)
+            signature = file_signature(candidate) or (0, 0)
+            return overlap, len(words & filename_words(candidate)), signature[0]
+        return max(candidates, key=score)
+    
+    def match_track(self, path):
+        """Banstatistikfilen vars bana nämns i filnamnet eller loppdata, eller den enda filen"""
+        if len(self.track_files) == 1:
+            return self.track_files[0]
+        filename = os.path.basename(path).lower()
+        for track_file in self.track_files:
+            if any(track in filename for track in self.tracks[track_file]):
+                return track_file
+        
+        horses_df = self._frame(path)
+        if horses_df is not None and 'track' in horses_df.columns:
+            race_tracks = set(horses_df['track'].dropna().astype(str).str.lower())
+            for track_file in self.track_files:
+                if race_tracks & set(self.tracks[track_file]):
+                    return track_file
+        return None
+    
+    def describe(self, entry):
+        """En rad om ett lopp och dess parade filer"""
+        name = os.path.basename(entry['path'])
+        if entry['race_number'] is None:
+            return f"{name}  ({entry['problem']})"
+        spelprocent = os.path.basename(entry['spelprocent']) if entry['spelprocent'] else 'ingen spelprocent'
+        banstatistik = os.path.basename(entry['banstatistik']) if entry['banstatistik'] else 'ingen banstatistik'
+        return f"{name}  (lopp {entry['race_number']}, {spelprocent}, {banstatistik})"
+    
+    def analyze(self, entry, engine='ai', fallback='equal'):
+        """Analysera ett lopp ur katalogen med redan tolkade filer"""
+        horses_df = self._frame(entry['path'])
+        if horses_df is None:
+            return None
+        # Grund kopia, så att den cachade DataFrame inte får kolumnen track
+        return analyze_loaded_race(
+            horses_df.copy(deep=False),
+            self.json_files.get(entry['spelprocent']),
+            entry['race_number'],
+            self.track_indexes.get(entry['banstatistik']),
+            entry['path'],
+            engine,
+            fallback
+        )
+
+def select_race_entry(catalog):
+    """
+    Låt användaren välja ett lopp ur katalogen. Saknas loppnummer eller
+    spelprocentfil får användaren ange dem. None vid ogiltigt val.
+    """
+    entries = catalog.refresh()
+    if not entries:
+        print("Inga CSV-filer hittades. Lägg till filer och försök igen.")
+        return None
+    
+    print("\nTillgängliga lopp:")
+    for i, entry in enumerate(entries, 1):
+        print(f"{i}. {catalog.describe(entry)}")
+    try:
+        choice = int(input("\nVälj filnummer: "))
+    except ValueError:
+        print("Ange ett giltigt nummer!")
+        return None
+    if not 1 <= choice <= len(entries):
+        print("Ogiltigt val!")
+        return None
+    
+    entry = dict(entries[choice - 1])
+    if entry['race_number'] is None:
+        try:
+            entry['race_number'] = int(input("Loppnummer (V75-N): "))
+        except ValueError:
+            print("Ange ett giltigt nummer!")
+            return None
+        entry['spelprocent'] = catalog.match_spelprocent(entry['path'], entry['race_number'])
+        entry['banstatistik'] = catalog.match_track(entry['path'])
+    if entry['spelprocent'] is None:
+        entry['spelprocent'], entry['banstatistik'] = select_json_files(catalog)
+        if not entry['spelprocent']:
+            return None
+    return entry
+
 # Huvudprogram
-def main():
+def run_interactive(engine='ai', fallback='equal'):
     """
-    Huvudprogram för V75 Spelvärdesanalys
+    Interaktiv analys av ett lopp i taget
     """
     print("===== V75 SPELVÄRDESANALYS =====")
     print("En app för att hitta bästa värdespel i V75")
     
+    # Katalogen och de tolkade filerna behålls mellan loppen
+    catalog = FileCatalog()
     while True:
         try:
-            # Välj CSV-fil
-            csv_path = select_csv_file()
-            if not csv_path:
-                continue
-            
-            # Välj JSON-filer
-            spelprocent_path, banstatistik_path = select_json_files()
-            
-            if not spelprocent_path:
+            # Välj lopp, spelprocent och banstatistik paras automatiskt
+            entry = select_race_entry(catalog)
+            if not entry:
                 continue
             
             # Analysera loppet
-            result = analyze_race(csv_path, spelprocent_path, banstatistik_path)
+            result = catalog.analyze(entry, engine, fallback)
             
         except Exception as e:
             print(f"Ett oväntat fel inträffade: {e}")
@@ -735,6 +5329,316 @@ def main():
     
     print("\nTack för att du använder V75 Spelvärdesanalys!")
 
+def add_cache_arguments(parser, defaults=True):
+    """Flaggor för AI-cachen, delpoängscachen och kolumnlagret (defaults som i shared_parsers)"""
+    def default(value):
+        return value if defaults else argparse.SUPPRESS
+    
+    parser.add_argument('--no-cache', action='store_true', default=default(False), help="Använd inte AI-cachen")
+    parser.add_argument('--refresh-cache', action='store_true', default=default(False),
+                        help="Hämta nya AI-svar och skriv över cachen")
+    parser.add_argument('--clear-cache', action='store_true', default=default(False),
+                        help="Töm AI-cachen och delpoängscachen innan körning")
+    parser.add_argument('--cache-dir', default=default(AI_CACHE_DIR), help="Katalog för AI-cachen")
+    parser.add_argument('--no-feature-cache', action='store_true', default=default(False),
+                        help="Använd inte delpoängscachen")
+    parser.add_argument('--feature-cache-dir', default=default(FEATURE_CACHE_DIR), help="Katalog för delpoängscachen")
+    parser.add_argument('--no-columnar', action='store_true', default=default(False),
+                        help="Läs CSV-filerna även om kolumnlager finns")
+    parser.add_argument('--columnar-dir', default=default(COLUMNAR_DIR), help="Katalog för kolumnlagret")
+
+def configure_ai_cache(args):
+    """Ställ in den delade AI-cachen, delpoängscachen och kolumnlagret från kommandoradsflaggor"""
+    ai_cache.directory = args.cache_dir
+    ai_cache.enabled = not args.no_cache
+    ai_cache.refresh = args.refresh_cache
+    feature_cache.directory = args.feature_cache_dir
+    feature_cache.enabled = not args.no_feature_cache
+    columnar_store.directory = args.columnar_dir
+    columnar_store.enabled = not args.no_columnar
+    if args.clear_cache:
+        ai_cache.clear()
+        feature_cache.clear()
+
+def configure_ai_transport(args):
+    """Ställ in den delade AI-transporten och ensemblen från kommandoradsflaggor"""
+    ai_ensemble.samples = max(1, args.ai_samples)
+    ai_ensemble.min_samples = max(1, args.ai_min_samples)
+    ai_ensemble.tolerance = args.ai_tolerance
+    ai_transport.timeout = args.ai_timeout
+    ai_transport.deadline = max(args.ai_deadline, args.ai_timeout)
+    ai_transport.max_attempts = max(1, args.ai_attempts)
+    ai_transport.hedge = args.ai_hedge
+    ai_transport.hedge_percentile = args.ai_hedge_percentile
+
+def configure_history(args):
+    """Slå på hästhistoriken från kommandoradsflaggor"""
+    history_store.path = args.history_db
+    history_store.depth = args.history_depth
+
+def configure_params(args):
+    """Läs in poängparametrar från --params"""
+    if not args.params:
+        return
+    try:
+        scoring_params.load(args.params)
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        sys.exit(f"Kunde inte läsa parameterfilen {args.params}: {e}")
+
+def shared_parsers(defaults=True):
+    """
+    Flaggor som gäller både före och efter underkommandot: rankingmotor,
+    mätning, hästhistorik och cacher. Underkommandonas kopior saknar standardvärden
+    (defaults=False) så att de inte skriver över flaggor givna före kommandot.
+    """
+    def default(value):
+        return value if defaults else argparse.SUPPRESS
+    
+    # Val av rankingmotor gäller både interaktivt läge och batchläge
+    ranking = argparse.ArgumentParser(add_help=False)
+    ranking.add_argument('--engine', choices=RANKING_ENGINES, default=default(None),
+                         help="Rankingmotor: AI-anrop eller lokal modell (standard: ai, local för backtest)")
+    ranking.add_argument('--fallback', choices=RANKING_FALLBACKS, default=default('equal'),
+                         help="Fallback om AI-analysen misslyckas: jämn fördelning eller lokal modell")
+    ranking.add_argument('--ai-timeout', type=float, default=default(AI_CALL_TIMEOUT),
+                         help="Tidsgräns i sekunder per AI-försök")
+    ranking.add_argument('--ai-deadline', type=float, default=default(AI_CALL_DEADLINE),
+                         help="Total tid i sekunder per AI-anrop, inklusive nya försök")
+    ranking.add_argument('--ai-attempts', type=int, default=default(AI_MAX_ATTEMPTS),
+                         help="Max antal försök per AI-anrop vid tillfälliga fel")
+    ranking.add_argument('--ai-hedge', action='store_true', default=default(False),
+                         help="Skicka ett extra anrop när ett svar dröjer ovanligt länge")
+    ranking.add_argument('--ai-samples', type=int, default=default(AI_ENSEMBLE_SAMPLES),
+                         help="Antal AI-svar per lopp som medelvärdesbildas (ensemble)")
+    ranking.add_argument('--ai-min-samples', type=int, default=default(AI_ENSEMBLE_MIN_SAMPLES),
+                         help="Minsta antal svar innan ensemblen kan avslutas i förtid")
+    ranking.add_argument('--ai-tolerance', type=float, default=default(AI_ENSEMBLE_TOLERANCE),
+                         help="Avsluta ensemblen när medelfelet per häst är högst så många procentenheter")
+    ranking.add_argument('--ai-hedge-percentile', type=float, default=default(AI_HEDGE_PERCENTILE),
+                         help="Percentil av tidigare svarstider som utlöser ett extra anrop")
+    
+    # Mätning och profilering
+    instrumentation = argparse.ArgumentParser(add_help=False)
+    instrumentation.add_argument('--metrics', default=default(None),
+                                 help="Spara mätvärden för körningen som JSON")
+    instrumentation.add_argument('--profile', default=default(None),
+                                 help="Profilera poängberäkningen med cProfile och spara profilen")
+    instrumentation.add_argument('--run-log-dir', default=default(RUN_LOG_DIR), help="Katalog för körloggen")
+    instrumentation.add_argument('--no-run-log', action='store_true', default=default(False),
+                                 help="Skriv ingen körlogg")
+    
+    # Hästhistorik för form- och distanspoäng
+    scoring = argparse.ArgumentParser(add_help=False)
+    scoring.add_argument('--history-db', default=default(None),
+                         help="Hästhistorik (SQLite) som ger form och distans fler lopp")
+    scoring.add_argument('--history-depth', type=int, default=default(HISTORY_DEPTH),
+                         help="Antal tidigare lopp per häst när hästhistorik används")
+    scoring.add_argument('--params', default=default(None),
+                         help="Parameterfil från fit med vikter, poängtabell och lokal modell")
+    
+    # AI-cachen, delpoängscachen och kolumnlagret
+    caching = argparse.ArgumentParser(add_help=False)
+    add_cache_arguments(caching, defaults)
+    
+    return ranking, instrumentation, scoring, caching
+
+def parse_args(argv=None):
+    """Tolka kommandoradsargument"""
+    parser = argparse.ArgumentParser(description="V75 Spelvärdesanalys", parents=shared_parsers())
+    ranking, instrumentation, scoring, caching = shared_parsers(defaults=False)
+    subparsers = parser.add_subparsers(dest='command')
+    
+    batch = subparsers.add_parser('batch', parents=[ranking, instrumentation, scoring, caching],
+                                  help="Analysera alla lopp i en katalog utan interaktiva val")
+    batch.add_argument('directory', help="Katalog med \"Lopp N\"-filer, eller en katalog med flera omgångar")
+    batch.add_argument('--spelprocent', help="Spelprocentfil (annars söks den i varje omgångskatalog)")
+    batch.add_argument('--banstatistik', help="Banstatistikfil (annars söks den i varje omgångskatalog)")
+    batch.add_argument('--output', default='resultat.csv', help="Samlad resultatfil (.csv eller .json)")
+    batch.add_argument('--workers', type=int, default=None, help="Antal arbetsprocesser för poängberäkning")
+    batch.add_argument('--no-ai', action='store_true', help="Hoppa över AI-ranking")
+    batch.add_argument('--stream', action='store_true',
+                       help="Poängsätt och skriv resultatet block för block, med konstant minnesåtgång")
+    batch.add_argument('--chunk-races', type=int, default=STREAM_CHUNK_RACES,
+                       help="Antal lopp per block med --stream")
+    batch.add_argument('--ai-concurrency', type=int, default=AI_CONCURRENCY, help="Max antal samtidiga AI-anrop")
+    batch.add_argument('--ai-rpm', type=int, default=AI_REQUESTS_PER_MINUTE, help="Max antal AI-anrop per minut")
+    batch.add_argument('--ai-tpm', type=int, default=AI_TOKENS_PER_MINUTE, help="Max antal tokens per minut")
+    
+    system = subparsers.add_parser('system', help="Optimera ett V75-system från en resultatfil")
+    system.add_argument('results', help="Resultatfil från batchläget (.csv eller .json)")
+    system.add_argument('--budget', type=float, required=True, help="Max kostnad i kronor")
+    system.add_argument('--card', help="Omgång i resultatfilen (standard: första)")
+    system.add_argument('--model-column', default='ai_percentage', help="Kolumn med modellens procent")
+    
+    simulate = subparsers.add_parser('simulate', help="Monte Carlo-simulera ett V75-system")
+    simulate.add_argument('results', help="Resultatfil från batchläget (.csv eller .json)")
+    simulate.add_argument('--budget', type=float, help="Optimera system inom budget (kronor)")
+    simulate.add_argument('--selections', help="System som '1,4;2;7,8,9', lopp separerade med semikolon")
+    simulate.add_argument('--card', help="Omgång i resultatfilen (standard: första)")
+    simulate.add_argument('--model-column', default='ai_percentage', help="Kolumn med modellens procent")
+    simulate.add_argument('--samples', type=int, default=1000000, help="Antal simulerade omgångar")
+    simulate.add_argument('--workers', type=int, default=1, help="Antal processer")
+    simulate.add_argument('--seed', type=int, default=None)
+    
+    backtest = subparsers.add_parser('backtest', parents=[ranking, instrumentation, scoring, caching],
+                                     help="Utvärdera rankingen mot historiska resultat")
+    backtest.add_argument('directory', help="Katalog med historiska omgångar (med resultatfiler)")
+    backtest.add_argument('--workers', type=int, default=None, help="Antal arbetsprocesser")
+    backtest.add_argument('--output', help="Spara nyckeltal som JSON")
+    
+    watch = subparsers.add_parser('watch', parents=[ranking, instrumentation, scoring, caching],
+                                  help="Bevaka spelprocent för en omgång och visa avvikelser löpande")
+    watch.add_argument('directory', help="Katalog med \"Lopp N\"-filer för en omgång")
+    watch.add_argument('--spelprocent', help="Spelprocentfil att bevaka (annars söks den i katalogen)")
+    watch.add_argument('--banstatistik', help="Banstatistikfil (annars söks den i katalogen)")
+    watch.add_argument('--interval', type=float, default=WATCH_INTERVAL, help="Sekunder mellan kontroller")
+    watch.add_argument('--output', help="Skriv aktuellt resultat (.csv eller .json) vid varje uppdatering")
+    watch.add_argument('--duration', type=float, help="Avsluta efter så många sekunder")
+    
+    fit = subparsers.add_parser('fit', parents=[scoring],
+                                help="Anpassa vikter och poängtabell mot historiska resultat")
+    fit.add_argument('directory', help="Katalog med historiska omgångar (med resultatfiler)")
+    fit.add_argument('--output', default=FIT_PARAMS_PATH, help="Parameterfil att spara")
+    fit.add_argument('--folds', type=int, default=FIT_FOLDS, help="Antal delar i korsvalideringen")
+    fit.add_argument('--workers', type=int, default=None, help="Antal arbetsprocesser (0 kör i huvudprocessen)")
+    fit.add_argument('--seed', type=int, default=0, help="Slumpfrö för indelningen av omgångar")
+    
+    history = subparsers.add_parser('history', help="Läs in omgångar och resultat i hästhistoriken")
+    history.add_argument('directory', help="Katalog med en eller flera omgångar")
+    history.add_argument('--db', default=HISTORY_DB_PATH, help="Databasfil för hästhistoriken")
+    
+    serve = subparsers.add_parser('serve', parents=[ranking, scoring, caching],
+                                  help="Starta en lokal analystjänst (HTTP/JSON) med varma cacher")
+    serve.add_argument('--host', default=SERVICE_HOST, help="Adress att lyssna på")
+    serve.add_argument('--port', type=int, default=SERVICE_PORT, help="Port att lyssna på")
+    serve.add_argument('--root', default='.', help="Katalog som förfrågningarnas sökvägar tolkas relativt")
+    serve.add_argument('--preload', help="Läs in och poängsätt alla omgångar i katalogen vid start")
+    serve.add_argument('--max-entries', type=int, default=SERVICE_MAX_ENTRIES,
+                       help="Max antal filer och poängsatta lopp per cache i minnet")
+    serve.add_argument('--ai-concurrency', type=int, default=AI_CONCURRENCY, help="Max antal samtidiga AI-anrop")
+    serve.add_argument('--ai-rpm', type=int, default=AI_REQUESTS_PER_MINUTE, help="Max antal AI-anrop per minut")
+    serve.add_argument('--ai-tpm', type=int, default=AI_TOKENS_PER_MINUTE, help="Max antal tokens per minut")
+    
+    ingest = subparsers.add_parser('ingest', help="Läs in CSV-filer till typade, minnesmappade kolumner")
+    ingest.add_argument('directory', help="Katalog med CSV-filer, eller en katalog med flera omgångar")
+    ingest.add_argument('--columnar-dir', default=argparse.SUPPRESS, help="Katalog för kolumnlagret")
+    
+    runs = subparsers.add_parser('runs', help="Visa tidigare körningar och AI-analyser från körloggen")
+    runs.add_argument('--dir', default=RUN_LOG_DIR, help="Katalog med körloggen")
+    runs.add_argument('--run', help="Bara analyser från körningen (id eller början av id)")
+    runs.add_argument('--horse', help="Bara analyser där hästen ingår")
+    runs.add_argument('--fallbacks', action='store_true', help="Bara analyser som föll tillbaka")
+    runs.add_argument('--since', help="Från och med tidpunkt, t.ex. 2024-05-01 eller 2024-05-01T18:00")
+    runs.add_argument('--json', action='store_true', help="Skriv matchande analyser som JSONL")
+    runs.add_argument('--limit', type=int, help="Bara de senaste N")
+    
+    args = parser.parse_args(argv)
+    if args.engine is None:
+        # Backtest går mot många historiska lopp och körs lokalt om inget annat anges
+        args.engine = 'local' if args.command == 'backtest' else 'ai'
+    return args
+
+def main(argv=None):
+    """
+    Huvudprogram för V75 Spelvärdesanalys
+    """
+    args = parse_args(argv)
+    
+    if getattr(args, 'profile', None):
+        metrics.enable_profiling()
+    run_log.directory = getattr(args, 'run_log_dir', RUN_LOG_DIR)
+    run_log.enabled = not getattr(args, 'no_run_log', False)
+    
+    try:
+        run_command(args)
+    finally:
+        feature_cache.save()
+        if run_log.thread is not None:
+            summary = metrics.summary()
+            run_log.log('run_end', command=args.command, argv=sys.argv[1:], wall_time=summary['wall_time'],
+                        counters=summary['counters'], tokens=summary['tokens'])
+            run_log.close()
+        if getattr(args, 'metrics', None):
+            metrics.print_summary()
+            metrics.write(args.metrics)
+            print(f"Mätvärden sparade i: {args.metrics}")
+        if getattr(args, 'profile', None):
+            metrics.write_profile(args.profile)
+            print(f"Profil sparad i: {args.profile}")
+
+def run_command(args):
+    """Kör valt kommando"""
+    configure_ai_transport(args)
+    configure_history(args)
+    configure_params(args)
+    if args.command == 'batch':
+        configure_ai_cache(args)
+        options = dict(
+            spelprocent_path=args.spelprocent,
+            banstatistik_path=args.banstatistik,
+            output_path=args.output,
+            workers=args.workers,
+            use_ai=not args.no_ai,
+            ai_limits={
+                'concurrency': args.ai_concurrency,
+                'requests_per_minute': args.ai_rpm,
+                'tokens_per_minute': args.ai_tpm
+            },
+            engine=args.engine,
+            fallback=args.fallback
+        )
+        if args.stream:
+            run_batch_stream(args.directory, chunk_races=args.chunk_races, **options)
+        else:
+            run_batch(args.directory, **options)
+    elif args.command == 'system':
+        run_system(args.results, args.budget, args.card, args.model_column)
+    elif args.command == 'backtest':
+        configure_ai_cache(args)
+        run_backtest(args.directory, args.engine, args.fallback, args.workers, args.output)
+    elif args.command == 'watch':
+        configure_ai_cache(args)
+        run_watch(args.directory, args.spelprocent, args.banstatistik, args.engine, args.fallback,
+                  args.interval, args.output, args.duration)
+    elif args.command == 'fit':
+        run_fit(args.directory, args.output, args.folds, args.workers, args.seed)
+    elif args.command == 'history':
+        run_history_ingest(args.directory, args.db)
+    elif args.command == 'serve':
+        configure_ai_cache(args)
+        run_service(
+            args.root,
+            host=args.host,
+            port=args.port,
+            engine=args.engine,
+            fallback=args.fallback,
+            ai_limits={
+                'concurrency': args.ai_concurrency,
+                'requests_per_minute': args.ai_rpm,
+                'tokens_per_minute': args.ai_tpm
+            },
+            preload=args.preload,
+            max_entries=args.max_entries
+        )
+    elif args.command == 'ingest':
+        run_columnar_ingest(args.directory, args.columnar_dir)
+    elif args.command == 'runs':
+        run_log_report(args.dir, args.run, args.horse, args.fallbacks, args.since, args.json, args.limit)
+    elif args.command == 'simulate':
+        run_simulation(
+            args.results,
+            budget=args.budget,
+            selections=parse_selections(args.selections) if args.selections else None,
+            card=args.card,
+            model_column=args.model_column,
+            samples=args.samples,
+            workers=args.workers,
+            seed=args.seed
+        )
+    else:
+        configure_ai_cache(args)
+        run_interactive(args.engine, args.fallback)
+
 # Säkerställ att programmet bara körs när det startas direkt
 if __name__ == "__main__":
     main()
\ No newline at end of file
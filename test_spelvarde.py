@@ -0,0 +1,206 @@
+import asyncio
+import json
+
+import numpy as np
+import pandas as pd
+
+import spelvarde
+
+def simulate_first_race(first_race, selected_first_race, samples=10000):
+    """Simulera en omgång där bara första loppet är osäkert, övriga lopp vinns alltid av vald häst 1"""
+    model = np.zeros((7, len(first_race)))
+    model[0] = first_race
+    model[1:, 0] = 1.0
+    selected = np.zeros(model.shape, dtype=bool)
+    selected[0] = selected_first_race
+    selected[1:, 0] = True
+    public = np.full(model.shape, 1 / model.shape[1])
+    stats = spelvarde.simulate_v75_batch(model, public, selected, samples, np.random.default_rng(0))
+    return stats['correct_counts'][7] / stats['samples']
+
+def test_simulate_v75_batch_zero_probability_horse_inside_field():
+    """En häst med 0 % mitt i fältet vinner aldrig, hästen efter den vinner sin andel"""
+    first_race = [0.5, 0.0, 0.5, 0.0]
+    assert 0.45 < simulate_first_race(first_race, [False, False, True, False]) < 0.55
+    assert simulate_first_race(first_race, [False, True, False, True]) == 0
+
+def baseline_horses_data(horses_df):
+    """Hästdata till AI som den byggdes rad för rad före HorseTable"""
+    return [
+        {
+            "name": horse['name'],
+            "start_number": horse['start_number'],
+            "form_score": round(horse['form_score'], 2),
+            "career_earnings": horse['earnings'],
+            "distance_1640_score": round(horse['distance_1640_score'], 2),
+            "distance_2140_score": round(horse['distance_2140_score'], 2),
+            "distance_2640_score": round(horse['distance_2640_score'], 2),
+            "track_position_score": round(horse['track_position_score'], 2),
+            "betting_percentage": round(horse['betting_percentage'], 2)
+        }
+        for _, horse in horses_df.iterrows()
+    ]
+
+def test_ai_prompt_unchanged_by_horse_table():
+    """Prompten (och därmed AI-cachens nyckel) är densamma som före HorseTable"""
+    horses_df = pd.DataFrame({
+        'name': ['Alfa', 'Beta', 'Gamma'],
+        'start_number': [1, 2, 3],
+        'earnings': [1202542, 0, 87500],
+        'form_score': [7.0, 3.8, 5.25],
+        'distance_1640_score': [6.5, 4.125, 0.0],
+        'distance_2140_score': [7.31, 2.0, 5.5],
+        'distance_2640_score': [0.0, 9.99, 3.333],
+        'track_position_score': [8.2, 6.1, 4.4],
+        'betting_percentage': [45.5, 30.25, 24.25],
+    })
+    expected = spelvarde.build_ai_prompt(baseline_horses_data(horses_df))
+    assert spelvarde.build_ai_prompt(spelvarde.prepare_horses_data(horses_df)) == expected
+
+def test_shared_flags_before_subcommand_are_kept():
+    """Flaggor före underkommandot skrivs inte över av underkommandots standardvärden"""
+    args = spelvarde.parse_args(['--engine', 'local', '--fallback', 'local', '--history-db', 'x.sqlite',
+                                 '--ai-samples', '5', '--metrics', 'm.json', 'batch', 'd'])
+    assert (args.engine, args.fallback, args.history_db, args.ai_samples, args.metrics) == (
+        'local', 'local', 'x.sqlite', 5, 'm.json')
+    args = spelvarde.parse_args(['--ai-samples', '5', 'batch', 'd', '--ai-samples', '3'])
+    assert args.ai_samples == 3
+    assert spelvarde.parse_args(['batch', 'd']).engine == 'ai'
+
+def test_backtest_defaults_to_local_engine():
+    """Backtest körs lokalt om ingen motor anges, men en uttrycklig motor gäller"""
+    assert spelvarde.parse_args(['backtest', 'd']).engine == 'local'
+    assert spelvarde.parse_args(['--engine', 'ai', 'backtest', 'd']).engine == 'ai'
+    assert spelvarde.parse_args(['backtest', 'd', '--engine', 'ai']).engine == 'ai'
+
+def test_empty_history_leaves_scores_unchanged(tmp_path):
+    """Historik påslagen utan äldre lopp i databasen ger samma poäng som utan historik"""
+    horses_df = pd.DataFrame({
+        'name': ['Alfa', 'Beta', 'Gamma', 'Delta'],
+        'start_number': [1, 2, 3, 4],
+        'career_results': ['25 6-4-3', '12 2-1-1', '3 0-0-1', '0 0-0-0'],
+        'earnings': [1202542, 250000, 15000, 0],
+        'previous_race_1_position': ['1', '3', '6', None],
+        'previous_race_1_distance': [2140, 2140, 1640, None],
+        'previous_race_2_position': ['2', 'd', '4', None],
+        'previous_race_2_distance': [2140, 2640, 2140, None],
+        'previous_race_3_position': ['4', '0', '3', None],
+        'previous_race_3_distance': [1640, 2140, 2140, None],
+    })
+    store = spelvarde.HistoryStore(str(tmp_path / 'historik.sqlite'))
+    store.connect()
+    extended = store.extend(horses_df)
+    assert 'previous_race_4_position' in extended.columns
+    expected = spelvarde.score_horses(horses_df)
+    scores = spelvarde.score_horses(extended)
+    for column in spelvarde.FEATURE_COLUMNS:
+        np.testing.assert_array_equal(scores[column], expected[column])
+
+def test_race_number_from_filename():
+    """Loppnummer ur filnamn, även när omgångens datum står före loppnumret"""
+    cases = {
+        'Lopp 3.csv': 3,
+        'V75-2024-05-04 Lopp 3.csv': 3,
+        'V75_20240504_lopp3.csv': 3,
+        'data/V75-5.csv': 5,
+        'V75 7 Solvalla.csv': 7,
+        'V75-2024-05-04.csv': None,
+        'V758.csv': None,
+    }
+    for filename, expected in cases.items():
+        assert spelvarde.race_number_from_filename(filename) == expected, filename
+
+def track_stats(*percentages):
+    """Spårstatistik med en segerprocent per spår från spår 1"""
+    return [{'spår': str(i), 'segerprocent': {'värde': f'{p}%'}} for i, p in enumerate(percentages, 1)]
+
+def test_track_index_defaults_to_axevalla_high_class():
+    """Utan känd bana och distansklass gäller Axevalla, autostart, hög oavsett ordning i filen"""
+    track_index = spelvarde.TrackIndex({'spårstatistik': {
+        'Solvalla': {'autostart': {'låg': track_stats(2, 2)}},
+        'Axevalla': {'autostart': {'mellan': track_stats(3, 3), 'hög': track_stats(9, 7)}},
+    }})
+    np.testing.assert_array_equal(track_index.scores([1, 2]), [9.0, 7.0])
+    np.testing.assert_array_equal(track_index.scores([1, 2], track='Okänd', distance_class='okänd'), [9.0, 7.0])
+    np.testing.assert_array_equal(track_index.scores([1], track='Solvalla'), [2.0])
+    np.testing.assert_array_equal(track_index.scores([1], distance_class='mellan'), [3.0])
+
+def scored_race(names, race_number):
+    """Ett poängsatt lopp som HorseTable"""
+    columns = {column: [5.0] * len(names) for column in spelvarde.HORSE_SCORE_COLUMNS}
+    horses_df = pd.DataFrame({'name': names, 'start_number': list(range(1, len(names) + 1)),
+                              'earnings': [0] * len(names), **columns})
+    return spelvarde.HorseTable.from_frame(horses_df, 'omgång', race_number)
+
+def test_failing_race_falls_back_without_aborting_card(monkeypatch):
+    """Ett lopp som inte går att förbereda faller tillbaka, övriga lopp analyseras ändå"""
+    broken = scored_race(['Alfa', 'Beta'], 1)
+    working = scored_race(['Gamma', 'Delta'], 2)
+    prepare = spelvarde.prepare_horses_data
+    
+    def prepare_or_fail(horses):
+        if horses is broken:
+            raise ValueError("trasig häst")
+        return prepare(horses)
+    
+    async def request(messages, horses_data, *args):
+        ranking = {'horses': [{'name': h['name'], 'start_number': h['start_number'],
+                               'calculated_percentage': 50.0} for h in horses_data],
+                   'analysis_summary': 'ok'}
+        return ranking, json.dumps(ranking), True
+    
+    monkeypatch.setattr(spelvarde, 'prepare_horses_data', prepare_or_fail)
+    monkeypatch.setattr(spelvarde, 'request_ai_ranking_async', request)
+    rankings = asyncio.run(spelvarde.rank_races_async(
+        [broken, working], None, spelvarde.RateLimiter(), asyncio.Semaphore(2)))
+    assert spelvarde.is_fallback_ranking(rankings[0])
+    assert rankings[1]['analysis_summary'] == 'ok'
+
+def test_file_snapshots_evict_least_recently_used(tmp_path):
+    """Med max_entries hålls bara de senast använda filerna kvar"""
+    paths = []
+    for name in ('a', 'b', 'c'):
+        path = tmp_path / f'{name}.json'
+        path.write_text(json.dumps(name), encoding='utf-8')
+        paths.append(str(path))
+    loads = []
+    snapshots = spelvarde.FileSnapshots(lambda path: loads.append(path) or spelvarde.load_json(path), max_entries=2)
+    a, b, c = paths
+    assert [snapshots.get(path) for path in (a, b, a, c, a)] == ['a', 'b', 'a', 'c', 'a']
+    assert loads == [a, b, c]
+    assert (len(snapshots), snapshots.evictions) == (2, 1)
+    snapshots.get(b)
+    assert loads == [a, b, c, b]
+
+def test_feature_cache_not_written_when_unused(tmp_path):
+    """Körningar som inte poängsätter något lopp skriver ingen delpoängscache"""
+    cache = spelvarde.FeatureCache(str(tmp_path / 'features'))
+    cache.save()
+    assert not (tmp_path / 'features').exists()
+
+def test_cache_flags_apply_to_interactive_mode(monkeypatch):
+    """Interaktivt läge kan stänga av cacherna med samma flaggor som batchläget"""
+    for cache, name in ((spelvarde.ai_cache, 'enabled'), (spelvarde.ai_cache, 'directory'),
+                        (spelvarde.feature_cache, 'enabled'), (spelvarde.feature_cache, 'directory'),
+                        (spelvarde.columnar_store, 'enabled'), (spelvarde.columnar_store, 'directory')):
+        monkeypatch.setattr(cache, name, getattr(cache, name))
+    args = spelvarde.parse_args(['--no-feature-cache', '--no-cache'])
+    spelvarde.configure_ai_cache(args)
+    assert not spelvarde.feature_cache.enabled and not spelvarde.ai_cache.enabled
+    args = spelvarde.parse_args(['--no-feature-cache', 'batch', 'd'])
+    assert args.no_feature_cache and args.columnar_dir == spelvarde.COLUMNAR_DIR
+
+def certain_payout_summary(payout_factor):
+    """Sammanfattning av en omgång där systemets enda rad alltid ger payout_factor gånger kostnaden"""
+    model = np.zeros((7, 2))
+    model[:, 0] = 1.0
+    selected = model.astype(bool)
+    public_share = spelvarde.V75_PAYOUT_RATE * spelvarde.V75_POOL_SHARES[7] / payout_factor
+    public = np.full(model.shape, public_share ** (1 / 7))
+    stats = spelvarde.simulate_v75_batch(model, public, selected, 100, np.random.default_rng(0))
+    return spelvarde.summarize_simulation(stats, spelvarde.V75_ROW_PRICE)
+
+def test_profit_probability_counts_payouts_above_cost():
+    """Utdelning strax under kostnaden är ingen vinst även i samma histogramfack som kostnaden"""
+    assert certain_payout_summary(0.99)['profit_probability'] == 0
+    assert certain_payout_summary(1.01)['profit_probability'] == 1